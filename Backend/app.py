@@ -4,6 +4,17 @@ from flask_jwt_extended import JWTManager
 from flask_socketio import SocketIO
 from database import db, migrate
 from config import Config
+from room_cache import recent_messages
+import counters  # Keeps Class.member_count / group_count in step with every flush
+from write_behind import write_behind
+from pubsub import create_client_manager
+from presence import presence
+from subscriptions import room_subscriptions
+from logs import configure_logging, socketio_loggers
+from metrics import instrument, http_metrics
+from query_audit import query_auditor
+from cascade import cascade_deleter
+from tombstones import tombstone_pruner
 import os
 
 # socket server
@@ -11,15 +22,15 @@ import os
 # Force eventlet for Railway deployment
 socketio = SocketIO(
     cors_allowed_origins="*", 
-    max_http_buffer_size=5 * 1024 * 1024,
-    async_mode='eventlet',
-    logger=True,
-    engineio_logger=True
+    max_http_buffer_size=5 * 1024 * 1024 + 64 * 1024,  # 5MB binary attachment + event fields
+    async_mode='eventlet'
+    # logger / engineio_logger come from the config in create_app (see logs.py)
 )
 
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
+    configure_logging(app)
 
     CORS(app, resources={
         r"/api/*": {
@@ -34,11 +45,18 @@ def create_app():
     # database init
     db.init_app(app)
     migrate.init_app(app, db)
+    recent_messages.init_app(app)
+    http_metrics.init_app(app)  # Request/SQL metrics and /metrics (see metrics.py)
+    query_auditor.init_app(app)  # N+1 detection and query budgets, development/tests only
 
     with app.app_context():
         # Import models so SQLAlchemy knows what to create
-        from models import User, SystemLog, FriendRequest, Message, Group, GroupMember, GroupMessage, Class, ClassMember, Assignment, AssignmentSubmission
+        from models import User, SystemLog, FriendRequest, Message, Group, GroupMember, GroupMessage, Class, ClassMember, Assignment, AssignmentSubmission, MessageTombstone, Attachment, UploadSession, Conversation, PendingRegistration, CascadeJob
         db.create_all()
+        # Full-text index lives outside the ORM metadata (FTS5 / tsvector)
+        from search import create_search_index
+        with db.engine.begin() as conn:
+            create_search_index(conn)
 
     # register routes
     from routes.auth import auth_bp
@@ -48,6 +66,8 @@ def create_app():
     from routes.groups import groups_bp
     from routes.classes import classes_bp
     from routes.assignments import assignments_bp
+    from routes.attachments import attachments_bp
+    from routes.jobs import jobs_bp
 
     app.register_blueprint(auth_bp, url_prefix="/api/auth")
     app.register_blueprint(friends_bp, url_prefix="/api/friends")
@@ -56,6 +76,8 @@ def create_app():
     app.register_blueprint(groups_bp, url_prefix="/api/groups")
     app.register_blueprint(classes_bp, url_prefix="/api/classes")
     app.register_blueprint(assignments_bp, url_prefix="/api/assignments")
+    app.register_blueprint(attachments_bp, url_prefix="/api/attachments")
+    app.register_blueprint(jobs_bp, url_prefix="/api/jobs")
     
     from routes.admin import admin_bp
     app.register_blueprint(admin_bp, url_prefix="/api/admin")
@@ -63,6 +85,7 @@ def create_app():
     # socket events
     from sockets.chat import register_socket_events
     register_socket_events(socketio)
+    instrument(socketio)  # Latency/throughput per handler (see metrics.py)
 
     # Serve frontend
     frontend_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Frontend')
@@ -75,8 +98,18 @@ def create_app():
     def serve_static(filename):
         return send_from_directory(frontend_dir, filename)
 
-    # Init socketio with app
-    socketio.init_app(app)
+    # Init socketio with app; a message queue relays emits between worker processes
+    client_manager = create_client_manager(app)
+    if client_manager:
+        socketio.init_app(app, client_manager=client_manager, **socketio_loggers(app))
+    else:
+        socketio.init_app(app, **socketio_loggers(app))
+    # Replays the message journal, so it runs after the tables exist
+    write_behind.init_app(app, socketio)
+    presence.init_app(app, socketio)
+    room_subscriptions.init_app(app, socketio)
+    cascade_deleter.init_app(app, socketio)  # Resumes delete jobs a dead worker left behind
+    tombstone_pruner.init_app(app, socketio)
 
     return app
 
@@ -0,0 +1,349 @@
+"""Content-addressed attachment store.
+
+Raw bytes live on local disk under ATTACHMENT_DIR, keyed by their SHA-256
+digest, so identical uploads are stored once. Rows keep only the digest
+(``file_ref`` / ``voice_ref``) and the bytes are streamed by
+``routes/attachments.py``.
+
+Download URLs are signed and expire (``ATTACHMENT_URL_TTL``). They are only
+minted while serializing a row the caller may read, so holding one proves
+access without an Authorization header (which <img>/<audio> tags cannot
+send). Each URL stays the same for a whole TTL window so browsers can cache
+it; cached payloads are re-signed with ``refresh_urls()`` when served. The
+blob row keeps the MIME type of whoever stored the bytes first, so a URL
+also signs the type its own row declared (``file_type``) and is served as
+that.
+
+Every store records (or touches) the blob's row and flushes it before
+looking at the file, so a blob freed by a cascade delete (cascade.py) in
+the meantime is either kept or written again. Files a transaction wrote for
+new blobs are removed again if it does not commit.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, quote, urlsplit
+
+from flask import current_app, request
+from sqlalchemy import event, or_, select, update
+from sqlalchemy.orm import Session
+from database import db
+from models import Attachment
+
+# Largest single upload accepted (decoded bytes)
+MAX_ATTACHMENT_BYTES = 5 * 1024 * 1024
+# Largest file accepted through the resumable chunked upload API
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# Read/write block size when streaming files
+BLOCK_SIZE = 64 * 1024
+# Allowance for text fields and multipart boundaries on top of the file bytes
+FORM_OVERHEAD_BYTES = 64 * 1024
+ATTACHMENT_PATH = "/api/attachments/"
+# Rendered in the page; every other type (HTML, SVG, scripts...) is only ever downloaded
+INLINE_TYPES = {
+    "image/png", "image/jpeg", "image/gif", "image/webp",
+    "audio/webm", "audio/ogg", "audio/mpeg", "audio/wav", "audio/mp4",
+    "application/pdf",
+}
+
+
+class UploadTooLarge(ValueError):
+    """An upload exceeded its size limit (routes answer 413)"""
+
+
+def blob_path(digest):
+    """On-disk location of a blob, fanned out by the first two hex digits"""
+    return os.path.join(current_app.config["ATTACHMENT_DIR"], digest[:2], digest)
+
+def url_signature(digest, expires, mime_type=None):
+    key = current_app.config["SECRET_KEY"].encode()
+    message = f"attachment:{digest}:{expires}" + (f":{mime_type}" if mime_type else "")
+    return hmac.new(key, message.encode(), hashlib.sha256).hexdigest()[:32]
+
+def attachment_url(digest, mime_type=None):
+    """Signed download URL, valid for one to two ``ATTACHMENT_URL_TTL`` windows, served as ``mime_type`` if given"""
+    ttl = current_app.config.get("ATTACHMENT_URL_TTL", 86400)
+    expires = (int(time.time()) // ttl + 2) * ttl
+    url = f"{ATTACHMENT_PATH}{digest}?exp={expires}&sig={url_signature(digest, expires, mime_type)}"
+    return url + f"&type={quote(mime_type, safe='')}" if mime_type else url
+
+def verify_url(digest, expires, signature, mime_type=None):
+    if expires is None or not signature or expires < time.time():
+        return False
+    return hmac.compare_digest(url_signature(digest, expires, mime_type), signature)
+
+def refresh_urls(payloads, keys=("file_data", "voice_data")):
+    """Copies of cached message payloads with their attachment URLs signed afresh"""
+    fresh = []
+    for payload in payloads:
+        stale = {key: urlsplit(payload[key]) for key in keys if str(payload.get(key) or "").startswith(ATTACHMENT_PATH)}
+        if stale:
+            payload = dict(payload, **{
+                key: attachment_url(url.path[len(ATTACHMENT_PATH):], parse_qs(url.query).get("type", [None])[0])
+                for key, url in stale.items()
+            })
+        fresh.append(payload)
+    return fresh
+
+def reference_columns():
+    """Every ``file_ref`` / ``voice_ref`` style column pointing into the store"""
+    return [
+        column for mapper in db.Model.registry.mappers for column in mapper.class_.__table__.c
+        if any(fk.column.table is Attachment.__table__ for fk in column.foreign_keys)
+    ]
+
+def is_referenced(digest):
+    """Whether any row still points at a blob (one indexed probe per reference column)"""
+    return bool(db.session.scalar(select(or_(
+        *(select(column).where(column == digest).exists() for column in reference_columns())
+    ))))
+
+def resolve_file(ref, inline=None, mime_type=None):
+    """URL for a stored attachment, falling back to a legacy inline base64 value"""
+    return attachment_url(ref, mime_type) if ref else inline
+
+def decode_data_url(value):
+    """Split a ``data:<mime>;base64,<payload>`` string (or bare base64) into bytes and MIME type"""
+    mime_type = None
+    if value.startswith("data:") and "," in value:
+        header, value = value.split(",", 1)
+        mime_type = header[5:].split(";")[0] or None
+    try:
+        return base64.b64decode(value, validate=True), mime_type
+    except binascii.Error as e:
+        raise ValueError(f"Invalid base64 attachment: {e}")
+
+def store_bytes(data, mime_type=None):
+    """Write bytes to the store (once per distinct content) and return the digest"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    created = record_blob(digest, len(data), mime_type)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file in the same directory so the rename is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        if created:
+            written_blobs(db.session).add(digest)
+    return digest
+
+def store_file(src_path, mime_type=None):
+    """Move a staged file into the store, hashing it incrementally; returns the digest"""
+    sha = hashlib.sha256()
+    size = 0
+    with open(src_path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            sha.update(block)
+            size += len(block)
+    return commit_staged(src_path, sha.hexdigest(), size, mime_type)
+
+def store_stream(stream, mime_type=None, max_bytes=MAX_ATTACHMENT_BYTES):
+    """Copy a byte stream into the store block by block, hashing as it goes.
+
+    Raises UploadTooLarge as soon as more than ``max_bytes`` have been read,
+    so an oversized body is never fully buffered. Returns None for an empty
+    stream.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=staging_dir(), prefix=".stream-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for block in iter(lambda: stream.read(BLOCK_SIZE), b""):
+                size += len(block)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"File too large. Maximum size is {max_bytes // (1024 * 1024)}MB")
+                sha.update(block)
+                f.write(block)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    if not size:
+        os.unlink(tmp_path)
+        return None
+    return commit_staged(tmp_path, sha.hexdigest(), size, mime_type)
+
+def commit_staged(src_path, digest, size, mime_type=None):
+    """Rename an already hashed staging file into place (or drop it as a duplicate)"""
+    path = blob_path(digest)
+    created = record_blob(digest, size, mime_type)
+
+    if os.path.exists(path):
+        os.unlink(src_path)  # Already stored: dedupe
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+        if created:
+            written_blobs(db.session).add(digest)
+    return digest
+
+def record_blob(digest, size, mime_type=None):
+    """Insert the blob's row, or mark an existing one as just used, and flush it; True if inserted.
+
+    The flushed row is locked until the caller commits, so a concurrent
+    cascade delete either waits and then skips the blob (its grace period
+    starts over) or has already removed it, in which case a new row goes in
+    and the caller finds the file gone and writes it again.
+    """
+    now = datetime.utcnow()
+    touched = db.session.execute(
+        update(Attachment).where(Attachment.sha256 == digest).values(last_used_at=now)
+    ).rowcount
+    if not touched:
+        db.session.add(Attachment(sha256=digest, size=size, mime_type=mime_type, last_used_at=now))
+        db.session.flush()
+    return not touched
+
+def written_blobs(session):
+    """Digests whose files this transaction wrote for rows it inserted"""
+    return session.info.setdefault("written_blobs", set())
+
+# A request that fails after storing (or never commits) must not leave files behind
+@event.listens_for(Session, "after_commit")
+def keep_written_blobs(session):
+    session.info.pop("written_blobs", None)
+
+@event.listens_for(Session, "after_transaction_end")
+def remove_uncommitted_blobs(session, transaction):
+    if transaction.parent is not None:
+        return
+    digests = session.info.pop("written_blobs", None)
+    if not digests:
+        return
+    with db.engine.connect() as conn:
+        # Another transaction may have stored the same bytes and committed since
+        kept = set(conn.execute(select(Attachment.sha256).where(Attachment.sha256.in_(digests))).scalars())
+    for digest in digests - kept:
+        try:
+            os.remove(blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+def staging_dir():
+    """Scratch directory for partial uploads; same filesystem as the store so moves are atomic"""
+    path = os.path.join(current_app.config["ATTACHMENT_DIR"], "uploads")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def staging_path(name):
+    return os.path.join(staging_dir(), name)
+
+def store_data_url(value, mime_type=None, max_bytes=None):
+    """Store a base64 upload as sent by the frontend; returns None for empty values"""
+    if not value:
+        return None
+    data, detected = decode_data_url(value)
+    if max_bytes is not None and len(data) > max_bytes:
+        raise UploadTooLarge(f"Attachment too large ({len(data)} bytes, limit {max_bytes})")
+    return store_bytes(data, mime_type or detected)
+
+def store_upload(value, mime_type=None):
+    """Store an upload sent as raw bytes (Socket.IO binary frame) or legacy base64 text"""
+    if not value:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        if len(value) > MAX_ATTACHMENT_BYTES:
+            raise ValueError("File too large. Maximum size is 5MB")
+        return store_bytes(bytes(value), mime_type)
+    return store_data_url(value, mime_type)
+
+def read_upload_fields(kinds=("file",), max_bytes=MAX_ATTACHMENT_BYTES):
+    """Text fields of a request that may carry attachments, in any accepted encoding.
+
+    * ``multipart/form-data``: text fields in the form, each attachment in a
+      file part named after its kind (``file``, ``voice``)
+    * any other non-JSON body: the raw bytes are one attachment (``?kind=``,
+      default ``file``) and the text fields come from the query string
+    * JSON (legacy): base64 data URLs in ``<kind>_data`` fields
+
+    Oversized bodies are rejected from Content-Length before anything is
+    read. Nothing is stored: authorise the request from these fields, then
+    call ``store_request_uploads()``.
+    """
+    mimetype = request.mimetype
+
+    if mimetype == "multipart/form-data":
+        check_content_length(max_bytes * len(kinds) + FORM_OVERHEAD_BYTES)
+        fields = request.form.to_dict()
+        for kind in kinds:
+            upload = request.files.get(kind)
+            if not upload:
+                continue
+            if upload.filename:
+                fields.setdefault(f"{kind}_name", upload.filename)
+            if upload.mimetype and upload.mimetype != "application/octet-stream":
+                fields.setdefault(f"{kind}_type", upload.mimetype)
+        return fields
+
+    if mimetype not in ("application/json", "application/x-www-form-urlencoded", ""):
+        check_content_length(max_bytes)
+        fields = request.args.to_dict()
+        kind = fields.pop("kind", kinds[0])
+        if kind not in kinds:
+            raise ValueError(f"Unknown attachment kind: {kind}")
+        if mimetype != "application/octet-stream":
+            fields.setdefault(f"{kind}_type", mimetype)
+        return fields
+
+    # Legacy JSON: base64 is ~4/3 of the decoded size
+    check_content_length(max_bytes * len(kinds) * 4 // 3 + FORM_OVERHEAD_BYTES)
+    fields = request.get_json(silent=True)
+    if not isinstance(fields, dict):
+        raise ValueError("Invalid request body")
+    return fields
+
+def store_request_uploads(fields, kinds=("file",), max_bytes=MAX_ATTACHMENT_BYTES):
+    """Stream the attachments of a request read by ``read_upload_fields()`` into the store.
+
+    Each attachment is limited to ``max_bytes`` whatever the encoding.
+    Returns the stored digest for each kind (None when absent).
+    """
+    mimetype = request.mimetype
+    refs = dict.fromkeys(kinds)
+
+    if mimetype == "multipart/form-data":
+        for kind in kinds:
+            upload = request.files.get(kind)
+            if upload:
+                refs[kind] = store_stream(upload.stream, fields.get(f"{kind}_type"), max_bytes)
+        return refs
+
+    if mimetype not in ("application/json", "application/x-www-form-urlencoded", ""):
+        kind = request.args.get("kind", kinds[0])
+        refs[kind] = store_stream(request.stream, fields.get(f"{kind}_type"), max_bytes)
+        return refs
+
+    for kind in kinds:
+        refs[kind] = store_data_url(fields.get(f"{kind}_data"), fields.get(f"{kind}_type"), max_bytes)
+    return refs
+
+def check_content_length(limit):
+    """Refuse a body larger than ``limit`` before reading it"""
+    if request.content_length is not None and request.content_length > limit:
+        raise UploadTooLarge(f"Request too large ({request.content_length} bytes, limit {limit})")
+    # Chunked bodies carry no length; Werkzeug stops reading past this instead
+    request.max_content_length = limit
+
+def open_attachment(row, kind="file"):
+    """Source URL for one row's attachment, loading its deferred blob if needed.
+
+    Read only: legacy rows still holding inline base64 get that value back
+    (migrate_attachments.py moves them into the store).
+    """
+    ref = getattr(row, f"{kind}_ref")
+    if ref:
+        return attachment_url(ref, row.file_type if kind == "file" else None)
+    return getattr(row, f"{kind}_data")  # Loads the deferred column
@@ -0,0 +1,310 @@
+"""Background cascading deletes in bounded batches.
+
+Deleting a class in the request used to remove its rows in one long write
+transaction (holding SQLite's write lock and stalling every chat send) and
+left its messages, assignments, submissions and their blobs behind.
+``cascade_deleter.enqueue()`` records a ``CascadeJob`` and returns at once;
+a background task then:
+
+1. plans the target's dependency tree from the foreign keys in models.py,
+   plus the references that have none (``POLYMORPHIC``). Children go before
+   their parents and leaf tables before subtrees, so memberships are removed
+   first and access ends with the first batches;
+2. deletes each table's rows ``CASCADE_BATCH_SIZE`` at a time, one short
+   transaction per batch, pausing ``CASCADE_PAUSE_MS`` between batches so
+   chat writes interleave;
+3. in the same transaction, deletes the attachment store blobs the batch
+   referenced that no remaining row does and nothing has stored again for
+   ``CASCADE_BLOB_GRACE_SECONDS`` (a message still queued by write_behind.py,
+   or an upload racing the job, keeps its blob). Their files are moved aside
+   before the commit and unlinked after it (put back if it fails), so a
+   concurrent store finds the file missing and writes it again (see
+   ``record_blob()`` in attachments.py).
+
+The target is marked for deletion before the request returns: the job row
+itself. Routes that write into a class or assignment check ``deleting()``
+and answer 409 while its job is queued or running.
+
+Progress (rows deleted of the planned total, current table, blobs and bytes
+reclaimed) is kept on the job row, served by ``GET /api/jobs/<id>`` and
+pushed to the requester's personal room as ``cascade_job``. Every batch is
+idempotent, so a job whose worker died is picked up by the next process to
+start once it has made no progress for ``CASCADE_STALE_SECONDS``.
+
+Batches are core DELETEs and bypass the session events: ``IN_BATCH`` and
+``AFTER_COMMIT`` stand in for them (search index, socket rooms, message
+cache, staged upload files). Counters need nothing: the class goes too.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, func, inspect, or_, select, union, update
+
+from attachments import blob_path, reference_columns, staging_path
+from database import db
+from logs import get_logger
+from models import (Assignment, Attachment, CascadeJob, Class, Conversation, Group, GroupMessage,
+                    MessageTombstone, UploadSession)
+from room_cache import group_room, recent_messages
+from search import unindex_messages
+from subscriptions import class_socket_room, group_socket_room, room_subscriptions
+
+log = get_logger("cascade")
+
+ROOTS = {"class": Class, "assignment": Assignment}
+# References without a foreign key: (child, column, parent, {discriminator: value})
+POLYMORPHIC = [
+    (Conversation, "chat_id", Group, {"chat_type": "group"}),
+    (MessageTombstone, "group_id", Group, {"chat_type": "group"}),
+]
+ACTIVE = ("queued", "running")
+
+
+def primary_key(model):
+    return inspect(model).primary_key[0]
+
+def child_links(model):
+    """``[(child model, column)]`` whose rows cannot outlive a ``model`` row"""
+    table = model.__table__
+    links = []
+    for mapper in sorted(db.Model.registry.mappers, key=lambda m: m.class_.__tablename__):
+        child = mapper.class_
+        if child is model:
+            continue  # Self references are cleared per batch (see delete_batch)
+        for fk in child.__table__.foreign_keys:
+            if fk.column.table is table:
+                links.append((child, child.__table__.c[fk.parent.name], {}))
+    for child, column, parent, match in POLYMORPHIC:
+        if parent is model:
+            links.append((child, child.__table__.c[column], match))
+    return links
+
+def plan(model, where):
+    """``[(model, where)]`` delete steps for the matching rows and everything under them, children first"""
+    ids = select(primary_key(model)).where(where)
+    subtrees = []
+    for child, column, match in child_links(model):
+        condition = and_(column.in_(ids), *(child.__table__.c[name] == value for name, value in match.items()))
+        subtrees.append(plan(child, condition))
+    subtrees.sort(key=len)  # Leaf tables (memberships) first
+    return [step for subtree in subtrees for step in subtree] + [(model, where)]
+
+def attachment_columns(table):
+    return [c for c in table.c if any(fk.column.table is Attachment.__table__ for fk in c.foreign_keys)]
+
+
+def delete_batch(model, where, size, blob_cutoff):
+    """Delete up to ``size`` matching rows and the blobs only they used; returns ``(ids, blobs)`` (caller commits)"""
+    table = model.__table__
+    pk = primary_key(model)
+    refs = attachment_columns(table)
+    rows = db.session.execute(select(pk, *refs).where(where).limit(size)).all()
+    if not rows:
+        return [], []
+    ids = [row[0] for row in rows]
+    digests = {digest for row in rows for digest in row[1:] if digest}
+
+    for fk in table.foreign_keys:
+        if fk.column.table is table:  # e.g. replies: detach before the parent goes
+            column = table.c[fk.parent.name]
+            db.session.execute(update(table).where(column.in_(ids)).values({column: None}))
+    db.session.execute(delete(table).where(pk.in_(ids)))
+    if model in IN_BATCH:
+        IN_BATCH[model](ids)
+    return ids, unreferenced_blobs(digests, blob_cutoff)
+
+def unreferenced_blobs(digests, cutoff):
+    """Delete the Attachment rows of ``digests`` nothing references nor stored since ``cutoff``; returns ``[(digest, size)]``"""
+    if not digests:
+        return []
+    referenced = set(db.session.execute(union(
+        *(select(column).where(column.in_(digests)) for column in reference_columns())
+    )).scalars())
+    free = digests - referenced
+    if not free:
+        return []
+    # The grace check is in the DELETE itself, so it sees a store that committed while this waited
+    blobs = db.session.execute(delete(Attachment).where(
+        Attachment.sha256.in_(free), func.coalesce(Attachment.last_used_at, Attachment.created_at) < cutoff
+    ).returning(Attachment.sha256, Attachment.size)).all()
+    for digest, _ in blobs:
+        try:
+            os.replace(blob_path(digest), trash_path(digest))
+        except FileNotFoundError:
+            pass
+    return blobs
+
+def trash_path(digest):
+    return blob_path(digest) + ".deleted"
+
+def remove_blob_files(blobs):
+    for digest, _ in blobs:
+        try:
+            os.remove(trash_path(digest))
+        except FileNotFoundError:
+            pass
+
+def restore_blob_files(blobs):
+    """Put back the files of a batch that rolled back (unless a store has written them again)"""
+    for digest, _ in blobs:
+        try:
+            if not os.path.exists(blob_path(digest)):
+                os.replace(trash_path(digest), blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+
+def unindex_group_messages(ids):
+    unindex_messages(db.session.connection(), "group", ids)
+
+def close_groups(ids):
+    for group_id in ids:
+        room_subscriptions.close(group_socket_room(group_id))
+        recent_messages.invalidate(group_room(group_id))
+
+def remove_staged_uploads(ids):
+    for upload_id in ids:
+        try:
+            os.unlink(staging_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+IN_BATCH = {GroupMessage: unindex_group_messages}
+AFTER_COMMIT = {Group: close_groups, UploadSession: remove_staged_uploads}
+
+
+def deleting(*targets):
+    """Whether any ``(target_type, target_id)`` has a queued or running delete job"""
+    return db.session.query(CascadeJob.query.filter(
+        CascadeJob.status.in_(ACTIVE),
+        or_(*(and_(CascadeJob.target_type == target_type, CascadeJob.target_id == target_id)
+              for target_type, target_id in targets))
+    ).exists()).scalar()
+
+def assignment_deleting(assignment):
+    """Whether the assignment or its class is being deleted"""
+    return deleting(("assignment", assignment.id), ("class", assignment.class_id))
+
+
+def job_status(job):
+    return {
+        "job_id": job.id,
+        "target_type": job.target_type,
+        "target_id": job.target_id,
+        "status": job.status,
+        "current_table": job.current_table,
+        "total_rows": job.total_rows,
+        "deleted_rows": job.deleted_rows,
+        "progress": round(job.deleted_rows / job.total_rows, 4) if job.total_rows else (1.0 if job.status == "done" else 0.0),
+        "blobs_reclaimed": job.blobs_reclaimed,
+        "bytes_reclaimed": job.bytes_reclaimed,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class CascadeDeleter:
+    def __init__(self):
+        self._app = None
+        self._socketio = None
+
+    def init_app(self, app, socketio):
+        """Start background delete jobs; resumes jobs a dead worker left behind"""
+        self._app = app
+        self._socketio = socketio
+        self.batch_size = app.config.get("CASCADE_BATCH_SIZE", 500)
+        self.pause = app.config.get("CASCADE_PAUSE_MS", 50) / 1000
+        self.stale = timedelta(seconds=app.config.get("CASCADE_STALE_SECONDS", 120))
+        self.blob_grace = timedelta(seconds=app.config.get("CASCADE_BLOB_GRACE_SECONDS", 3600))
+        app.extensions["cascade"] = self
+
+        with app.app_context():
+            orphaned = db.session.execute(select(CascadeJob.id).where(
+                CascadeJob.status.in_(ACTIVE), CascadeJob.updated_at < datetime.utcnow() - self.stale
+            )).scalars().all()
+        for job_id in orphaned:
+            socketio.start_background_task(self.run, job_id)
+
+    def enqueue(self, target_type, target_id, user_id):
+        """Record a delete job and start it in the background; an active job for the target is reused"""
+        job = CascadeJob.query.filter(
+            CascadeJob.target_type == target_type, CascadeJob.target_id == target_id, CascadeJob.status.in_(ACTIVE)
+        ).first()
+        if job is None:
+            job = CascadeJob(target_type=target_type, target_id=target_id, requested_by=user_id)
+            db.session.add(job)
+            db.session.commit()
+            self._socketio.start_background_task(self.run, job.id)
+        return job
+
+    def claim(self, job_id):
+        """Take a queued job, or a running one whose worker stopped heartbeating"""
+        now = datetime.utcnow()
+        claimed = db.session.execute(update(CascadeJob).where(
+            CascadeJob.id == job_id,
+            or_(CascadeJob.status == "queued", and_(CascadeJob.status == "running", CascadeJob.updated_at < now - self.stale))
+        ).values(status="running", updated_at=now)).rowcount == 1
+        db.session.commit()
+        return claimed
+
+    def run(self, job_id):
+        with self._app.app_context():
+            if not self.claim(job_id):
+                return
+            job = db.session.get(CascadeJob, job_id)
+            try:
+                self.execute(job)
+            except Exception as e:
+                db.session.rollback()
+                job.status, job.error, job.finished_at = "failed", str(e), datetime.utcnow()
+                db.session.commit()
+                log.exception(f"Cascade delete job {job_id} failed")
+            self.notify(job)
+            log.event("cascade_job_finished", level=logging.INFO if job.status == "done" else logging.ERROR,
+                      job_id=job.id, target=f"{job.target_type}:{job.target_id}", status=job.status,
+                      deleted_rows=job.deleted_rows, bytes_reclaimed=job.bytes_reclaimed)
+
+    def execute(self, job):
+        root = ROOTS[job.target_type]
+        steps = plan(root, primary_key(root) == job.target_id)
+        if not job.total_rows:
+            job.total_rows = sum(
+                db.session.scalar(select(func.count()).select_from(model).where(where)) for model, where in steps
+            )
+            db.session.commit()
+        if job.target_type == "class":
+            room_subscriptions.close(class_socket_room(job.target_id))
+
+        for model, where in steps:
+            job.current_table = model.__tablename__
+            while True:
+                ids, blobs = [], []
+                try:
+                    ids, blobs = delete_batch(model, where, self.batch_size, datetime.utcnow() - self.blob_grace)
+                    if not ids:
+                        break
+                    job.deleted_rows += len(ids)
+                    job.blobs_reclaimed += len(blobs)
+                    job.bytes_reclaimed += sum(size for _, size in blobs)
+                    job.updated_at = datetime.utcnow()
+                    db.session.commit()
+                except Exception:
+                    restore_blob_files(blobs)
+                    raise
+                remove_blob_files(blobs)
+                if model in AFTER_COMMIT:
+                    AFTER_COMMIT[model](ids)
+                self.notify(job)
+                self._socketio.sleep(self.pause)  # Let waiting writers take the lock
+
+        job.status, job.current_table, job.finished_at = "done", None, datetime.utcnow()
+        db.session.commit()
+
+    def notify(self, job):
+        if job.requested_by is not None:
+            self._socketio.emit("cascade_job", job_status(job), room=str(job.requested_by))
+
+
+cascade_deleter = CascadeDeleter()
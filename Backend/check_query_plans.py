@@ -0,0 +1,96 @@
+"""Fail if a hot query pattern falls back to a full table scan.
+
+Each registered pattern is compiled to SQL and run through SQLite's
+EXPLAIN QUERY PLAN. Any ``SCAN <table>`` step means an index is missing
+(or a query stopped matching one) and the script exits non-zero.
+
+    python check_query_plans.py            # the configured database
+    python check_query_plans.py --models   # a scratch in-memory schema from models.py
+"""
+import sys
+
+from sqlalchemy import create_engine, text
+
+from app import create_app
+from database import db
+from models import (Message, GroupMessage, GroupMember, ClassMember, Assignment,
+                    AssignmentSubmission, FriendRequest, Conversation)
+
+# Placeholder ids; the plan does not depend on the values
+A, B, GROUP, CLASS, ASSIGNMENT = 1, 2, 3, 4, 5
+
+# (description, query builder) — register new hot queries here
+QUERY_PATTERNS = [
+    ("DM history page", lambda: Message.query.filter(
+        ((Message.sender_id == A) & (Message.receiver_id == B)) |
+        ((Message.sender_id == B) & (Message.receiver_id == A))
+    ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(51)),
+    ("Group history page", lambda: GroupMessage.query.filter_by(group_id=GROUP)
+        .order_by(GroupMessage.timestamp.desc(), GroupMessage.id.desc()).limit(51)),
+    ("Group membership check", lambda: GroupMember.query.filter_by(group_id=GROUP, user_id=A).limit(1)),
+    ("Group members", lambda: GroupMember.query.filter_by(group_id=GROUP)),
+    ("User's groups", lambda: GroupMember.query.filter_by(user_id=A)),
+    ("Class membership check", lambda: ClassMember.query.filter_by(class_id=CLASS, user_id=A).limit(1)),
+    ("Class members", lambda: ClassMember.query.filter_by(class_id=CLASS)),
+    ("User's classes", lambda: ClassMember.query.filter_by(user_id=A)),
+    ("Class assignments", lambda: Assignment.query.filter_by(class_id=CLASS).order_by(Assignment.due_date)),
+    ("Student submission", lambda: AssignmentSubmission.query.filter_by(assignment_id=ASSIGNMENT, student_id=A).limit(1)),
+    ("Assignment submissions", lambda: AssignmentSubmission.query.filter_by(assignment_id=ASSIGNMENT)),
+    ("Friend request between users", lambda: FriendRequest.query.filter(
+        ((FriendRequest.sender_id == A) & (FriendRequest.receiver_id == B)) |
+        ((FriendRequest.sender_id == B) & (FriendRequest.receiver_id == A))
+    ).limit(1)),
+    ("Incoming friend requests", lambda: FriendRequest.query.filter_by(receiver_id=A, status='pending')),
+    ("Outgoing friend requests", lambda: FriendRequest.query.filter_by(sender_id=A, status='pending')),
+    ("Inbox", lambda: Conversation.query.filter_by(user_id=A).order_by(Conversation.last_timestamp.desc())),
+    ("Group inbox fan-out", lambda: Conversation.query.filter_by(chat_type="group", chat_id=GROUP)),
+    ("Friends list", lambda: FriendRequest.query.filter(
+        ((FriendRequest.sender_id == A) | (FriendRequest.receiver_id == A)) &
+        (FriendRequest.status == 'accepted')
+    )),
+]
+
+
+def full_scans(conn, query):
+    """Plan steps of a query that read a whole table"""
+    sql = str(query.statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql)).fetchall()
+    details = [row[-1] for row in plan]
+    return [d for d in details if d.startswith("SCAN ") and d != "SCAN CONSTANT ROW"]
+
+
+def check(conn):
+    failures = 0
+    for description, build in QUERY_PATTERNS:
+        scans = full_scans(conn, build())
+        if scans:
+            failures += 1
+            print(f"FAIL  {description}: {'; '.join(scans)}")
+        else:
+            print(f"ok    {description}")
+    return failures
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        if "--models" in sys.argv:
+            engine = create_engine("sqlite://")
+            db.metadata.create_all(engine)
+        else:
+            engine = db.engine
+            if engine.dialect.name != "sqlite":
+                print("EXPLAIN QUERY PLAN checks need SQLite; rerun with --models")
+                return 2
+        with engine.connect() as conn:
+            failures = check(conn)
+
+    if failures:
+        print(f"{failures} query pattern(s) fall back to a full table scan")
+        return 1
+    print("All query patterns use an index")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,3 +9,52 @@ class Config:
     SQLALCHEMY_DATABASE_URI = "sqlite:///sapcca.db"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     JWT_SECRET_KEY = "JWT_SECRET_123" 
+    # Content-addressed attachment store (see attachments.py)
+    ATTACHMENT_DIR = os.environ.get("ATTACHMENT_DIR", os.path.join(BASE_DIR, "instance", "attachments"))
+    ATTACHMENT_URL_TTL = int(os.environ.get("ATTACHMENT_URL_TTL", 86400))  # Signed download URLs live one to two of these (seconds)
+    # Per-room recent message cache (see room_cache.py)
+    RECENT_CACHE_ROOM_SIZE = int(os.environ.get("RECENT_CACHE_ROOM_SIZE", 50))  # Messages kept per room
+    RECENT_CACHE_MAX_BYTES = int(os.environ.get("RECENT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    # Write-behind persistence for socket chat messages (see write_behind.py)
+    WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0") == "1"
+    WRITE_BEHIND_INTERVAL_MS = int(os.environ.get("WRITE_BEHIND_INTERVAL_MS", 50))  # Max time a message waits
+    WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 200))  # Flush early at this many
+    WRITE_BEHIND_WORKER_IDS = os.environ.get("WRITE_BEHIND_WORKER_IDS", "0-31")  # Claimed one per process; disjoint per host
+    WRITE_BEHIND_JOURNAL_DIR = os.environ.get("WRITE_BEHIND_JOURNAL_DIR", os.path.join(BASE_DIR, "instance", "journal"))
+    WRITE_BEHIND_FSYNC = os.environ.get("WRITE_BEHIND_FSYNC", "0") == "1"  # fsync every journal append
+    WRITE_BEHIND_SYNC_LAG_MS = int(os.environ.get("WRITE_BEHIND_SYNC_LAG_MS", 2000))  # Sync cursors trail the clock by this much
+    # Multi-worker Socket.IO (see pubsub.py and deploy/README.md)
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")  # redis://, amqp://, sqlite:///... ; unset = one process
+    SOCKETIO_CHANNEL = os.environ.get("SOCKETIO_CHANNEL", "sapcca")
+    SOCKETIO_QUEUE_POLL_MS = int(os.environ.get("SOCKETIO_QUEUE_POLL_MS", 50))  # sqlite broker only
+    # Socket presence (see presence.py)
+    PRESENCE_TIMEOUT = int(os.environ.get("PRESENCE_TIMEOUT", 60))  # Seconds without a heartbeat before offline
+    PRESENCE_FLUSH_MS = int(os.environ.get("PRESENCE_FLUSH_MS", 1000))  # Presence change coalescing window
+    # Logging (see logs.py)
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json or text
+    LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))  # Records beyond this are dropped, never waited on
+    LOG_SAMPLE_RATES = os.environ.get(  # Fraction of each chatty event kept
+        "LOG_SAMPLE_RATES",
+        "ice_candidate=0.01,message_sent=0.1,group_message_sent=0.1,room_joined=0.1,room_left=0.1"
+    )
+    SOCKETIO_LOGGER = os.environ.get("SOCKETIO_LOGGER", "0") == "1"  # Socket.IO packet logs
+    ENGINEIO_LOGGER = os.environ.get("ENGINEIO_LOGGER", "0") == "1"  # Engine.IO transport logs (very verbose)
+    # Prometheus scrape endpoint /metrics (see metrics.py)
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # Bearer token for scrapers (admins may use their JWT)
+    METRICS_PUBLIC = os.environ.get("METRICS_PUBLIC", "0") == "1"  # Serve /metrics without authentication
+    # Per-request SQL audit for development and tests (see query_audit.py)
+    QUERY_AUDIT = os.environ.get("QUERY_AUDIT", "0") == "1"
+    QUERY_AUDIT_REPEAT_THRESHOLD = int(os.environ.get("QUERY_AUDIT_REPEAT_THRESHOLD", 5))  # Same statement this often = N+1
+    QUERY_AUDIT_RAISE = os.environ.get("QUERY_AUDIT_RAISE", "0") == "1"  # Fail over-budget requests instead of logging
+    # Bulk roster import (see roster.py)
+    ROSTER_CHUNK_SIZE = int(os.environ.get("ROSTER_CHUNK_SIZE", 500))  # Rows resolved and inserted per batch
+    ROSTER_MAX_ROWS = int(os.environ.get("ROSTER_MAX_ROWS", 20000))
+    # Background cascading deletes (see cascade.py)
+    CASCADE_BATCH_SIZE = int(os.environ.get("CASCADE_BATCH_SIZE", 500))  # Rows per delete transaction
+    CASCADE_PAUSE_MS = int(os.environ.get("CASCADE_PAUSE_MS", 50))  # Gap between batches for other writers
+    CASCADE_STALE_SECONDS = int(os.environ.get("CASCADE_STALE_SECONDS", 120))  # Running job without progress: resumed on startup
+    CASCADE_BLOB_GRACE_SECONDS = int(os.environ.get("CASCADE_BLOB_GRACE_SECONDS", 3600))  # Blobs stored within this are kept
+    # Deleted-message tombstones for delta sync (see tombstones.py)
+    SYNC_HORIZON_DAYS = int(os.environ.get("SYNC_HORIZON_DAYS", 7))  # Kept this long; older sync cursors reload history
+    SYNC_PRUNE_INTERVAL = int(os.environ.get("SYNC_PRUNE_INTERVAL", 3600))  # Seconds between prune passes
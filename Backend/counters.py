@@ -0,0 +1,113 @@
+"""Materialized per-class counts and version stamp.
+
+Maintained in the same flush as the change, whatever route made it:
+
+* ``Class.member_count`` / ``Class.group_count`` follow ClassMember and
+  Group inserts, deletes and re-parenting, so class listings read them
+  instead of counting.
+* ``Class.version`` is bumped by any change to what the class detail view
+  shows: the class row, its members, its groups, their members, and the
+  name, email or role of a user in the class. Class detail responses use it
+  as their ETag (see routes/classes.py).
+
+Every adjustment is a relative ``UPDATE ... SET n = n + delta``, which stays
+correct under concurrent writers. Bulk statements bypass the session: only
+use ``query.delete()`` when the class itself is being deleted, and follow a
+bulk insert with ``adjust_class()`` (see roster.py).
+"""
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+from models import Class, ClassMember, Group, GroupMember, User
+
+COUNTERS = {ClassMember: "member_count", Group: "group_count"}
+USER_FIELDS = ("display_name", "email", "role")  # Shown in class member lists
+
+classes = Class.__table__
+
+
+def class_ids_of(obj):
+    """Current and previous class of a ClassMember or Group (both when re-parented)"""
+    history = inspect(obj).attrs.class_id.history
+    return {i for i in (*history.deleted, *history.added, *history.unchanged) if i is not None}
+
+def collect_changes(session):
+    """``({class_id: {column: delta}}, group ids, user ids)`` for the current flush"""
+    changes = {}
+    group_ids, user_ids, deleted_classes = set(), set(), set()
+
+    def bump(class_id, counter=None, delta=0):
+        if class_id is None:
+            return
+        columns = changes.setdefault(class_id, {"version": 1})
+        if counter:
+            columns[counter] = columns.get(counter, 0) + delta
+
+    for objects, delta in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if type(obj) in COUNTERS:
+                # A deleted row counts against the parent it was committed under
+                history = inspect(obj).attrs.class_id.history
+                parent = history.deleted[0] if delta < 0 and history.deleted else obj.class_id
+                bump(parent, COUNTERS[type(obj)], delta)
+            elif isinstance(obj, Class) and delta < 0:
+                deleted_classes.add(obj.id)  # Nothing left to stamp
+            elif isinstance(obj, GroupMember):
+                group_ids.add(obj.group_id)
+
+    for obj in session.dirty:
+        if not session.is_modified(obj, include_collections=False):
+            continue
+        if isinstance(obj, Class):
+            bump(obj.id)
+        elif type(obj) in COUNTERS:
+            history = inspect(obj).attrs.class_id.history
+            for old in history.deleted:
+                bump(old, COUNTERS[type(obj)], -1)
+            for new in history.added:
+                bump(new, COUNTERS[type(obj)], 1)
+            for class_id in class_ids_of(obj):
+                bump(class_id)
+        elif isinstance(obj, GroupMember):
+            group_ids.add(obj.group_id)
+        elif isinstance(obj, User):
+            state = inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in USER_FIELDS):
+                user_ids.add(obj.id)
+    for class_id in deleted_classes:
+        changes.pop(class_id, None)
+    return changes, group_ids - {None}, user_ids
+
+def adjust_class(session, class_id, columns):
+    """Add ``{column: delta}`` to a class row (and to its loaded instance, without a SELECT)"""
+    session.connection().execute(update(classes).where(classes.c.id == class_id).values(
+        {classes.c[name]: classes.c[name] + delta for name, delta in columns.items() if delta}
+    ))
+    loaded = session.identity_map.get(identity_key(Class, class_id))
+    if loaded is not None:
+        for name, delta in columns.items():
+            if name in loaded.__dict__:
+                set_committed_value(loaded, name, loaded.__dict__[name] + delta)
+
+
+@event.listens_for(Session, "after_flush")
+def apply_class_counters(session, flush_context):
+    changes, group_ids, user_ids = collect_changes(session)
+    if not (changes or group_ids or user_ids):
+        return
+    connection = session.connection()
+    for class_id, columns in changes.items():
+        adjust_class(session, class_id, columns)
+
+    # Classes reached through a group or a member: one statement each
+    affected = []
+    if group_ids:
+        affected.append(select(Group.class_id).where(Group.id.in_(group_ids), Group.class_id.is_not(None)))
+    if user_ids:
+        affected.append(select(ClassMember.class_id).where(ClassMember.user_id.in_(user_ids)))
+    for class_ids in affected:
+        connection.execute(update(classes).where(
+            classes.c.id.in_(class_ids.scalar_subquery()), classes.c.id.not_in(list(changes))
+        ).values(version=classes.c.version + 1))
@@ -0,0 +1,182 @@
+"""Per-user conversation inbox.
+
+Every user has one Conversation row per DM peer and per group they have
+messages in, holding the last message and an unread count. Rows are
+updated in the same transaction as the send or delete, so the chat sidebar
+is a single indexed read (``/api/messages/inbox``) instead of a scan over
+message history. Callers commit.
+"""
+from sqlalchemy import case, exists, insert, literal, select, update
+
+from database import db
+from models import Conversation, GroupMember, GroupMessage, Message
+
+# Characters of message text kept for the sidebar
+PREVIEW_LENGTH = 100
+
+
+def message_preview(text, file_name=None, has_voice=False):
+    """Sidebar line for a message: its text, or a placeholder for attachments"""
+    if text:
+        return text[:PREVIEW_LENGTH]
+    if has_voice:
+        return "[Voice message]"
+    if file_name:
+        return f"[File: {file_name}]"[:PREVIEW_LENGTH]
+    return ""
+
+def last_message_fields(msg, text):
+    return {
+        "last_message_id": msg.id,
+        "last_sender_id": msg.sender_id,
+        "preview": message_preview(text, msg.file_name, bool(msg.voice_ref)),
+        "last_timestamp": msg.timestamp,
+    }
+
+def record_dm(msg):
+    """Update both participants' rows for a new direct message"""
+    db.session.flush()  # Assigns msg.id and msg.timestamp
+    fields = last_message_fields(msg, msg.content)
+
+    sides = [(msg.sender_id, msg.receiver_id)]
+    if msg.receiver_id != msg.sender_id:
+        sides.append((msg.receiver_id, msg.sender_id))
+
+    for user_id, peer_id in sides:
+        conv = Conversation.query.filter_by(user_id=user_id, chat_type="dm", chat_id=peer_id).first()
+        is_sender = user_id == msg.sender_id
+        if not conv:
+            db.session.add(Conversation(
+                user_id=user_id, chat_type="dm", chat_id=peer_id,
+                unread_count=0 if is_sender else 1,
+                last_read_message_id=msg.id if is_sender else 0,
+                **fields
+            ))
+            continue
+        for key, value in fields.items():
+            setattr(conv, key, value)
+        if is_sender:
+            # Replying means the sender has read the conversation
+            conv.unread_count = 0
+            conv.last_read_message_id = msg.id
+        else:
+            conv.unread_count = Conversation.unread_count + 1  # Atomic in SQL
+
+def record_group_message(msg):
+    """Update every member's row for a new group message in two set-based statements"""
+    db.session.flush()
+    fields = last_message_fields(msg, msg.text)
+    is_sender = Conversation.user_id == msg.sender_id
+
+    db.session.execute(
+        update(Conversation)
+        .where(Conversation.chat_type == "group", Conversation.chat_id == msg.group_id)
+        .values(
+            unread_count=case((is_sender, 0), else_=Conversation.unread_count + 1),
+            last_read_message_id=case((is_sender, msg.id), else_=Conversation.last_read_message_id),
+            **fields
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    # Members who have no row yet (first message since they joined)
+    member_is_sender = GroupMember.user_id == msg.sender_id
+    missing = select(
+        GroupMember.user_id,
+        literal("group"),
+        literal(msg.group_id),
+        case((member_is_sender, 0), else_=1),
+        case((member_is_sender, msg.id), else_=0),
+        *(literal(value) for value in fields.values())
+    ).where(
+        GroupMember.group_id == msg.group_id,
+        ~exists().where(
+            (Conversation.user_id == GroupMember.user_id) &
+            (Conversation.chat_type == "group") &
+            (Conversation.chat_id == msg.group_id)
+        )
+    )
+    db.session.execute(insert(Conversation).from_select(
+        ["user_id", "chat_type", "chat_id", "unread_count", "last_read_message_id", *fields],
+        missing
+    ))
+
+def record_delete(msg, chat_type):
+    """Fix up rows affected by deleting ``msg`` (call before deleting it)"""
+    if chat_type == "dm":
+        chat_filter = (Conversation.chat_type == "dm") & (
+            ((Conversation.user_id == msg.sender_id) & (Conversation.chat_id == msg.receiver_id)) |
+            ((Conversation.user_id == msg.receiver_id) & (Conversation.chat_id == msg.sender_id))
+        )
+        previous = Message.query.filter(
+            ((Message.sender_id == msg.sender_id) & (Message.receiver_id == msg.receiver_id)) |
+            ((Message.sender_id == msg.receiver_id) & (Message.receiver_id == msg.sender_id)),
+            Message.id != msg.id
+        ).order_by(Message.timestamp.desc(), Message.id.desc()).first()
+        previous_text = previous.content if previous else None
+    else:
+        chat_filter = (Conversation.chat_type == "group") & (Conversation.chat_id == msg.group_id)
+        previous = GroupMessage.query.filter(
+            GroupMessage.group_id == msg.group_id,
+            GroupMessage.id != msg.id
+        ).order_by(GroupMessage.timestamp.desc(), GroupMessage.id.desc()).first()
+        previous_text = previous.text if previous else None
+
+    # Recipients who had not read it yet lose one unread
+    db.session.execute(
+        update(Conversation)
+        .where(
+            chat_filter,
+            Conversation.user_id != msg.sender_id,
+            Conversation.last_read_message_id < msg.id,
+            Conversation.unread_count > 0
+        )
+        .values(unread_count=Conversation.unread_count - 1)
+        .execution_options(synchronize_session=False)
+    )
+
+    # Rows showing it as the last message fall back to the one before
+    if previous:
+        fields = last_message_fields(previous, previous_text)
+    else:
+        fields = dict.fromkeys(("last_message_id", "last_sender_id", "preview", "last_timestamp"))
+    db.session.execute(
+        update(Conversation)
+        .where(chat_filter, Conversation.last_message_id == msg.id)
+        .values(**fields)
+        .execution_options(synchronize_session=False)
+    )
+
+def mark_read(user_id, chat_type, chat_id):
+    """Clear a user's unread count for one chat; True if anything was unread (caller commits).
+
+    History and sync reads call this on every page, so it checks first and
+    only writes (taking SQLite's write lock) when there is something to clear.
+    """
+    unread = db.session.query(Conversation.id).filter(
+        Conversation.user_id == user_id,
+        Conversation.chat_type == chat_type,
+        Conversation.chat_id == chat_id,
+        Conversation.unread_count > 0
+    ).first()
+    if unread is None:
+        return False
+    db.session.execute(
+        update(Conversation)
+        .where(
+            Conversation.user_id == user_id,
+            Conversation.chat_type == chat_type,
+            Conversation.chat_id == chat_id,
+            Conversation.unread_count > 0
+        )
+        .values(unread_count=0, last_read_message_id=Conversation.last_message_id)
+        .execution_options(synchronize_session=False)
+    )
+    return True
+
+def forget_group(group_id, user_id=None):
+    """Drop group rows when a member leaves (or for everyone when the group goes)"""
+    query = Conversation.query.filter_by(chat_type="group", chat_id=group_id)
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    query.delete(synchronize_session=False)
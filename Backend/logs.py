@@ -0,0 +1,191 @@
+"""Structured, non-blocking application logging.
+
+Handlers log through ``get_logger(name)`` instead of ``print()``:
+
+    log = get_logger("sockets")
+    log.event("ice_candidate", sender_id=1, peer_id=2)  # INFO, sampled
+    log.exception("Error sending group message")          # Any logging call works
+
+* ``event()`` records carry the event name and keyword fields; with
+  ``LOG_FORMAT=json`` (the default) each record is one JSON line.
+* ``LOG_SAMPLE_RATES`` (``"ice_candidate=0.01,message_sent=0.1"``) keeps one
+  in ``1/rate`` of a chatty INFO/DEBUG event; warnings and errors are never
+  sampled. Kept records carry ``sample_rate`` so counts can be scaled back.
+* Records are put on a bounded in-memory queue and written by a native OS
+  thread, so a handler (or the eventlet hub) never waits on stdout. When the
+  queue is full, records are dropped and counted rather than blocking.
+
+Socket.IO / Engine.IO protocol logs are off unless ``SOCKETIO_LOGGER`` /
+``ENGINEIO_LOGGER`` are set; they then go through the same queue.
+"""
+import json
+import logging
+import sys
+import threading
+import queue
+from datetime import datetime, timezone
+
+try:
+    from eventlet import patcher
+except ImportError:
+    patcher = None
+
+ROOT = "sapcca"
+
+
+def native(module):
+    """The unpatched module even when eventlet has monkey-patched it"""
+    if patcher is not None:
+        return patcher.original(module)
+    return {"threading": threading, "queue": queue}[module]
+
+def parse_rates(spec):
+    """``"event=rate,..."`` -> ``{event: rate}``"""
+    rates = {}
+    for item in (spec or "").split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class Sampler:
+    """Keeps every Nth record of an event, N = 1 / its rate (deterministic, no RNG)"""
+
+    def __init__(self, rates=None):
+        self.rates = rates or {}
+        self._seen = {}
+
+    def keep(self, event):
+        rate = self.rates.get(event)
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        count = self._seen.get(event, 0)
+        self._seen[event] = count + 1
+        return count % round(1 / rate) == 0
+
+
+class EventLogger(logging.LoggerAdapter):
+    def event(self, name, level=logging.INFO, **fields):
+        """Log a named event with structured fields (sampled below WARNING)"""
+        if not self.logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING:
+            if not sampler.keep(name):
+                return
+            rate = sampler.rates.get(name)
+            if rate is not None and rate < 1:
+                fields["sample_rate"] = rate
+        self.logger.log(level, name, extra={"event": name, "fields": fields})
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        if hasattr(record, "event"):
+            entry["event"] = record.event
+            entry.update(record.fields)
+        else:
+            entry["msg"] = record.getMessage()
+        if record.exc_text:
+            entry["exc"] = record.exc_text  # Formatted before queueing
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        if hasattr(record, "event"):
+            line += "".join(f" {key}={value}" for key, value in record.fields.items())
+        return line
+
+
+class QueueWriter(logging.Handler):
+    """Enqueues records; a native thread formats and writes them"""
+
+    def __init__(self, stream, formatter, maxsize=10000):
+        super().__init__()
+        self.stream = stream
+        self.setFormatter(formatter)
+        self._queues = native("queue")  # Its Full/Empty are not queue.Full/queue.Empty
+        self.queue = self._queues.Queue(maxsize)
+        self.dropped = 0
+        self._thread = native("threading").Thread(target=self._drain, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def handle(self, record):
+        # No handler lock: the queue is the only shared state
+        if not self.filter(record):
+            return False
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)  # Traceback objects stay here
+            record.exc_info = None
+        record.msg, record.args = record.getMessage(), None
+        try:
+            self.queue.put_nowait(record)
+        except self._queues.Full:
+            self.dropped += 1
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+    def _drain(self):
+        while True:
+            record = self.queue.get()
+            while record is not None:
+                try:
+                    self.stream.write(self.format(record) + "\n")
+                except Exception:
+                    pass
+                try:
+                    record = self.queue.get_nowait()
+                except self._queues.Empty:
+                    record = None
+            self.stream.flush()  # Once per burst, not per line
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "dropped": self.dropped}
+
+
+sampler = Sampler()
+writer = None
+
+def get_logger(name):
+    return EventLogger(logging.getLogger(f"{ROOT}.{name}"), {})
+
+def configure_logging(app):
+    """Install the queue writer on the application loggers (idempotent)"""
+    global writer
+    sampler.rates = parse_rates(app.config.get("LOG_SAMPLE_RATES"))
+    level = app.config.get("LOG_LEVEL", "INFO")
+    formatter = JsonFormatter() if app.config.get("LOG_FORMAT", "json") == "json" else TextFormatter()
+    if writer is None:
+        writer = QueueWriter(sys.stdout, formatter, app.config.get("LOG_QUEUE_SIZE", 10000))
+    else:
+        writer.setFormatter(formatter)
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    root.propagate = False
+    if writer not in root.handlers:
+        root.addHandler(writer)
+    app.extensions["logs"] = writer
+
+def socketio_loggers(app):
+    """``logger`` / ``engineio_logger`` for Socket.IO: queued, errors only unless enabled"""
+    options = {}
+    for option, key, name in (("logger", "SOCKETIO_LOGGER", "socketio"), ("engineio_logger", "ENGINEIO_LOGGER", "engineio")):
+        logger = logging.getLogger(f"{ROOT}.{name}")
+        logger.setLevel(logging.INFO if app.config.get(key) else logging.ERROR)
+        options[option] = logger
+    return options
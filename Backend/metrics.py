@@ -0,0 +1,503 @@
+"""In-process metrics: Socket.IO handlers, HTTP routes, SQL and the process.
+
+``instrument(socketio)`` wraps every handler registered with
+``@socketio.on`` (call it after registration, before ``init_app``). Per
+event it records calls, errors, payload bytes and a latency histogram; per
+room it records event counts and a one-minute rate, so the admin dashboard
+can show which rooms and event types load the worker. Room names come from
+client payloads, so an event only counts toward a room the socket is in
+once its handler returns; everything else is bucketed as ``other``.
+
+* Latency buckets are fixed (log-spaced from 50 µs to 10 s), so recording
+  is a bisect plus an increment and memory does not grow with traffic.
+  Percentiles are read from the buckets (upper bound of the bucket holding
+  the rank), accurate to one bucket.
+* Errors count exceptions escaping a handler plus ERROR records the handler
+  logs itself (handlers in sockets/chat.py catch and log their failures).
+* Metrics are per process; each worker reports its own.
+
+``http_metrics.init_app(app)`` times every Flask request per blueprint and
+route, counts the SQL statements (and their time) each request runs, and
+serves everything in Prometheus text format at ``/metrics`` together with
+connection pool usage, eventlet hub load and process RSS. Scrapes need
+``Authorization: Bearer <METRICS_TOKEN>`` or an admin's JWT; set
+``METRICS_PUBLIC=1`` to serve them without either (e.g. behind a private
+network only).
+SQL from socket handlers is counted under the ``socketio`` blueprint and
+from background loops under ``background``.
+"""
+import bisect
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy import event
+
+from database import db
+from logs import ROOT
+from models import User
+
+# Upper bounds in milliseconds; a final bucket catches anything slower
+LATENCY_BUCKETS_MS = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+)
+SQL_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)  # Statements per request
+MAX_ROOMS = 1000  # Rooms tracked at once, least recently active dropped first
+TOP_ROOMS = 20
+OTHER_ROOM = "other"  # Rooms named in payloads the socket has not joined
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "sum", "max")
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count, 3) if self.count else None,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max, 3),
+            "buckets": dict(zip([str(b) for b in self.bounds] + ["+Inf"], self.counts)),
+        }
+
+
+class RateWindow:
+    """Events per second over the last minute, from two one-minute counters"""
+    __slots__ = ("minute", "current", "previous", "total")
+
+    def __init__(self):
+        self.minute = int(time.monotonic() // 60)
+        self.current = self.previous = self.total = 0
+
+    def add(self, now):
+        self._roll(now)
+        self.current += 1
+        self.total += 1
+
+    def rate(self, now):
+        self._roll(now)
+        elapsed = (now % 60) / 60
+        return round((self.previous * (1 - elapsed) + self.current) / 60, 3)
+
+    def _roll(self, now):
+        minute = int(now // 60)
+        if minute != self.minute:
+            self.previous = self.current if minute == self.minute + 1 else 0
+            self.current = 0
+            self.minute = minute
+
+
+class EventStats:
+    __slots__ = ("calls", "errors", "payload_bytes", "max_payload_bytes", "latency", "rate")
+
+    def __init__(self):
+        self.calls = self.errors = self.payload_bytes = self.max_payload_bytes = 0
+        self.latency = Histogram()
+        self.rate = RateWindow()
+
+
+class SocketMetrics:
+    def __init__(self):
+        self._events = {}  # event name -> EventStats
+        self._rooms = OrderedDict()  # room -> RateWindow, least recently active first
+        self._lock = threading.Lock()
+        self._current = threading.local()  # Event being handled (greenlet-local under eventlet)
+        self.started = time.time()
+        self.socketio = None  # For room membership (set by instrument())
+
+    def wrap(self, event, handler):
+        if getattr(handler, "_instrumented", False):
+            return handler
+
+        @wraps(handler)
+        def instrumented(sid, *args):
+            self._current.event = event
+            self._current.failed = False
+            started = time.perf_counter()
+            try:
+                return handler(sid, *args)
+            except Exception:
+                self._current.failed = True
+                raise
+            finally:
+                self.record(event, (time.perf_counter() - started) * 1000, sid, args, self._current.failed)
+                self._current.event = None
+
+        instrumented._instrumented = True
+        return instrumented
+
+    def record(self, event, elapsed_ms, sid, args, failed):
+        size = payload_size(args)
+        room = room_of(args)
+        if room is not None and not self.in_room(sid, room):
+            room = OTHER_ROOM
+        now = time.monotonic()
+        with self._lock:
+            stats = self._events.get(event)
+            if stats is None:
+                stats = self._events[event] = EventStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.payload_bytes += size
+            stats.max_payload_bytes = max(stats.max_payload_bytes, size)
+            stats.latency.record(elapsed_ms)
+            stats.rate.add(now)
+            if room is not None:
+                window = self._rooms.get(room)
+                if window is None:
+                    window = self._rooms[room] = RateWindow()
+                    if len(self._rooms) > MAX_ROOMS:
+                        self._rooms.popitem(last=False)
+                else:
+                    self._rooms.move_to_end(room)
+                window.add(now)
+
+    def in_room(self, sid, room):
+        server = self.socketio.server if self.socketio is not None else None
+        if server is None:
+            return False
+        return sid in server.manager.rooms.get("/", {}).get(room, ())
+
+    def handled_error(self):
+        """Count an error a handler caught and logged"""
+        if getattr(self._current, "event", None):
+            self._current.failed = True
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            events = {
+                name: {
+                    "calls": s.calls,
+                    "errors": s.errors,
+                    "per_second": s.rate.rate(now),
+                    "payload_bytes": s.payload_bytes,
+                    "avg_payload_bytes": s.payload_bytes // s.calls if s.calls else 0,
+                    "max_payload_bytes": s.max_payload_bytes,
+                    "latency": s.latency.snapshot(),
+                }
+                for name, s in sorted(self._events.items())
+            }
+            rooms = sorted(
+                ({"room": room, "per_second": w.rate(now), "events": w.total} for room, w in self._rooms.items()),
+                key=lambda r: (r["per_second"], r["events"]), reverse=True
+            )
+        return {
+            "uptime_s": round(time.time() - self.started),
+            "events": events,
+            "top_rooms": rooms[:TOP_ROOMS],
+            "tracked_rooms": len(rooms),
+        }
+
+    def reset(self):
+        with self._lock:
+            self._events.clear()
+            self._rooms.clear()
+            self.started = time.time()
+
+
+class HandledErrors(logging.Filter):
+    """Counts ERROR records logged while a socket handler runs"""
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            socket_metrics.handled_error()
+        return True
+
+
+def payload_size(value):
+    """Approximate wire size of event arguments without serializing them"""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(k)) + payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+    return 8 if value is not None else 0
+
+def room_of(args):
+    """Room an event targets, from the conventions of sockets/chat.py payloads"""
+    data = args[0] if args and isinstance(args[0], dict) else None
+    if not data:
+        return None
+    if data.get("room"):
+        return str(data["room"])
+    if data.get("call_room"):
+        return str(data["call_room"])
+    if data.get("group_id"):
+        return f"group_{data['group_id']}"
+    return None
+
+
+socket_metrics = SocketMetrics()
+
+def instrument(socketio):
+    """Wrap every handler registered so far (idempotent)"""
+    socket_metrics.socketio = socketio
+    socketio.handlers = [(event, socket_metrics.wrap(event, handler), namespace)
+                         for event, handler, namespace in socketio.handlers]
+    sockets_log = logging.getLogger(f"{ROOT}.sockets")
+    if not any(isinstance(f, HandledErrors) for f in sockets_log.filters):
+        sockets_log.addFilter(HandledErrors())
+
+
+class HttpMetrics:
+    def __init__(self):
+        self._requests = {}  # (blueprint, route, method, status) -> count
+        self._latency = {}  # (blueprint, route) -> Histogram (ms)
+        self._sql_per_request = {}  # blueprint -> (Histogram of statements, Histogram of ms)
+        self._sql_totals = {}  # blueprint -> [statements, ms]
+        self._lock = threading.Lock()
+        self.token = None
+        self.public = False
+
+    def init_app(self, app):
+        self.token = app.config.get("METRICS_TOKEN")
+        self.public = app.config.get("METRICS_PUBLIC", False)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(db.engine, "after_cursor_execute", self.after_cursor_execute)
+            event.listen(db.engine, "handle_error", discard_query_start)
+        app.add_url_rule("/metrics", "metrics", self.serve)
+        app.extensions["http_metrics"] = self
+
+    def before_request(self):
+        g.request_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_ms = 0.0
+
+    def after_request(self, response):
+        started = g.pop("request_started", None)
+        if started is None:
+            return response
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        blueprint = request.blueprint or "app"
+        route = request.url_rule.rule if request.url_rule else "unmatched"  # Bounded label values
+        with self._lock:
+            key = (blueprint, route, request.method, response.status_code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            latency = self._latency.get((blueprint, route))
+            if latency is None:
+                latency = self._latency[(blueprint, route)] = Histogram()
+            latency.record(elapsed_ms)
+            sql = self._sql_per_request.get(blueprint)
+            if sql is None:
+                sql = self._sql_per_request[blueprint] = (Histogram(SQL_COUNT_BUCKETS), Histogram())
+            sql[0].record(g.sql_statements)
+            sql[1].record(g.sql_ms)
+        return response
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if has_request_context() and "sql_statements" in g:
+            g.sql_statements += 1
+            g.sql_ms += elapsed_ms
+            blueprint = request.blueprint or "app"
+        elif has_request_context():
+            blueprint = "socketio"  # Socket handlers run in a request context of their own
+        else:
+            blueprint = "background"
+        with self._lock:
+            totals = self._sql_totals.setdefault(blueprint, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed_ms
+
+    def health(self):
+        """Share of requests answered without a 5xx since start, e.g. ``"99.2%"``"""
+        with self._lock:
+            total = sum(self._requests.values())
+            failed = sum(n for (_, _, _, status), n in self._requests.items() if status >= 500)
+        if not total:
+            return "n/a"
+        return f"{100 * (total - failed) / total:.1f}%"
+
+    def authorized(self):
+        """A scrape carrying METRICS_TOKEN, or a request from an admin"""
+        if self.public:
+            return True
+        if self.token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {self.token}"):
+            return True
+        try:
+            verify_jwt_in_request()
+        except Exception:
+            return False  # Missing, malformed or expired token
+        user = db.session.get(User, int(get_jwt_identity()))
+        return bool(user and user.is_admin)
+
+    def serve(self):
+        if not self.authorized():
+            return Response("Unauthorized\n", status=401, mimetype="text/plain")
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def discard_query_start(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+
+http_metrics = HttpMetrics()
+
+
+# --- Prometheus text exposition ---
+
+def labels(**values):
+    parts = []
+    for key, value in values.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+def histogram_lines(name, histogram, scale=1.0, **label_values):
+    """Cumulative ``_bucket`` / ``_sum`` / ``_count`` lines; ``scale`` converts ms to seconds"""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(list(histogram.bounds) + ["+Inf"], histogram.counts):
+        cumulative += count
+        le = bound if bound == "+Inf" else repr(bound * scale)
+        lines.append(f"{name}_bucket{labels(**label_values, le=le)} {cumulative}")
+    suffix = labels(**label_values) if label_values else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum * scale}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
+
+def metric(lines, name, kind, help_text):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+def render_prometheus():
+    lines = []
+    ms = 0.001
+
+    with http_metrics._lock:
+        requests = dict(http_metrics._requests)
+        latency = {k: copy_histogram(h) for k, h in http_metrics._latency.items()}
+        sql_per_request = {k: (copy_histogram(a), copy_histogram(b)) for k, (a, b) in http_metrics._sql_per_request.items()}
+        sql_totals = {k: list(v) for k, v in http_metrics._sql_totals.items()}
+
+    metric(lines, "sapcca_http_requests_total", "counter", "HTTP requests by blueprint, route, method and status.")
+    for (blueprint, route, method, status), count in sorted(requests.items()):
+        lines.append(f"sapcca_http_requests_total{labels(blueprint=blueprint, route=route, method=method, status=status)} {count}")
+    metric(lines, "sapcca_http_request_duration_seconds", "histogram", "HTTP request latency by blueprint and route.")
+    for (blueprint, route), h in sorted(latency.items()):
+        lines += histogram_lines("sapcca_http_request_duration_seconds", h, ms, blueprint=blueprint, route=route)
+    metric(lines, "sapcca_http_request_sql_statements", "histogram", "SQL statements run per HTTP request.")
+    for blueprint, (counts, _) in sorted(sql_per_request.items()):
+        lines += histogram_lines("sapcca_http_request_sql_statements", counts, blueprint=blueprint)
+    metric(lines, "sapcca_http_request_sql_seconds", "histogram", "Time spent in SQL per HTTP request.")
+    for blueprint, (_, seconds) in sorted(sql_per_request.items()):
+        lines += histogram_lines("sapcca_http_request_sql_seconds", seconds, ms, blueprint=blueprint)
+    metric(lines, "sapcca_sql_statements_total", "counter", "SQL statements executed, by blueprint (background outside requests).")
+    for blueprint, (count, _) in sorted(sql_totals.items()):
+        lines.append(f"sapcca_sql_statements_total{labels(blueprint=blueprint)} {count}")
+    metric(lines, "sapcca_sql_seconds_total", "counter", "Time spent executing SQL, by blueprint.")
+    for blueprint, (_, total_ms) in sorted(sql_totals.items()):
+        lines.append(f"sapcca_sql_seconds_total{labels(blueprint=blueprint)} {total_ms * ms}")
+
+    with socket_metrics._lock:
+        events = {name: (s.calls, s.errors, s.payload_bytes, copy_histogram(s.latency))
+                  for name, s in socket_metrics._events.items()}
+    metric(lines, "sapcca_socketio_events_total", "counter", "Socket.IO events handled.")
+    for name, (calls, _, _, _) in sorted(events.items()):
+        lines.append(f"sapcca_socketio_events_total{labels(event=name)} {calls}")
+    metric(lines, "sapcca_socketio_event_errors_total", "counter", "Socket.IO events that raised or logged an error.")
+    for name, (_, errors, _, _) in sorted(events.items()):
+        lines.append(f"sapcca_socketio_event_errors_total{labels(event=name)} {errors}")
+    metric(lines, "sapcca_socketio_payload_bytes_total", "counter", "Approximate Socket.IO event payload bytes received.")
+    for name, (_, _, size, _) in sorted(events.items()):
+        lines.append(f"sapcca_socketio_payload_bytes_total{labels(event=name)} {size}")
+    metric(lines, "sapcca_socketio_event_duration_seconds", "histogram", "Socket.IO handler latency.")
+    for name, (_, _, _, h) in sorted(events.items()):
+        lines += histogram_lines("sapcca_socketio_event_duration_seconds", h, ms, event=name)
+
+    pool = db.engine.pool
+    for name, attr, help_text in (
+        ("sapcca_db_pool_size", "size", "Configured connection pool size."),
+        ("sapcca_db_pool_checked_out", "checkedout", "Connections in use."),
+        ("sapcca_db_pool_checked_in", "checkedin", "Idle connections in the pool."),
+        ("sapcca_db_pool_overflow", "overflow", "Connections opened beyond the pool size."),
+    ):
+        if hasattr(pool, attr):  # QueuePool; SQLite memory/static pools lack these
+            metric(lines, name, "gauge", help_text)
+            lines.append(f"{name} {max(getattr(pool, attr)(), 0)}")  # overflow() is negative below the pool size
+
+    hub = hub_load()
+    if hub is not None:
+        timers, listeners = hub
+        metric(lines, "sapcca_eventlet_hub_timers", "gauge", "Scheduled eventlet timers (sleeping and timed-out green threads).")
+        lines.append(f"sapcca_eventlet_hub_timers {timers}")
+        metric(lines, "sapcca_eventlet_hub_listeners", "gauge", "File descriptors green threads are waiting on.")
+        lines.append(f"sapcca_eventlet_hub_listeners {listeners}")
+    rss = resident_memory_bytes()
+    if rss is not None:
+        metric(lines, "sapcca_process_resident_memory_bytes", "gauge", "Resident set size of this worker.")
+        lines.append(f"sapcca_process_resident_memory_bytes {rss}")
+    metric(lines, "sapcca_process_uptime_seconds", "gauge", "Seconds since metrics started in this worker.")
+    lines.append(f"sapcca_process_uptime_seconds {round(time.time() - socket_metrics.started)}")
+    return "\n".join(lines) + "\n"
+
+def copy_histogram(h):
+    clone = Histogram(h.bounds)
+    clone.counts, clone.count, clone.sum, clone.max = list(h.counts), h.count, h.sum, h.max
+    return clone
+
+def hub_load():
+    """``(timers, listeners)`` of the eventlet hub: every blocked green thread holds one or the other"""
+    try:
+        from eventlet import hubs
+    except ImportError:
+        return None
+    hub = hubs.get_hub()
+    timers = len(getattr(hub, "timers", ())) + len(getattr(hub, "next_timers", ()))
+    listeners = sum(len(fds) for fds in getattr(hub, "listeners", {}).values())
+    return timers, listeners
+
+def resident_memory_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Peak, in KiB on Linux
@@ -0,0 +1,55 @@
+"""Move legacy base64 blobs out of the database into the attachment store.
+
+Run once after update_db.py. Rows are processed in small batches so SQLite
+is never write-locked for long; re-running is safe (already migrated rows
+have no inline data left).
+"""
+from app import create_app
+from database import db
+from models import Message, GroupMessage, Assignment, AssignmentSubmission
+from attachments import store_data_url
+
+BATCH_SIZE = 100
+
+# (model, inline column, reference column, MIME type column)
+BLOB_COLUMNS = [
+    (Message, "file_data", "file_ref", "file_type"),
+    (Message, "voice_data", "voice_ref", None),
+    (GroupMessage, "file_data", "file_ref", "file_type"),
+    (GroupMessage, "voice_data", "voice_ref", None),
+    (Assignment, "file_data", "file_ref", "file_type"),
+    (AssignmentSubmission, "file_data", "file_ref", "file_type"),
+]
+
+def migrate_column(model, inline, ref, mime):
+    moved = failed = 0
+    last_id = 0
+    while True:
+        rows = model.query.filter(
+            (model.id > last_id) & (getattr(model, inline).isnot(None))
+        ).order_by(model.id.asc()).limit(BATCH_SIZE).all()
+        if not rows:
+            break
+
+        for row in rows:
+            last_id = row.id
+            try:
+                digest = store_data_url(getattr(row, inline), getattr(row, mime) if mime else None)
+            except ValueError as e:
+                print(f"  skipping {model.__tablename__} {row.id}: {e}")
+                failed += 1
+                continue
+            setattr(row, ref, digest)
+            setattr(row, inline, None)
+            moved += 1
+
+        db.session.commit()
+
+    print(f"{model.__tablename__}.{inline}: moved {moved}, skipped {failed}")
+
+if __name__ == "__main__":
+    app = create_app()
+    with app.app_context():
+        for columns in BLOB_COLUMNS:
+            migrate_column(*columns)
+        print("Attachment migration complete. Run VACUUM to reclaim SQLite file space.")
@@ -0,0 +1,51 @@
+"""Baseline: fold the ad-hoc update_db.py column additions into history
+
+Tables themselves are created by db.create_all() in create_app(), which runs
+before any migration. This revision adds the columns that update_db.py used
+to patch into older databases, skipping any that already exist.
+
+Revision ID: 3f1c2a9d7b10
+Revises: 
+Create Date: 2026-10-18 15:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+ATTACHMENT_COLUMNS = [
+    ("message", "file_ref"),
+    ("message", "voice_ref"),
+    ("group_message", "file_ref"),
+    ("group_message", "voice_ref"),
+    ("assignment", "file_ref"),
+    ("assignment_submission", "file_ref"),
+]
+
+
+def existing_columns(table):
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    if 'is_admin' not in existing_columns('user'):
+        op.add_column('user', sa.Column('is_admin', sa.Boolean(), server_default=sa.false()))
+
+    for table, column in ATTACHMENT_COLUMNS:
+        if column not in existing_columns(table):
+            op.add_column(table, sa.Column(column, sa.String(64), nullable=True))
+            # SQLite cannot ALTER in a constraint; the reference is enforced by the ORM there
+            if op.get_bind().dialect.name != 'sqlite':
+                op.create_foreign_key(f'fk_{table}_{column}', table, 'attachment', [column], ['sha256'])
+
+
+def downgrade():
+    # The baseline is the oldest supported schema; there is nothing to go back to
+    pass
@@ -0,0 +1,61 @@
+"""Composite and unique indexes for the hot query shapes
+
+Conversation history, membership checks, submission lookups and friend
+request checks all filtered on unindexed columns and scanned whole tables.
+Duplicate membership/submission rows are removed before the unique indexes
+are built. check_query_plans.py verifies the resulting plans.
+
+Revision ID: 8b4e61d0c2f5
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4e61d0c2f5'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns, unique)
+INDEXES = [
+    ('ix_message_sender_receiver_timestamp', 'message', ['sender_id', 'receiver_id', 'timestamp'], False),
+    ('ix_group_message_group_timestamp', 'group_message', ['group_id', 'timestamp'], False),
+    ('uq_group_member_group_user', 'group_member', ['group_id', 'user_id'], True),
+    ('ix_group_member_user', 'group_member', ['user_id'], False),
+    ('uq_class_member_class_user', 'class_member', ['class_id', 'user_id'], True),
+    ('ix_class_member_user', 'class_member', ['user_id'], False),
+    ('uq_assignment_submission_assignment_student', 'assignment_submission', ['assignment_id', 'student_id'], True),
+    ('ix_assignment_class_due', 'assignment', ['class_id', 'due_date'], False),
+    ('ix_friend_request_sender_receiver_status', 'friend_request', ['sender_id', 'receiver_id', 'status'], False),
+    ('ix_friend_request_receiver_status', 'friend_request', ['receiver_id', 'status'], False),
+]
+
+# Rows to keep when collapsing duplicates: first membership, latest submission
+DEDUPE = [
+    ('group_member', ['group_id', 'user_id'], 'MIN'),
+    ('class_member', ['class_id', 'user_id'], 'MIN'),
+    ('assignment_submission', ['assignment_id', 'student_id'], 'MAX'),
+]
+
+
+def upgrade():
+    for table, columns, keep in DEDUPE:
+        cols = ", ".join(columns)
+        op.execute(
+            f"DELETE FROM {table} WHERE id NOT IN "
+            f"(SELECT keep_id FROM (SELECT {keep}(id) AS keep_id FROM {table} GROUP BY {cols}) AS kept)"
+        )
+
+    for name, table, columns, unique in INDEXES:
+        # create_all() builds these on fresh databases before migrations run
+        op.create_index(name, table, columns, unique=unique, if_not_exists=True)
+
+
+def downgrade():
+    for name, table, columns, unique in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,47 @@
+"""Add cascade_job, the background cascading delete queue
+
+create_all() already creates the table on startup; this revision covers
+databases upgraded with ``flask db upgrade`` alone.
+
+Revision ID: a1c4e9b2d7f3
+Revises: d5c8a1f37e94
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c4e9b2d7f3'
+down_revision = 'd5c8a1f37e94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('cascade_job'):
+        return
+    op.create_table(
+        'cascade_job',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('target_type', sa.String(20), nullable=False),
+        sa.Column('target_id', sa.Integer(), nullable=False),
+        sa.Column('requested_by', sa.Integer(), sa.ForeignKey('user.id'), nullable=True),
+        sa.Column('status', sa.String(10), nullable=False, server_default='queued'),
+        sa.Column('current_table', sa.String(50), nullable=True),
+        sa.Column('total_rows', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('deleted_rows', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('blobs_reclaimed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('bytes_reclaimed', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_cascade_job_target', 'cascade_job', ['target_type', 'target_id'])
+    op.create_index('ix_cascade_job_status_updated', 'cascade_job', ['status', 'updated_at'])
+
+
+def downgrade():
+    op.drop_table('cascade_job')
@@ -0,0 +1,27 @@
+"""Add user.last_seen for socket presence
+
+Revision ID: a6d2f8b5e913
+Revises: f4a9c3e17b28
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d2f8b5e913'
+down_revision = 'f4a9c3e17b28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('user')}
+    if 'last_seen' not in columns:
+        op.add_column('user', sa.Column('last_seen', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('last_seen')
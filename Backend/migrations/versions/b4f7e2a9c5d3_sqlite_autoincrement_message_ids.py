@@ -0,0 +1,51 @@
+"""Rebuild the message tables with AUTOINCREMENT on SQLite
+
+Sync clients poll with ``since_id`` / ``since_deleted`` cursors, so ids must
+never be reused. The models ask for ``sqlite_autoincrement``, but
+create_all() only applies it to tables it creates: on older databases these
+are plain rowid tables, where deleting the newest row hands its id to the
+next insert. Each table still missing AUTOINCREMENT is copied into a new one
+(which seeds ``sqlite_sequence`` from the copied ids), dropped and renamed.
+Postgres sequences never reuse ids, so this is a no-op there.
+
+Revision ID: b4f7e2a9c5d3
+Revises: e7b2c5d9a416
+Create Date: 2026-10-20 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4f7e2a9c5d3'
+down_revision = 'e7b2c5d9a416'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['message', 'group_message', 'message_tombstone']
+
+
+def has_autoincrement(connection, table):
+    sql = connection.execute(
+        sa.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table}
+    ).scalar()
+    return sql is not None and 'AUTOINCREMENT' in sql.upper()
+
+
+def upgrade():
+    connection = op.get_bind()
+    if connection.dialect.name != 'sqlite':
+        return
+    for table in TABLES:
+        # create_all() builds these with AUTOINCREMENT on fresh databases
+        if has_autoincrement(connection, table):
+            continue
+        with op.batch_alter_table(table, recreate='always', table_kwargs={'sqlite_autoincrement': True}):
+            pass
+
+
+def downgrade():
+    # Plain rowid tables would reuse ids again; nothing worth undoing
+    pass
@@ -0,0 +1,38 @@
+"""Add materialized class.member_count and class.group_count
+
+Adds the counter columns (if create_all() has not already) and fills them
+from the current rows, so the revision can be re-run.
+
+Revision ID: b93e0d7a4c21
+Revises: a6d2f8b5e913
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b93e0d7a4c21'
+down_revision = 'a6d2f8b5e913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('class')}
+    for name in ('member_count', 'group_count'):
+        if name not in columns:
+            op.add_column('class', sa.Column(name, sa.Integer(), nullable=False, server_default='0'))
+
+    op.execute("""
+        UPDATE class SET
+            member_count = (SELECT COUNT(*) FROM class_member WHERE class_member.class_id = class.id),
+            group_count = (SELECT COUNT(*) FROM "group" WHERE "group".class_id = class.id)
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('class') as batch_op:
+        batch_op.drop_column('group_count')
+        batch_op.drop_column('member_count')
@@ -0,0 +1,40 @@
+"""Index the attachment reference columns
+
+Downloads check that some row still references a blob, and cascade deletes
+check which blobs became unreferenced; both probe every ``file_ref`` /
+``voice_ref`` column by digest.
+
+Revision ID: c3e8f1a94b62
+Revises: a1c4e9b2d7f3
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8f1a94b62'
+down_revision = 'a1c4e9b2d7f3'
+branch_labels = None
+depends_on = None
+
+
+REFERENCES = [
+    ('message', 'file_ref'),
+    ('message', 'voice_ref'),
+    ('group_message', 'file_ref'),
+    ('group_message', 'voice_ref'),
+    ('assignment', 'file_ref'),
+    ('assignment_submission', 'file_ref'),
+]
+
+
+def upgrade():
+    for table, column in REFERENCES:
+        # create_all() builds these on fresh databases before migrations run
+        op.create_index(f'ix_{table}_{column}', table, [column], if_not_exists=True)
+
+
+def downgrade():
+    for table, column in reversed(REFERENCES):
+        op.drop_index(f'ix_{table}_{column}', table_name=table, if_exists=True)
@@ -0,0 +1,77 @@
+"""Backfill the conversation inbox from existing message history
+
+The conversation table is created by create_all(); this fills one row per
+(user, DM peer) and (member, group) from the latest existing message.
+There was no read tracking before, so existing history starts out read.
+Rows that already exist are left alone, so the revision can be re-run.
+
+Revision ID: c71d5e2a9f43
+Revises: 8b4e61d0c2f5
+Create Date: 2026-10-18 15:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71d5e2a9f43'
+down_revision = '8b4e61d0c2f5'
+branch_labels = None
+depends_on = None
+
+
+# Mirrors inbox.message_preview()
+PREVIEW = """substr(CASE
+    WHEN {text} IS NOT NULL AND {text} != '' THEN {text}
+    WHEN voice_ref IS NOT NULL THEN '[Voice message]'
+    WHEN file_name IS NOT NULL THEN '[File: ' || file_name || ']'
+    ELSE '' END, 1, 100)"""
+
+COLUMNS = ("user_id, chat_type, chat_id, last_message_id, last_sender_id, preview, "
+           "last_timestamp, unread_count, last_read_message_id")
+
+
+def upgrade():
+    op.create_index('ix_conversation_chat', 'conversation', ['chat_type', 'chat_id'], if_not_exists=True)
+
+    # DMs: each message belongs to the sender's and the receiver's conversation
+    op.execute(f"""
+        INSERT INTO conversation ({COLUMNS})
+        SELECT owner_id, 'dm', peer_id, id, sender_id, {PREVIEW.format(text='content')}, timestamp, 0, id
+        FROM (
+            SELECT m.*, sides.owner_id, sides.peer_id,
+                   ROW_NUMBER() OVER (PARTITION BY sides.owner_id, sides.peer_id
+                                      ORDER BY m.timestamp DESC, m.id DESC) AS rn
+            FROM message m
+            JOIN (SELECT id AS message_id, sender_id AS owner_id, receiver_id AS peer_id FROM message
+                  UNION ALL
+                  SELECT id, receiver_id, sender_id FROM message WHERE receiver_id != sender_id) sides
+              ON sides.message_id = m.id
+        ) latest
+        WHERE rn = 1 AND NOT EXISTS (
+            SELECT 1 FROM conversation c
+            WHERE c.user_id = latest.owner_id AND c.chat_type = 'dm' AND c.chat_id = latest.peer_id
+        )
+    """)
+
+    # Groups: every current member gets the group's latest message
+    op.execute(f"""
+        INSERT INTO conversation ({COLUMNS})
+        SELECT gm.user_id, 'group', latest.group_id, latest.id, latest.sender_id,
+               latest.preview, latest.timestamp, 0, latest.id
+        FROM (
+            SELECT id, group_id, sender_id, timestamp, {PREVIEW.format(text='text')} AS preview,
+                   ROW_NUMBER() OVER (PARTITION BY group_id ORDER BY timestamp DESC, id DESC) AS rn
+            FROM group_message
+        ) latest
+        JOIN group_member gm ON gm.group_id = latest.group_id
+        WHERE latest.rn = 1 AND NOT EXISTS (
+            SELECT 1 FROM conversation c
+            WHERE c.user_id = gm.user_id AND c.chat_type = 'group' AND c.chat_id = latest.group_id
+        )
+    """)
+
+
+def downgrade():
+    op.execute("DELETE FROM conversation")
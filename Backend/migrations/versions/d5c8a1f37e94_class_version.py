@@ -0,0 +1,27 @@
+"""Add class.version, the class detail ETag stamp
+
+Revision ID: d5c8a1f37e94
+Revises: b93e0d7a4c21
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5c8a1f37e94'
+down_revision = 'b93e0d7a4c21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('class')}
+    if 'version' not in columns:
+        op.add_column('class', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('class') as batch_op:
+        batch_op.drop_column('version')
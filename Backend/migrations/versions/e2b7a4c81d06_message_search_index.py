@@ -0,0 +1,31 @@
+"""Full-text message search index (FTS5 on SQLite, tsvector on Postgres)
+
+create_app() creates the empty index on startup; this revision fills it
+from existing message history. Later sends and deletes keep it current.
+
+Revision ID: e2b7a4c81d06
+Revises: c71d5e2a9f43
+Create Date: 2026-10-18 16:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from search import create_search_index, rebuild_search_index
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7a4c81d06'
+down_revision = 'c71d5e2a9f43'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    create_search_index(connection)
+    rebuild_search_index(connection)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS message_search")
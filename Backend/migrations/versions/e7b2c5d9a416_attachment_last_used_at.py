@@ -0,0 +1,30 @@
+"""Add attachment.last_used_at
+
+Cascade deletes only reclaim blobs nothing has stored again within
+CASCADE_BLOB_GRACE_SECONDS; existing rows fall back to created_at.
+
+Revision ID: e7b2c5d9a416
+Revises: c3e8f1a94b62
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b2c5d9a416'
+down_revision = 'c3e8f1a94b62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('attachment')}
+    if 'last_used_at' not in columns:
+        op.add_column('attachment', sa.Column('last_used_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('attachment') as batch_op:
+        batch_op.drop_column('last_used_at')
@@ -0,0 +1,46 @@
+"""Widen message id columns to BIGINT for snowflake ids
+
+Write-behind mode (write_behind.py) assigns 53-bit ids up front, which
+overflow a 32-bit INTEGER on Postgres. SQLite integers are already 64-bit,
+so this is a no-op there.
+
+Revision ID: f4a9c3e17b28
+Revises: e2b7a4c81d06
+Create Date: 2026-10-18 17:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a9c3e17b28'
+down_revision = 'e2b7a4c81d06'
+branch_labels = None
+depends_on = None
+
+
+# (table, column)
+COLUMNS = [
+    ('message', 'id'),
+    ('message', 'reply_to_id'),
+    ('group_message', 'id'),
+    ('group_message', 'reply_to_id'),
+    ('message_tombstone', 'message_id'),
+    ('conversation', 'last_message_id'),
+    ('conversation', 'last_read_message_id'),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    for table, column in COLUMNS:
+        op.alter_column(table, column, type_=sa.BigInteger(), existing_type=sa.Integer())
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    for table, column in COLUMNS:
+        op.alter_column(table, column, type_=sa.Integer(), existing_type=sa.BigInteger())
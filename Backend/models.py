@@ -1,6 +1,32 @@
 from database import db
 from datetime import datetime
 
+# Message ids may be 53-bit snowflakes (see write_behind.py); SQLite's
+# INTEGER PRIMARY KEY is already 64-bit and must stay INTEGER to alias rowid
+MessageId = db.BigInteger().with_variant(db.Integer(), "sqlite")
+
+class AttachmentFields:
+    """Attachment metadata that never touches the deferred base64 blob columns.
+
+    Models mixing this in defer ``file_data`` (and ``voice_data``) and load
+    SQL ``length()`` projections of them instead, so list and history queries
+    only pull the blob when a handler reads the column explicitly.
+    """
+    @property
+    def has_file(self):
+        return bool(self.file_ref or self.file_data_length)
+
+    @property
+    def file_size(self):
+        if self.file_attachment:
+            return self.file_attachment.size
+        # Legacy inline base64: decoded size is ~3/4 of the text length
+        return self.file_data_length * 3 // 4 if self.file_data_length else None
+
+    @property
+    def has_voice(self):
+        return bool(self.voice_ref or self.voice_data_length)
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True)
@@ -16,6 +42,7 @@ class User(db.Model):
     role = db.Column(db.String(20), default="student")
     department = db.Column(db.String(100), nullable=True)
     faculty_designation = db.Column(db.String(100), nullable=True)
+    last_seen = db.Column(db.DateTime, nullable=True)  # Last socket disconnect (see presence.py)
 
 class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -35,6 +62,11 @@ class Class(db.Model):
     icon_url = db.Column(db.String(500), nullable=True)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Maintained on every ClassMember / Group insert and delete (see counters.py)
+    member_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    group_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Bumped by every change to the class, its groups or memberships; class detail ETag
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
 class ClassMember(db.Model):
     """Represents membership in a class"""
@@ -43,6 +75,10 @@ class ClassMember(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     is_moderator = db.Column(db.Boolean, default=False)  # Can create groups, manage members
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('uq_class_member_class_user', 'class_id', 'user_id', unique=True),
+        db.Index('ix_class_member_user', 'user_id'),
+    )
 
 
 class GroupMember(db.Model):
@@ -51,21 +87,36 @@ class GroupMember(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_admin = db.Column(db.Boolean, default=False)
+    __table_args__ = (
+        db.Index('uq_group_member_group_user', 'group_id', 'user_id', unique=True),
+        db.Index('ix_group_member_user', 'user_id'),
+    )
 
-class GroupMessage(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+class GroupMessage(AttachmentFields, db.Model):
+    id = db.Column(MessageId, primary_key=True)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'))
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     text = db.Column(db.Text)
-    file_data = db.Column(db.Text, nullable=True)
+    file_data = db.deferred(db.Column(db.Text, nullable=True))
+    file_data_length = db.column_property(db.func.length(file_data))
     file_name = db.Column(db.String(255), nullable=True)
     file_type = db.Column(db.String(50), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     # Voice message fields
-    voice_data = db.Column(db.Text, nullable=True)  # Base64 encoded audio
+    voice_data = db.deferred(db.Column(db.Text, nullable=True))  # Base64 encoded audio
+    voice_data_length = db.column_property(db.func.length(voice_data))
     voice_duration = db.Column(db.Integer, nullable=True)  # Duration in seconds
+    # Attachment store references (replace the legacy base64 columns above)
+    file_ref = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), nullable=True, index=True)
+    voice_ref = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), nullable=True, index=True)
+    file_attachment = db.relationship('Attachment', foreign_keys=[file_ref], lazy='joined')
     # Reply/threading field
-    reply_to_id = db.Column(db.Integer, db.ForeignKey('group_message.id'), nullable=True)
+    reply_to_id = db.Column(MessageId, db.ForeignKey('group_message.id'), nullable=True)
+    __table_args__ = (
+        db.Index('ix_group_message_group_timestamp', 'group_id', 'timestamp'),
+        # Never reuse ids of deleted rows (sync clients poll with since_id)
+        {'sqlite_autoincrement': True},
+    )
 
 class SystemLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -79,25 +130,79 @@ class FriendRequest(db.Model):
     receiver_id = db.Column(db.Integer)
     status = db.Column(db.String(20), default="pending")
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_friend_request_sender_receiver_status', 'sender_id', 'receiver_id', 'status'),
+        db.Index('ix_friend_request_receiver_status', 'receiver_id', 'status'),  # Incoming requests
+    )
 
-class Message(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+class Message(AttachmentFields, db.Model):
+    id = db.Column(MessageId, primary_key=True)
     sender_id = db.Column(db.Integer)
     receiver_id = db.Column(db.Integer)
     content = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     # File attachment fields
-    file_data = db.Column(db.Text, nullable=True)  # Base64 encoded file
+    file_data = db.deferred(db.Column(db.Text, nullable=True))  # Base64 encoded file
+    file_data_length = db.column_property(db.func.length(file_data))
     file_name = db.Column(db.String(255), nullable=True)  # Original filename
     file_type = db.Column(db.String(50), nullable=True)  # MIME type
     file_category = db.Column(db.String(20), nullable=True)  # document/photo/video/audio
     # Voice message fields
-    voice_data = db.Column(db.Text, nullable=True)  # Base64 encoded audio
+    voice_data = db.deferred(db.Column(db.Text, nullable=True))  # Base64 encoded audio
+    voice_data_length = db.column_property(db.func.length(voice_data))
     voice_duration = db.Column(db.Integer, nullable=True)  # Duration in seconds
+    # Attachment store references (replace the legacy base64 columns above)
+    file_ref = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), nullable=True, index=True)
+    voice_ref = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), nullable=True, index=True)
+    file_attachment = db.relationship('Attachment', foreign_keys=[file_ref], lazy='joined')
     # Reply/threading field
-    reply_to_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    reply_to_id = db.Column(MessageId, db.ForeignKey('message.id'), nullable=True)
+    __table_args__ = (
+        # Serves both directions of a conversation, newest first
+        db.Index('ix_message_sender_receiver_timestamp', 'sender_id', 'receiver_id', 'timestamp'),
+        # Never reuse ids of deleted rows (sync clients poll with since_id)
+        {'sqlite_autoincrement': True},
+    )
+
+class MessageTombstone(db.Model):
+    """Records a deleted DM or group message so polling clients can drop it"""
+    id = db.Column(db.Integer, primary_key=True)
+    chat_type = db.Column(db.String(10), nullable=False)  # 'dm' or 'group'
+    message_id = db.Column(MessageId, nullable=False)
+    sender_id = db.Column(db.Integer)
+    receiver_id = db.Column(db.Integer, nullable=True)  # DMs only
+    group_id = db.Column(db.Integer, nullable=True)  # Groups only
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class Conversation(db.Model):
+    """Inbox summary of one chat for one user, updated with every send"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    chat_type = db.Column(db.String(10), nullable=False)  # 'dm' or 'group'
+    chat_id = db.Column(db.Integer, nullable=False)  # Peer user id (DM) or group id
+    last_message_id = db.Column(MessageId)
+    last_sender_id = db.Column(db.Integer)
+    preview = db.Column(db.String(100))
+    last_timestamp = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    last_read_message_id = db.Column(MessageId, default=0, nullable=False)
+    __table_args__ = (
+        db.Index('uq_conversation_user_chat', 'user_id', 'chat_type', 'chat_id', unique=True),
+        db.Index('ix_conversation_user_timestamp', 'user_id', 'last_timestamp'),
+        db.Index('ix_conversation_chat', 'chat_type', 'chat_id'),  # Fan-out updates per group
+    )
+
+class Attachment(db.Model):
+    """A blob in the content-addressed attachment store (bytes live on disk)"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    mime_type = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Touched by every store of these bytes; cascade deletes spare recently used blobs
+    last_used_at = db.Column(db.DateTime, nullable=True)
 
-class Assignment(db.Model):
+class Assignment(AttachmentFields, db.Model):
     """Represents an assignment created by faculty for a class"""
     id = db.Column(db.Integer, primary_key=True)
     class_id = db.Column(db.Integer, db.ForeignKey('class.id'), nullable=False)
@@ -107,24 +212,80 @@ class Assignment(db.Model):
     total_points = db.Column(db.Integer, default=100)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    file_data = db.Column(db.Text, nullable=True)  # Optional assignment file
+    file_data = db.deferred(db.Column(db.Text, nullable=True))  # Optional assignment file
+    file_data_length = db.column_property(db.func.length(file_data))
     file_name = db.Column(db.String(200), nullable=True)
     file_type = db.Column(db.String(100), nullable=True)
+    file_ref = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), nullable=True, index=True)
+    file_attachment = db.relationship('Attachment', foreign_keys=[file_ref], lazy='joined')
+    __table_args__ = (
+        db.Index('ix_assignment_class_due', 'class_id', 'due_date'),
+    )
 
-class AssignmentSubmission(db.Model):
+class AssignmentSubmission(AttachmentFields, db.Model):
     """Represents a student's submission for an assignment"""
     id = db.Column(db.Integer, primary_key=True)
     assignment_id = db.Column(db.Integer, db.ForeignKey('assignment.id'), nullable=False)
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
-    file_data = db.Column(db.Text)  # Base64 encoded submission file
+    file_data = db.deferred(db.Column(db.Text))  # Base64 encoded submission file
+    file_data_length = db.column_property(db.func.length(file_data))
     file_name = db.Column(db.String(200))
     file_type = db.Column(db.String(100))
+    file_ref = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), nullable=True, index=True)
+    file_attachment = db.relationship('Attachment', foreign_keys=[file_ref], lazy='joined')
     text_response = db.Column(db.Text)  # Text submission
     grade = db.Column(db.Integer)  # Out of total_points
     feedback = db.Column(db.Text)  # Teacher feedback
     graded_at = db.Column(db.DateTime)
     graded_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    __table_args__ = (
+        db.Index('uq_assignment_submission_assignment_student', 'assignment_id', 'student_id', unique=True),
+    )
+
+class UploadSession(db.Model):
+    """A resumable chunked upload in progress (bytes are staged on disk)"""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    assignment_id = db.Column(db.Integer, db.ForeignKey('assignment.id'), nullable=False)
+    file_name = db.Column(db.String(200))
+    file_type = db.Column(db.String(100))
+    size = db.Column(db.Integer, nullable=False)  # Declared total size in bytes
+    received = db.Column(db.Integer, default=0)  # Bytes written so far
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class CascadeJob(db.Model):
+    """A background cascading delete of a class or assignment and its progress (see cascade.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    target_type = db.Column(db.String(20), nullable=False)  # 'class' or 'assignment'
+    target_id = db.Column(db.Integer, nullable=False)
+    requested_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    status = db.Column(db.String(10), default="queued", nullable=False)  # queued, running, done, failed
+    current_table = db.Column(db.String(50), nullable=True)
+    total_rows = db.Column(db.Integer, default=0, nullable=False)  # Planned when the job starts
+    deleted_rows = db.Column(db.Integer, default=0, nullable=False)
+    blobs_reclaimed = db.Column(db.Integer, default=0, nullable=False)
+    bytes_reclaimed = db.Column(db.BigInteger, default=0, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Heartbeat: bumped by every batch
+    finished_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        db.Index('ix_cascade_job_target', 'target_type', 'target_id'),
+        db.Index('ix_cascade_job_status_updated', 'status', 'updated_at'),
+    )
+
+class PendingRegistration(db.Model):
+    """A sign-up awaiting OTP verification (shared by every worker process)"""
+    email = db.Column(db.String(120), primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    registration_number = db.Column(db.String(50), nullable=True)
+    password_hash = db.Column(db.String(200), nullable=False)
+    role = db.Column(db.String(20), default="student")
+    department = db.Column(db.String(100), nullable=True)
+    faculty_designation = db.Column(db.String(100), nullable=True)
+    otp_code = db.Column(db.String(10), nullable=False)
+    otp_expiry = db.Column(db.DateTime, nullable=False, index=True)
 
 class CallLog(db.Model):
     """Represents a call record between two users"""
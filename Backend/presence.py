@@ -0,0 +1,216 @@
+"""Socket connection registry and online presence.
+
+A socket authenticates once, at connect, with its JWT. From then on handlers
+resolve identity from the registry (``user_of(sid)``) instead of trusting
+ids in event payloads, and the server knows who is online.
+
+* A user is online while any of their sockets has sent a heartbeat (or any
+  event) within ``PRESENCE_TIMEOUT`` seconds, or is still answering
+  Engine.IO's ping/pong (Engine.IO closes sockets that stop answering). A
+  socket that is both silent and gone from Engine.IO is forgotten; live
+  sockets are never disconnected for being quiet.
+* Online/offline transitions of local sockets are coalesced and sent every
+  ``PRESENCE_FLUSH_MS`` as one ``presence`` event per interested friend,
+  so a flapping connection produces at most one change per interval.
+* ``User.last_seen`` is written in bulk when users go offline.
+
+With a Socket.IO message queue (pubsub.py) each worker also publishes a
+snapshot of its online users every ``PRESENCE_TIMEOUT / 2`` seconds; peers
+forget a worker's users when its snapshots stop arriving.
+"""
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import or_, update
+
+from database import db
+from logs import get_logger
+from models import FriendRequest, User
+
+log = get_logger("presence")
+
+
+class PresenceRegistry:
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._sids = {}  # sid -> user id
+        self._user_sids = {}  # user id -> set of sids on this worker
+        self._heartbeats = {}  # sid -> monotonic time of last activity
+        self._profiles = {}  # user id -> (display name, avatar url) of connected users
+        self._last_seen = {}  # user id -> datetime they went offline
+        self._peers = {}  # worker host id -> (user ids online there, expiry)
+        self._announced = {}  # user id -> online state last sent to friends
+        self._changed = set()  # users whose state may differ from _announced
+        self._lock = threading.Lock()
+        self.publish = None  # Sends a snapshot of local users to other workers (see pubsub.py)
+
+    def init_app(self, app, socketio):
+        self.timeout = app.config.get("PRESENCE_TIMEOUT", self.timeout)
+        self.interval = app.config.get("PRESENCE_FLUSH_MS", 1000) / 1000
+        self._app = app
+        self._socketio = socketio
+        app.extensions["presence"] = self
+        socketio.start_background_task(self.run)
+
+    # --- Connections ---
+
+    def connect(self, sid, user_id, name, avatar_url):
+        with self._lock:
+            self._sids[sid] = user_id
+            self._profiles[user_id] = (name, avatar_url or "")
+            self._user_sids.setdefault(user_id, set()).add(sid)
+            self._heartbeats[sid] = time.monotonic()
+            self._changed.add(user_id)
+
+    def disconnect(self, sid):
+        with self._lock:
+            self._drop(sid)
+
+    def user_of(self, sid):
+        """User id of an authenticated socket (counts as a heartbeat)"""
+        user_id = self._sids.get(sid)
+        if user_id is not None:
+            self._heartbeats[sid] = time.monotonic()
+        return user_id
+
+    def profile_of(self, user_id):
+        """``(display name, avatar url)``, cached at connect for connected users"""
+        profile = self._profiles.get(user_id)
+        if profile is None:
+            user = User.query.get(user_id)
+            profile = (user.display_name, user.avatar_url or "") if user else ("Unknown", "")
+        return profile
+
+    def update_profile(self, user_id, name, avatar_url):
+        if user_id in self._profiles:
+            self._profiles[user_id] = (name, avatar_url or "")
+
+    def sids_of(self, user_id):
+        with self._lock:
+            return set(self._user_sids.get(user_id, ()))
+
+    # --- Presence ---
+
+    def is_online(self, user_id):
+        return user_id in self._user_sids or any(user_id in users for users, _ in self._peers.values())
+
+    def lookup(self, user_ids):
+        """``{user_id: {"online", "last_seen"}}``; last_seen falls back to the database"""
+        with self._lock:
+            result = {uid: {"online": self.is_online(uid), "last_seen": self._last_seen.get(uid)} for uid in user_ids}
+        missing = [uid for uid, p in result.items() if not p["online"] and p["last_seen"] is None]
+        if missing:
+            for uid, last_seen in db.session.query(User.id, User.last_seen).filter(User.id.in_(missing)):
+                result[uid]["last_seen"] = last_seen
+        for p in result.values():
+            p["last_seen"] = p["last_seen"].isoformat() if p["last_seen"] else None
+        return result
+
+    def apply_peer(self, host_id, user_ids):
+        """Snapshot of the users online on another worker (that worker announces their changes)"""
+        with self._lock:
+            self._peers[host_id] = (set(user_ids), time.monotonic() + self.timeout)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._user_sids)
+
+    # --- Background work ---
+
+    def run(self):
+        next_snapshot = 0
+        while True:
+            self._socketio.sleep(self.interval)
+            try:
+                with self._app.app_context():
+                    self.expire()
+                    self.flush()
+                if self.publish is not None and time.monotonic() >= next_snapshot:
+                    self.publish(self.snapshot())
+                    next_snapshot = time.monotonic() + self.timeout / 2
+            except Exception:
+                log.exception("Presence update failed")
+
+    def transport_open(self, sid):
+        """Whether Engine.IO still holds the socket (its ping/pong is our liveness signal)"""
+        server = self._socketio.server
+        eio_sid = server.manager.eio_sid_from_sid(sid, "/")
+        socket = server.eio.sockets.get(eio_sid) if eio_sid else None
+        return socket is not None and not socket.closed
+
+    def expire(self):
+        """Forget sockets (and peer workers) that went quiet; returns the expired sids"""
+        now = time.monotonic()
+        with self._lock:
+            quiet = [sid for sid, seen in self._heartbeats.items() if now - seen > self.timeout]
+            stale = []
+            for sid in quiet:
+                if self.transport_open(sid):
+                    self._heartbeats[sid] = now  # Answering pings: a page without heartbeats
+                else:
+                    stale.append(sid)  # Missed its disconnect event
+                    self._drop(sid)
+            for host_id, (users, expiry) in list(self._peers.items()):
+                if now > expiry:
+                    # The worker died without announcing its users went offline
+                    del self._peers[host_id]
+                    for uid in users:
+                        self._announced[uid] = True
+                        self._last_seen.setdefault(uid, datetime.utcnow())
+                    self._changed |= users
+        return stale
+
+    def flush(self):
+        """Send coalesced changes to online friends and record last_seen"""
+        with self._lock:
+            changes = {}
+            for uid in self._changed:
+                online = self.is_online(uid)
+                if self._announced.get(uid, False) != online:
+                    changes[uid] = online
+                    self._announced[uid] = online
+                if not online:
+                    self._announced.pop(uid, None)
+            self._changed = set()
+            last_seen = {uid: self._last_seen.get(uid) for uid, online in changes.items() if not online}
+        if not changes:
+            return
+
+        went_offline = [{"id": uid, "last_seen": seen} for uid, seen in last_seen.items() if seen]
+        if went_offline:
+            db.session.execute(update(User), went_offline)  # Bulk UPDATE by primary key
+            db.session.commit()
+
+        events = {}
+        for sender_id, receiver_id in db.session.query(FriendRequest.sender_id, FriendRequest.receiver_id).filter(
+            FriendRequest.status == "accepted",
+            or_(FriendRequest.sender_id.in_(changes), FriendRequest.receiver_id.in_(changes))
+        ):
+            for uid, friend_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+                if uid in changes:
+                    events.setdefault(friend_id, []).append({
+                        "user_id": uid,
+                        "online": changes[uid],
+                        "last_seen": last_seen[uid].isoformat() if last_seen.get(uid) else None,
+                    })
+        for friend_id, friend_changes in events.items():
+            self._socketio.emit("presence", {"changes": friend_changes}, room=str(friend_id))
+
+    # --- Internal (lock held) ---
+
+    def _drop(self, sid):
+        user_id = self._sids.pop(sid, None)
+        self._heartbeats.pop(sid, None)
+        if user_id is None:
+            return
+        sids = self._user_sids.get(user_id)
+        sids.discard(sid)
+        if not sids:
+            del self._user_sids[user_id]
+            self._profiles.pop(user_id, None)
+            self._last_seen[user_id] = datetime.utcnow()
+            self._changed.add(user_id)
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,148 @@
+"""Cross-process Socket.IO message queue for multi-worker deployments.
+
+``SOCKETIO_MESSAGE_QUEUE`` selects the backend that relays emits, room
+joins and ack callbacks between worker processes:
+
+* ``redis://`` / ``rediss://``, ``kafka://``, ``zmq+tcp://`` or any Kombu
+  URL (``amqp://`` ...) use python-socketio's managers (the client library
+  for that broker must be installed).
+* ``sqlite:///path/to/broker.db`` uses SQLiteManager below, a polling
+  broker in a local SQLite file. It needs no extra service, so tests and
+  single-host deployments can run several workers, but every hop costs up
+  to ``SOCKETIO_QUEUE_POLL_MS``.
+
+Unset keeps the single-process default. Whatever the backend, the same
+channel also carries worker-to-worker state: recent message cache
+invalidations (room_cache.py), so a send handled by one worker does not
+leave stale pages in the others, presence snapshots (presence.py) and
+group/class membership changes for sockets connected elsewhere
+(subscriptions.py).
+"""
+import pickle
+import sqlite3
+import time
+from contextlib import closing
+
+import socketio
+
+from presence import presence
+from room_cache import recent_messages
+from subscriptions import room_subscriptions
+
+# Internal events relayed between workers only (no client ever joins the room)
+CACHE_EVENT = "room_cache_invalidate"
+PRESENCE_EVENT = "presence_snapshot"
+SUBSCRIPTION_EVENT = "room_subscription_change"
+WORKER_ROOM = "__workers__"
+
+
+class WorkerSync:
+    """Mixin for a PubSubManager that applies state published by peer workers"""
+
+    def _handle_emit(self, message):
+        event = message.get("event")
+        if event not in (CACHE_EVENT, PRESENCE_EVENT, SUBSCRIPTION_EVENT):
+            return super()._handle_emit(message)
+        if message.get("host_id") == self.host_id:
+            return
+        data = message["data"][0]
+        if event == CACHE_EVENT:
+            recent_messages.invalidate(tuple(data), broadcast=False)
+        elif event == SUBSCRIPTION_EVENT:
+            room_subscriptions.apply([tuple(change) for change in data], broadcast=False)
+        else:
+            presence.apply_peer(message["host_id"], data)
+
+    def publish_invalidation(self, room):
+        self.emit(CACHE_EVENT, list(room), namespace="/", room=WORKER_ROOM)
+
+    def publish_presence(self, user_ids):
+        self.emit(PRESENCE_EVENT, user_ids, namespace="/", room=WORKER_ROOM)
+
+    def publish_subscriptions(self, changes):
+        self.emit(SUBSCRIPTION_EVENT, changes, namespace="/", room=WORKER_ROOM)
+
+
+class SQLiteManager(socketio.PubSubManager):
+    """Pub/sub over an append-only table in a shared SQLite file.
+
+    Publishers insert rows; every process polls for rows newer than the last
+    one it saw. Rows older than ``retention`` seconds are pruned.
+    """
+    name = "sqlite"
+
+    def __init__(self, url="sqlite:///socketio_queue.db", channel="socketio", write_only=False,
+                 logger=None, json=None, poll_interval=0.05, retention=60):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = url[len("sqlite:///"):]
+        self.poll_interval = poll_interval
+        self.retention = retention
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS socketio_queue ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, "
+                "payload BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # Autocommit: every statement is its own short transaction
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def _publish(self, data):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO socketio_queue (channel, payload, created_at) VALUES (?, ?, ?)",
+                (self.channel, pickle.dumps(data), time.time())
+            )
+
+    def _sleep(self):
+        if self.server is not None:
+            self.server.sleep(self.poll_interval)  # Yields to other greenlets
+        else:
+            time.sleep(self.poll_interval)
+
+    def _listen(self):
+        with closing(self._connect()) as conn:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM socketio_queue").fetchone()[0]
+            next_prune = time.time() + self.retention
+            while True:
+                rows = conn.execute(
+                    "SELECT id, payload FROM socketio_queue WHERE id > ? AND channel = ? ORDER BY id",
+                    (last_id, self.channel)
+                ).fetchall()
+                if time.time() >= next_prune:
+                    conn.execute("DELETE FROM socketio_queue WHERE created_at < ?", (time.time() - self.retention,))
+                    next_prune = time.time() + self.retention
+                for row_id, payload in rows:
+                    last_id = row_id
+                    yield pickle.loads(payload)
+                if not rows:
+                    self._sleep()
+
+
+def manager_class(url):
+    if url.startswith("sqlite:///"):
+        return SQLiteManager
+    if url.startswith(("redis://", "rediss://")):
+        return socketio.RedisManager
+    if url.startswith("kafka://"):
+        return socketio.KafkaManager
+    if url.startswith("zmq"):
+        return socketio.ZmqManager
+    return socketio.KombuManager
+
+def create_client_manager(app):
+    """Client manager for SOCKETIO_MESSAGE_QUEUE, or None for a single process"""
+    url = app.config.get("SOCKETIO_MESSAGE_QUEUE")
+    if not url:
+        return None
+    base = manager_class(url)
+    options = {"channel": app.config.get("SOCKETIO_CHANNEL", "sapcca")}
+    if base is SQLiteManager:
+        options["poll_interval"] = app.config.get("SOCKETIO_QUEUE_POLL_MS", 50) / 1000
+    manager = type(f"Synced{base.__name__}", (WorkerSync, base), {})(url, **options)
+    recent_messages.publish = manager.publish_invalidation
+    presence.publish = manager.publish_presence
+    room_subscriptions.publish = manager.publish_subscriptions
+    return manager
@@ -0,0 +1,157 @@
+"""Per-request SQL auditing for development and tests: N+1 detection and query budgets.
+
+With ``QUERY_AUDIT`` enabled every HTTP request records the statements it
+runs (through SQLAlchemy cursor events):
+
+* A statement shape (SQL text with IN-lists collapsed) repeated
+  ``QUERY_AUDIT_REPEAT_THRESHOLD`` times in one request is reported as an
+  N+1 pattern, with the application call sites that issued it.
+* A view decorated with ``@query_budget(n)`` that runs more than ``n``
+  statements is reported as over budget; with ``QUERY_AUDIT_RAISE`` (tests)
+  the request fails with ``QueryBudgetExceeded`` instead.
+* Responses carry ``X-Query-Count``.
+
+Tests can also bound any block, independent of the app config::
+
+    with max_queries(4):
+        client.get("/api/classes/list", headers=headers)
+
+Auditing walks the Python stack per statement, so leave it off in
+production; the metrics in metrics.py cover production query counts.
+"""
+import logging
+import os
+import re
+import sys
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database import db
+from logs import get_logger
+
+log = get_logger("query_audit")
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+MAX_CALL_SITES = 3  # Distinct call sites kept per statement shape
+STACK_DEPTH = 4  # Application frames per call site
+
+IN_LIST = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def statement_shape(statement):
+    """SQL text with expanded IN-lists collapsed, so ``IN (?, ?)`` and ``IN (?)`` match"""
+    return IN_LIST.sub("(?...)", WHITESPACE.sub(" ", statement).strip())
+
+def call_site():
+    """Innermost application frames (outside libraries and this module)"""
+    frames = []
+    frame = sys._getframe(2)
+    while frame is not None and len(frames) < STACK_DEPTH:
+        path = frame.f_code.co_filename
+        if path.startswith(BACKEND_DIR) and path != __file__ and "site-packages" not in path:
+            frames.append(f"{os.path.relpath(path, BACKEND_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}")
+        frame = frame.f_back
+    return " < ".join(frames) or "<unknown>"
+
+
+class StatementLog:
+    def __init__(self):
+        self.count = 0
+        self.shapes = {}  # shape -> [executions, call sites]
+
+    def add(self, statement):
+        self.count += 1
+        entry = self.shapes.setdefault(statement_shape(statement), [0, []])
+        entry[0] += 1
+        if len(entry[1]) < MAX_CALL_SITES:
+            site = call_site()
+            if site not in entry[1]:
+                entry[1].append(site)
+
+    def repeated(self, threshold):
+        """``[(shape, executions, call sites)]`` run at least ``threshold`` times, most first"""
+        found = [(shape, n, sites) for shape, (n, sites) in self.shapes.items() if n >= threshold]
+        return sorted(found, key=lambda item: item[1], reverse=True)
+
+    def report(self, limit=5):
+        lines = [f"{self.count} statement(s):"]
+        for shape, n, sites in self.repeated(1)[:limit]:
+            lines.append(f"  {n}x {shape[:200]}")
+            lines += [f"      at {site}" for site in sites]
+        return "\n".join(lines)
+
+
+def query_budget(max_statements):
+    """Declare the most SQL statements a view may run (checked when QUERY_AUDIT is on)"""
+    def decorator(view):
+        view.query_budget = max_statements  # Copied by functools.wraps of outer decorators
+        return view
+    return decorator
+
+@contextmanager
+def max_queries(limit):
+    """Fail with QueryBudgetExceeded if the block runs more than ``limit`` statements"""
+    statements = StatementLog()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.add(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    if statements.count > limit:
+        raise QueryBudgetExceeded(f"Expected at most {limit} queries, ran {statements.report()}")
+
+
+class QueryAuditor:
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        if not app.config.get("QUERY_AUDIT"):
+            return
+        self.enabled = True
+        self.threshold = app.config.get("QUERY_AUDIT_REPEAT_THRESHOLD", 5)
+        self.strict = app.config.get("QUERY_AUDIT_RAISE", False)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", self.record)
+        app.extensions["query_audit"] = self
+
+    def before_request(self):
+        g.query_audit = StatementLog()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and "query_audit" in g:
+            g.query_audit.add(statement)
+
+    def after_request(self, response):
+        statements = g.pop("query_audit", None)
+        if statements is None:
+            return response
+        response.headers["X-Query-Count"] = str(statements.count)
+        endpoint = request.endpoint or request.path
+
+        for shape, n, sites in statements.repeated(self.threshold):
+            log.event("n_plus_one", level=logging.WARNING, endpoint=endpoint, executions=n, statement=shape[:500], call_sites=sites)
+
+        budget = getattr(current_app.view_functions.get(request.endpoint), "query_budget", None)
+        if budget is not None and statements.count > budget:
+            log.event("query_budget_exceeded", level=logging.ERROR, endpoint=endpoint, budget=budget, statements=statements.count)
+            if self.strict:
+                raise QueryBudgetExceeded(f"{endpoint}: budget {budget}, ran {statements.report()}")
+        return response
+
+
+query_auditor = QueryAuditor()
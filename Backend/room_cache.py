@@ -0,0 +1,203 @@
+"""Bounded in-process cache of the newest serialized messages per room.
+
+Opening a chat only needs its latest page, so once a history request has
+loaded a room from the database the room keeps up to RECENT_CACHE_ROOM_SIZE
+serialized messages and later opens are served from memory.
+
+* Send paths append to warm rooms after their commit.
+* Updating or deleting a Message/GroupMessage row (from any route) drops its
+  room when the transaction commits.
+* Rooms are evicted least-recently-used once the estimated size passes
+  RECENT_CACHE_MAX_BYTES.
+
+A per-room generation counter is taken before each database read, so a fill
+that raced a write is discarded instead of caching a stale page. The cache is
+per process; with a Socket.IO message queue configured, every local change
+also invalidates the room in the other workers (pubsub.py). Sender names
+inside cached group entries are as of caching time.
+"""
+import bisect
+import json
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import GroupMessage, Message
+
+# Generation entries kept for rooms that are not cached (bounds memory)
+MAX_TRACKED_ROOMS = 10000
+
+
+def dm_room(user_a, user_b):
+    return ("dm", min(user_a, user_b), max(user_a, user_b))
+
+def group_room(group_id):
+    return ("group", int(group_id))
+
+def room_of(msg):
+    if isinstance(msg, Message):
+        return dm_room(msg.sender_id, msg.receiver_id)
+    return group_room(msg.group_id)
+
+
+class RoomBuffer:
+    """Newest messages of one room, oldest first, keyed by (timestamp, id)"""
+    __slots__ = ("keys", "payloads", "sizes", "has_more")
+
+    def __init__(self, has_more):
+        self.keys, self.payloads, self.sizes = [], [], []
+        self.has_more = has_more  # Older messages exist beyond the buffer
+
+    def insert(self, key, payload, size):
+        i = bisect.bisect(self.keys, key)
+        self.keys.insert(i, key)
+        self.payloads.insert(i, payload)
+        self.sizes.insert(i, size)
+
+    def drop_oldest(self):
+        self.keys.pop(0)
+        self.payloads.pop(0)
+        self.has_more = True
+        return self.sizes.pop(0)
+
+
+class RecentMessageCache:
+    def __init__(self, room_size=50, max_bytes=32 * 1024 * 1024):
+        self.room_size = room_size
+        self.max_bytes = max_bytes
+        self._rooms = OrderedDict()  # room -> RoomBuffer, least recently used first
+        self._generations = OrderedDict()  # room -> write counter
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.publish = None  # Tells other worker processes a room changed (see pubsub.py)
+        self.hits = self.misses = self.bypasses = self.evictions = 0
+
+    def init_app(self, app):
+        self.room_size = app.config.get("RECENT_CACHE_ROOM_SIZE", self.room_size)
+        self.max_bytes = app.config.get("RECENT_CACHE_MAX_BYTES", self.max_bytes)
+        app.extensions["recent_messages"] = self
+
+    def generation(self, room):
+        """Write counter for a room; take it before reading the database"""
+        with self._lock:
+            self._generations.setdefault(room, 0)
+            self._generations.move_to_end(room)
+            while len(self._generations) > MAX_TRACKED_ROOMS:
+                self._generations.popitem(last=False)
+            return self._generations[room]
+
+    def page(self, room, limit):
+        """``(payloads, has_more)`` for the newest ``limit`` messages, or None on a miss"""
+        with self._lock:
+            if limit > self.room_size:
+                self.bypasses += 1
+                return None
+            buf = self._rooms.get(room)
+            # A short buffer only answers if nothing older exists
+            if buf is None or (len(buf.keys) < limit and buf.has_more):
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room)
+            self.hits += 1
+            return list(buf.payloads[-limit:]), len(buf.keys) > limit or buf.has_more
+
+    def fill(self, room, entries, has_more, generation):
+        """Cache a page just read from the database (``[(key, payload)]``, oldest first)"""
+        with self._lock:
+            if self._generations.get(room) != generation:
+                return  # Written (or forgotten) since the read began
+            self._discard(room)
+            if len(entries) > self.room_size:
+                entries, has_more = entries[-self.room_size:], True
+            buf = RoomBuffer(has_more)
+            for key, payload in entries:
+                size = estimate_size(payload)
+                buf.insert(key, payload, size)
+                self.bytes += size
+            self._rooms[room] = buf
+            self._evict()
+
+    def append(self, room, key, payload):
+        """Add a just-committed message to a warm room"""
+        with self._lock:
+            self._bump(room)
+            buf = self._rooms.get(room)
+            if buf is not None:
+                size = estimate_size(payload)
+                buf.insert(key, payload, size)
+                self.bytes += size
+                while len(buf.keys) > self.room_size:
+                    self.bytes -= buf.drop_oldest()
+                self._evict()
+            # A cold room loads from the database on its next open
+        self._broadcast(room)
+
+    def invalidate(self, room, broadcast=True):
+        with self._lock:
+            self._bump(room)
+            self._discard(room)
+        if broadcast:
+            self._broadcast(room)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "rooms": len(self._rooms),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "room_size": self.room_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+    def _broadcast(self, room):
+        # Other workers drop their copy and reload it from the database
+        if self.publish is not None:
+            self.publish(room)
+
+    # --- Internal (lock held) ---
+
+    def _bump(self, room):
+        self._generations[room] = self._generations.get(room, 0) + 1
+        self._generations.move_to_end(room)
+
+    def _discard(self, room):
+        buf = self._rooms.pop(room, None)
+        if buf is not None:
+            self.bytes -= sum(buf.sizes)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._rooms:
+            _, buf = self._rooms.popitem(last=False)
+            self.bytes -= sum(buf.sizes)
+            self.evictions += 1
+
+
+def estimate_size(payload):
+    return len(json.dumps(payload, default=str))
+
+
+recent_messages = RecentMessageCache()
+
+
+# Rows changed or deleted by any code path drop their room once committed
+@event.listens_for(Session, "after_flush")
+def collect_stale_rooms(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Message, GroupMessage)):
+            session.info.setdefault("stale_rooms", set()).add(room_of(obj))
+
+@event.listens_for(Session, "after_commit")
+def invalidate_stale_rooms(session):
+    for room in session.info.pop("stale_rooms", ()):
+        recent_messages.invalidate(room)
+
+@event.listens_for(Session, "after_rollback")
+def forget_stale_rooms(session):
+    session.info.pop("stale_rooms", None)
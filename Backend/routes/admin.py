@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User, SystemLog, Message, FriendRequest, db
 from functools import wraps
+import datetime
 import sqlalchemy
 import sys
 import os
@@ -11,6 +12,11 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from DSA.performance import generate_performance_graphs
 from models import User, SystemLog, Message, FriendRequest, Group, GroupMember, GroupMessage, Class, ClassMember, Assignment, AssignmentSubmission, db
 
+from room_cache import recent_messages
+from write_behind import write_behind
+import logs
+from metrics import socket_metrics
+
 admin_bp = Blueprint("admin", __name__)
 
 from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
@@ -60,9 +66,24 @@ def get_stats():
         "users": User.query.count(),
         "messages": Message.query.count(),
         "logs": SystemLog.query.count(),
-        "friend_requests": FriendRequest.query.count()
+        "friend_requests": FriendRequest.query.count(),
+        "recent_message_cache": recent_messages.stats(),
+        "write_behind": write_behind.stats(),
+        "logging": logs.writer.stats() if logs.writer else None
     })
 
+@admin_bp.route("/socket-metrics", methods=["GET"])
+@admin_required
+def get_socket_metrics():
+    """Per-event Socket.IO handler metrics and the busiest rooms (this worker)"""
+    return jsonify(socket_metrics.snapshot())
+
+@admin_bp.route("/socket-metrics/reset", methods=["POST"])
+@admin_required
+def reset_socket_metrics():
+    socket_metrics.reset()
+    return jsonify({"message": "Socket metrics reset"})
+
 @admin_bp.route("/tables", methods=["GET"])
 @admin_required
 def get_tables():
@@ -80,11 +101,17 @@ def get_table_data(table_name):
         return jsonify({"error": "Table not supported in API"}), 400
 
     rows = model.query.all()
+    # Deferred blob columns are summarised from their length projection instead of loaded
+    deferred = {p.key for p in sqlalchemy.inspect(model).column_attrs if p.deferred}
     # Serialize
     data = []
     for row in rows:
         row_data = {}
         for column in row.__table__.columns:
+            if column.name in deferred:
+                length = getattr(row, f"{column.name}_length", None)
+                row_data[column.name] = f"<{length} chars>" if length else None
+                continue
              # handle binary or complex types if needed, but for now simple serialization
             val = getattr(row, column.name)
             if isinstance(val, (datetime.datetime, datetime.date)):
@@ -1,33 +1,61 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import Assignment, AssignmentSubmission, User, ClassMember
+from sqlalchemy import and_, or_
+from models import Assignment, AssignmentSubmission, User, ClassMember, UploadSession
 from database import db
-from datetime import datetime
+from query_audit import query_budget
+from cascade import cascade_deleter, job_status, deleting, assignment_deleting, unreferenced_blobs, remove_blob_files, restore_blob_files
+from attachments import read_upload_fields, store_request_uploads, UploadTooLarge, store_file, staging_path, resolve_file, MAX_UPLOAD_BYTES, BLOCK_SIZE
+from datetime import datetime, timedelta, timezone
+import os
+import uuid
 
 assignments_bp = Blueprint("assignments", __name__)
 
+# Resumable upload tuning
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Suggested chunk size returned by init
+MAX_CHUNK_BYTES = 4 * 1024 * 1024  # Largest single chunk accepted
+UPLOAD_EXPIRY = timedelta(hours=24)  # Abandoned sessions are purged after this
+MAX_ACTIVE_UPLOADS = 5  # Open upload sessions per user
+MAX_STAGED_BYTES = 2 * MAX_UPLOAD_BYTES  # Declared size of a user's open sessions, together
+MAX_PAGE_SIZE = 100  # Largest page of a paginated assignment listing
+
 # --- Assignment Management ---
 
 @assignments_bp.post("/create")
 @jwt_required()
 def create_assignment():
-    """Faculty creates an assignment for their class"""
+    """Faculty creates an assignment for their class (multipart, raw body, or legacy JSON)"""
     uid = int(get_jwt_identity())
-    data = request.json
+    
+    try:
+        data = read_upload_fields()
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     class_id = data.get("class_id")
     title = data.get("title")
     description = data.get("description", "")
     due_date_str = data.get("due_date")
-    total_points = data.get("total_points", 100)
     
     if not all([class_id, title, due_date_str]):
         return jsonify({"error": "class_id, title, and due_date are required"}), 400
     
+    try:
+        # Form and query fields arrive as strings
+        class_id = int(class_id)
+        total_points = int(data.get("total_points", 100))
+    except (TypeError, ValueError):
+        return jsonify({"error": "class_id and total_points must be integers"}), 400
+    
     # Verify user is a moderator of this class
     membership = ClassMember.query.filter_by(class_id=class_id, user_id=uid).first()
     if not membership or not membership.is_moderator:
         return jsonify({"error": "Must be class moderator to create assignments"}), 403
+    if deleting(("class", class_id)):
+        return jsonify({"error": "Class is being deleted"}), 409
     
     # Parse due date
     try:
@@ -35,6 +63,14 @@ def create_assignment():
     except:
         return jsonify({"error": "Invalid due_date format. Use ISO format"}), 400
     
+    # Attachment bytes are stored only once the moderator check and validation pass
+    try:
+        refs = store_request_uploads(data)
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
     new_assignment = Assignment(
         class_id=class_id,
         title=title,
@@ -42,7 +78,7 @@ def create_assignment():
         due_date=due_date,
         total_points=total_points,
         created_by=uid,
-        file_data=data.get("file_data"),
+        file_ref=refs["file"],
         file_name=data.get("file_name"),
         file_type=data.get("file_type")
     )
@@ -54,8 +90,13 @@ def create_assignment():
 
 @assignments_bp.get("/class/<int:class_id>")
 @jwt_required()
+@query_budget(2)
 def list_class_assignments(class_id):
-    """Get all assignments for a class"""
+    """Get a class's assignments with the caller's submission status
+    
+    Optional: ``due_after`` / ``due_before`` (ISO) window on the due date,
+    ``limit`` / ``offset`` pagination (``has_more`` tells if a page follows).
+    """
     uid = int(get_jwt_identity())
     
     # Verify user is a member of this class
@@ -63,13 +104,40 @@ def list_class_assignments(class_id):
     if not membership:
         return jsonify({"error": "Access denied"}), 403
     
-    assignments = Assignment.query.filter_by(class_id=class_id).order_by(Assignment.due_date.asc()).all()
+    try:
+        due_after = parse_due_bound(request.args.get("due_after"))
+        due_before = parse_due_bound(request.args.get("due_before"))
+    except ValueError:
+        return jsonify({"error": "Invalid due_after/due_before format. Use ISO format"}), 400
+    limit = request.args.get("limit", type=int)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    
+    # One outer join gives each assignment with the caller's submission; blobs stay on disk
+    query = db.session.query(
+        Assignment.id, Assignment.title, Assignment.description, Assignment.due_date,
+        Assignment.total_points, Assignment.created_at, Assignment.file_name,
+        or_(Assignment.file_ref.is_not(None), Assignment.file_data.is_not(None)).label("has_file"),  # NULL test, no blob read
+        AssignmentSubmission.id.label("submission_id"), AssignmentSubmission.grade, AssignmentSubmission.submitted_at
+    ).outerjoin(AssignmentSubmission, and_(
+        AssignmentSubmission.assignment_id == Assignment.id, AssignmentSubmission.student_id == uid
+    )).filter(Assignment.class_id == class_id)
+    if due_after is not None:
+        query = query.filter(Assignment.due_date >= due_after)
+    if due_before is not None:
+        query = query.filter(Assignment.due_date < due_before)
+    query = query.order_by(Assignment.due_date.asc(), Assignment.id.asc())
+    
+    has_more = False
+    if limit is not None:
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+        rows = query.offset(offset).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        rows = query.all()
     
     results = []
-    for a in assignments:
-        # Check if current user has submitted
-        submission = AssignmentSubmission.query.filter_by(assignment_id=a.id, student_id=uid).first()
-        
+    for a in rows:
         results.append({
             "id": a.id,
             "title": a.title,
@@ -77,15 +145,24 @@ def list_class_assignments(class_id):
             "due_date": a.due_date.isoformat(),
             "total_points": a.total_points,
             "created_at": a.created_at.isoformat(),
-            "has_file": bool(a.file_data),
+            "has_file": bool(a.has_file),
             "file_name": a.file_name,
             # Student-specific fields
-            "submitted": bool(submission),
-            "grade": submission.grade if submission else None,
-            "submission_time": submission.submitted_at.isoformat() if submission else None
+            "submitted": a.submission_id is not None,
+            "grade": a.grade,
+            "submission_time": a.submitted_at.isoformat() if a.submitted_at else None
         })
     
-    return jsonify({"assignments": results}), 200
+    return jsonify({"assignments": results, "has_more": has_more}), 200
+
+def parse_due_bound(value):
+    """ISO date/datetime query parameter as naive UTC (how due dates are compared), or None"""
+    if not value:
+        return None
+    bound = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if bound.tzinfo is not None:
+        bound = bound.astimezone(timezone.utc).replace(tzinfo=None)
+    return bound
 
 @assignments_bp.get("/<int:assignment_id>")
 @jwt_required()
@@ -112,7 +189,7 @@ def get_assignment_details(assignment_id):
         "due_date": assignment.due_date.isoformat(),
         "total_points": assignment.total_points,
         "created_at": assignment.created_at.isoformat(),
-        "file_data": assignment.file_data,
+        "file_data": resolve_file(assignment.file_ref, assignment.file_data, assignment.file_type),
         "file_name": assignment.file_name,
         "file_type": assignment.file_type,
         "submission": {
@@ -128,9 +205,8 @@ def get_assignment_details(assignment_id):
 @assignments_bp.post("/<int:assignment_id>/submit")
 @jwt_required()
 def submit_assignment(assignment_id):
-    """Student submits work for an assignment"""
+    """Student submits work for an assignment (multipart, raw body, or legacy JSON)"""
     uid = int(get_jwt_identity())
-    data = request.json
     
     assignment = Assignment.query.get(assignment_id)
     if not assignment:
@@ -140,27 +216,54 @@ def submit_assignment(assignment_id):
     membership = ClassMember.query.filter_by(class_id=assignment.class_id, user_id=uid).first()
     if not membership:
         return jsonify({"error": "Access denied"}), 403
+    if assignment_deleting(assignment):
+        return jsonify({"error": "Assignment is being deleted"}), 409
     
+    try:
+        data = read_upload_fields()
+        refs = store_request_uploads(data)
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return save_submission(assignment_id, uid, refs["file"], data.get("file_name"), data.get("file_type"), data.get("text_response", ""))
+
+def save_submission(assignment_id, uid, file_ref, file_name, file_type, text_response):
+    """Create or replace a student's submission in a single commit"""
     # Check if already submitted
     existing = AssignmentSubmission.query.filter_by(assignment_id=assignment_id, student_id=uid).first()
     if existing:
         # Update existing submission
-        existing.file_data = data.get("file_data")
-        existing.file_name = data.get("file_name")
-        existing.file_type = data.get("file_type")
-        existing.text_response = data.get("text_response", "")
+        replaced = existing.file_ref if existing.file_ref != file_ref else None
+        existing.file_ref = file_ref
+        existing.file_data = None
+        existing.file_name = file_name
+        existing.file_type = file_type
+        existing.text_response = text_response
         existing.submitted_at = datetime.utcnow()
-        db.session.commit()
+
+        # The replaced file goes too unless another row uses it (the cascade delete check)
+        blobs = []
+        try:
+            if replaced:
+                db.session.flush()
+                blobs = unreferenced_blobs({replaced}, datetime.utcnow() - cascade_deleter.blob_grace)
+            db.session.commit()
+        except Exception:
+            restore_blob_files(blobs)
+            raise
+        remove_blob_files(blobs)
         return jsonify({"message": "Submission updated"}), 200
     
     # Create new submission
     submission = AssignmentSubmission(
         assignment_id=assignment_id,
         student_id=uid,
-        file_data=data.get("file_data"),
-        file_name=data.get("file_name"),
-        file_type=data.get("file_type"),
-        text_response=data.get("text_response", "")
+        file_ref=file_ref,
+        file_name=file_name,
+        file_type=file_type,
+        text_response=text_response
     )
     
     db.session.add(submission)
@@ -168,6 +271,155 @@ def submit_assignment(assignment_id):
     
     return jsonify({"message": "Assignment submitted successfully"}), 201
 
+# --- Resumable Chunked Submission Uploads ---
+
+@assignments_bp.post("/<int:assignment_id>/uploads")
+@jwt_required()
+def init_upload(assignment_id):
+    """Start a resumable upload for a submission file"""
+    uid = int(get_jwt_identity())
+    data = request.json
+    
+    assignment = Assignment.query.get(assignment_id)
+    if not assignment:
+        return jsonify({"error": "Assignment not found"}), 404
+    
+    # Verify student is in class
+    membership = ClassMember.query.filter_by(class_id=assignment.class_id, user_id=uid).first()
+    if not membership:
+        return jsonify({"error": "Access denied"}), 403
+    if assignment_deleting(assignment):
+        return jsonify({"error": "Assignment is being deleted"}), 409
+    
+    try:
+        size = int(data["size"])
+    except (TypeError, KeyError, ValueError):
+        return jsonify({"error": "size is required"}), 400
+    if size <= 0 or size > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"File size must be between 1 byte and {MAX_UPLOAD_BYTES // (1024 * 1024)}MB"}), 400
+    
+    purge_expired_uploads(uid)
+    
+    # Staged bytes sit on local disk until completed or expired: bound them per user
+    active, staged = db.session.query(db.func.count(UploadSession.id), db.func.coalesce(db.func.sum(UploadSession.size), 0)).filter(
+        UploadSession.user_id == uid
+    ).one()
+    if active >= MAX_ACTIVE_UPLOADS:
+        return jsonify({"error": f"Too many uploads in progress (limit {MAX_ACTIVE_UPLOADS})"}), 429
+    if staged + size > MAX_STAGED_BYTES:
+        return jsonify({"error": f"Uploads in progress would exceed {MAX_STAGED_BYTES // (1024 * 1024)}MB"}), 429
+    
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=uid,
+        assignment_id=assignment_id,
+        file_name=data.get("file_name"),
+        file_type=data.get("file_type"),
+        size=size,
+        received=0
+    )
+    open(staging_path(upload.id), "wb").close()
+    db.session.add(upload)
+    db.session.commit()
+    
+    return jsonify({"upload_id": upload.id, "chunk_size": UPLOAD_CHUNK_SIZE, "received": 0, "size": size}), 201
+
+@assignments_bp.get("/uploads/<upload_id>")
+@jwt_required()
+def upload_status(upload_id):
+    """Report how many bytes have been received so a client can resume"""
+    uid = int(get_jwt_identity())
+    
+    upload = UploadSession.query.get(upload_id)
+    if not upload or upload.user_id != uid:
+        return jsonify({"error": "Upload not found"}), 404
+    
+    return jsonify({
+        "upload_id": upload.id,
+        "received": upload.received,
+        "size": upload.size,
+        "complete": upload.received == upload.size
+    }), 200
+
+@assignments_bp.put("/uploads/<upload_id>")
+@jwt_required()
+def upload_chunk(upload_id):
+    """Append one chunk (raw request body) at the given offset"""
+    uid = int(get_jwt_identity())
+    
+    upload = UploadSession.query.get(upload_id)
+    if not upload or upload.user_id != uid:
+        return jsonify({"error": "Upload not found"}), 404
+    
+    # Reject before reading anything from the socket
+    length = request.content_length
+    if length is None or length <= 0 or length > MAX_CHUNK_BYTES:
+        return jsonify({"error": f"Chunk must be between 1 byte and {MAX_CHUNK_BYTES // (1024 * 1024)}MB"}), 413
+    
+    offset = request.args.get("offset", type=int)
+    if offset != upload.received:
+        # Client is out of step (e.g. a retried chunk already landed); tell it where to resume
+        return jsonify({"error": "Offset mismatch", "received": upload.received}), 409
+    
+    if offset + length > upload.size:
+        return jsonify({"error": "Chunk exceeds declared file size", "received": upload.received}), 400
+    
+    # Stream the body to disk block by block
+    written = 0
+    with open(staging_path(upload.id), "r+b") as f:
+        f.seek(offset)
+        while written < length:
+            block = request.stream.read(min(BLOCK_SIZE, length - written))
+            if not block:
+                break
+            f.write(block)
+            written += len(block)
+        # Drop anything past the acknowledged bytes (short or aborted bodies)
+        f.truncate(offset + written)
+    
+    upload.received = offset + written
+    db.session.commit()
+    
+    return jsonify({"received": upload.received, "size": upload.size}), 200
+
+@assignments_bp.post("/uploads/<upload_id>/complete")
+@jwt_required()
+def complete_upload(upload_id):
+    """Finalize a fully received upload into the student's submission"""
+    uid = int(get_jwt_identity())
+    data = request.json or {}
+    
+    upload = UploadSession.query.get(upload_id)
+    if not upload or upload.user_id != uid:
+        return jsonify({"error": "Upload not found"}), 404
+    
+    if upload.received != upload.size:
+        return jsonify({"error": "Upload incomplete", "received": upload.received, "size": upload.size}), 409
+    
+    # Membership may have been revoked while uploading
+    assignment = Assignment.query.get(upload.assignment_id)
+    if not assignment or not ClassMember.query.filter_by(class_id=assignment.class_id, user_id=uid).first():
+        return jsonify({"error": "Access denied"}), 403
+    if assignment_deleting(assignment):
+        return jsonify({"error": "Assignment is being deleted"}), 409
+    
+    # The staged file moves into the store; the session row goes in the same commit as the submission
+    file_ref = store_file(staging_path(upload.id), upload.file_type)
+    db.session.delete(upload)
+    
+    return save_submission(upload.assignment_id, uid, file_ref, upload.file_name, upload.file_type, data.get("text_response", ""))
+
+def purge_expired_uploads(uid):
+    """Drop a user's abandoned upload sessions and their staged bytes"""
+    cutoff = datetime.utcnow() - UPLOAD_EXPIRY
+    for stale in UploadSession.query.filter(
+        (UploadSession.user_id == uid) & (UploadSession.created_at < cutoff)
+    ).all():
+        path = staging_path(stale.id)
+        if os.path.exists(path):
+            os.unlink(path)
+        db.session.delete(stale)
+
 @assignments_bp.get("/<int:assignment_id>/submissions")
 @jwt_required()
 def get_assignment_submissions(assignment_id):
@@ -228,7 +480,7 @@ def get_student_submission(assignment_id, student_id):
         return jsonify({"error": "Submission not found"}), 404
     
     return jsonify({
-        "file_data": submission.file_data,
+        "file_data": resolve_file(submission.file_ref, submission.file_data, submission.file_type),
         "file_name": submission.file_name,
         "file_type": submission.file_type,
         "text_response": submission.text_response,
@@ -250,6 +502,8 @@ def grade_submission(assignment_id, student_id):
     membership = ClassMember.query.filter_by(class_id=assignment.class_id, user_id=uid).first()
     if not membership or not membership.is_moderator:
         return jsonify({"error": "Moderator access required"}), 403
+    if assignment_deleting(assignment):
+        return jsonify({"error": "Assignment is being deleted"}), 409
     
     submission = AssignmentSubmission.query.filter_by(assignment_id=assignment_id, student_id=student_id).first()
     if not submission:
@@ -285,10 +539,7 @@ def delete_assignment(assignment_id):
     if not membership or not membership.is_moderator:
         return jsonify({"error": "Moderator access required"}), 403
     
-    # Delete all submissions first
-    AssignmentSubmission.query.filter_by(assignment_id=assignment_id).delete()
-    
-    db.session.delete(assignment)
-    db.session.commit()
+    # Submissions, upload sessions and their files go in the background
+    job = cascade_deleter.enqueue("assignment", assignment_id, uid)
     
-    return jsonify({"message": "Assignment deleted"}), 200
+    return jsonify({"message": "Assignment deletion started", "job": job_status(job)}), 202
@@ -0,0 +1,52 @@
+from flask import Blueprint, request, jsonify, send_file
+from models import Attachment
+from database import db
+from attachments import blob_path, is_referenced, verify_url, INLINE_TYPES
+import os
+import re
+import time
+
+attachments_bp = Blueprint("attachments", __name__)
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+@attachments_bp.get("/<digest>")
+def download(digest):
+    """Stream a stored attachment through a signed URL (see attachments.py).
+
+    Only allowlisted image/audio/PDF types render inline; everything else is
+    sent as a download, and the response can never run script (nosniff,
+    sandboxed CSP). A blob no row references any more is gone even if the
+    URL has not expired. Range requests and If-None-Match are handled by
+    send_file.
+    """
+    if not SHA256_RE.match(digest):
+        return jsonify({"error": "Invalid attachment id"}), 400
+
+    expires = request.args.get("exp", type=int)
+    mime_type = request.args.get("type")  # Declared by the row that minted the URL
+    if not verify_url(digest, expires, request.args.get("sig"), mime_type):
+        return jsonify({"error": "Link expired or invalid"}), 403
+
+    attachment = Attachment.query.get(digest)
+    path = blob_path(digest)
+    if not attachment or not os.path.exists(path) or not is_referenced(digest):
+        return jsonify({"error": "Attachment not found"}), 404
+
+    mime_type = mime_type or attachment.mime_type
+    inline = mime_type in INLINE_TYPES and request.args.get("download") != "1"
+    remaining = max(expires - int(time.time()), 0)
+    response = send_file(
+        path,
+        mimetype=mime_type if inline else "application/octet-stream",
+        as_attachment=not inline,
+        download_name=request.args.get("name") or digest,
+        conditional=True,
+        etag=digest,
+        max_age=remaining
+    )
+    # Content never changes for a digest; the URL itself expires
+    response.headers["Cache-Control"] = f"private, max-age={remaining}, immutable"
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    response.headers["Content-Security-Policy"] = "sandbox"
+    return response
@@ -1,15 +1,14 @@
 from flask import Blueprint, request, jsonify
-from models import User
+from models import User, PendingRegistration
 from database import db
 from flask_jwt_extended import create_access_token
 from werkzeug.security import generate_password_hash, check_password_hash
+from logs import get_logger
 from datetime import datetime, timedelta
 import random
 
 auth_bp = Blueprint("auth", __name__)
-
-# In-memory storage for pending registrations (before OTP verification)
-pending_registrations = {}
+log = get_logger("auth")
 
 @auth_bp.post("/register")
 def register():
@@ -26,23 +25,24 @@ def register():
         otp_code = str(random.randint(10000, 99999))
         otp_expiry = datetime.utcnow() + timedelta(minutes=10)
         
-        # Store registration data temporarily (NOT in database yet)
-        pending_registrations[email] = {
-            "name": data["name"],
-            "registration_number": data.get("registration_number"),  # Optional field
-            "password": data["password"],  # Will be hashed on verification
-            "role": data.get("role", "student"),
-            "department": data.get("department"),
-            "faculty_designation": data.get("faculty_designation"),
-            "otp_code": otp_code,
-            "otp_expiry": otp_expiry
-        }
-        
-        # Print OTP to console (in production, send via email)
-        print(f"\n{'='*50}")
-        print(f"OTP for {email}: {otp_code}")
-        print(f"Expires at: {otp_expiry}")
-        print(f"{'='*50}\n")
+        # Store registration data until verified (NOT a user account yet); kept in
+        # the database so any worker process can verify the OTP
+        PendingRegistration.query.filter(PendingRegistration.otp_expiry < datetime.utcnow()).delete(synchronize_session=False)
+        db.session.merge(PendingRegistration(
+            email=email,
+            name=data["name"],
+            registration_number=data.get("registration_number"),  # Optional field
+            password_hash=generate_password_hash(data["password"]),
+            role=data.get("role", "student"),
+            department=data.get("department"),
+            faculty_designation=data.get("faculty_designation"),
+            otp_code=otp_code,
+            otp_expiry=otp_expiry
+        ))
+        db.session.commit()
+        
+        # Log the OTP (in production, send via email)
+        log.event("otp_issued", email=email, otp=otp_code, expires=otp_expiry)
         
         return jsonify({
             "message": "OTP sent to console (check terminal)",
@@ -62,23 +62,21 @@ def verify_otp():
         otp = data["otp"]
         
         # Check if registration is pending
-        if email not in pending_registrations:
+        pending = PendingRegistration.query.get(email)
+        if not pending:
             return jsonify({"error": "No pending registration for this email"}), 404
         
-        pending = pending_registrations[email]
-        
         # Check OTP expiry
-        if datetime.utcnow() > pending["otp_expiry"]:
-            del pending_registrations[email]
+        if datetime.utcnow() > pending.otp_expiry:
+            db.session.delete(pending)
+            db.session.commit()
             return jsonify({"error": "OTP expired. Please register again."}), 400
         
         # Verify OTP
-        if pending["otp_code"] != otp:
+        if pending.otp_code != otp:
             return jsonify({"error": "Invalid OTP"}), 400
         
         # OTP is valid - NOW create the user account
-        hashed_password = generate_password_hash(pending["password"])
-        
         # Delete old unverified account if exists
         old_user = User.query.filter_by(email=email).first()
         if old_user:
@@ -86,22 +84,21 @@ def verify_otp():
         
         user = User(
             email=email,
-            password=hashed_password,
-            display_name=pending["name"],
-            registration_number=pending.get("registration_number"),
+            password=pending.password_hash,
+            display_name=pending.name,
+            registration_number=pending.registration_number,
             is_verified=True,
-            role=pending.get("role", "student"),
-            department=pending.get("department"),
-            faculty_designation=pending.get("faculty_designation"),
+            role=pending.role or "student",
+            department=pending.department,
+            faculty_designation=pending.faculty_designation,
             otp_code=None,
             otp_expiry=None
         )
         db.session.add(user)
+        # Remove from pending in the same transaction
+        db.session.delete(pending)
         db.session.commit()
         
-        # Remove from pending
-        del pending_registrations[email]
-        
         # Generate token
         token = create_access_token(identity=str(user.id))
         
@@ -1,8 +1,15 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify, make_response
+from sqlalchemy import and_, func
+from sqlalchemy.orm import aliased
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User, Class, ClassMember, Group, GroupMember, Assignment, AssignmentSubmission, SystemLog, FriendRequest
 from database import db
+from metrics import http_metrics
+from query_audit import query_budget
+from cascade import cascade_deleter, job_status, deleting
+import roster
 from datetime import datetime, timedelta
+import hashlib
 import sys
 import os
 
@@ -79,88 +86,91 @@ def create_class():
 
 @classes_bp.get("/list")
 @jwt_required()
+@query_budget(1)
 def list_classes():
     """List all classes user is a member of"""
     uid = int(get_jwt_identity())
     
-    # Get user's class memberships
-    memberships = ClassMember.query.filter_by(user_id=uid).all()
-    classes = []
-    
-    for m in memberships:
-        c = Class.query.get(m.class_id)
-        if not c:
-            continue
-            
-        # Count groups in this class
-        group_count = Group.query.filter_by(class_id=c.id).count()
-        
-        # Count members
-        member_count = ClassMember.query.filter_by(class_id=c.id).count()
-        
-        classes.append({
-            "id": c.id,
-            "name": c.name,
-            "description": c.description,
-            "icon": c.icon_url,
-            "created_by": c.created_by,
-            "created_at": c.created_at.isoformat(),
-            "is_moderator": m.is_moderator,
-            "group_count": group_count,
-            "member_count": member_count
-        })
+    # One joined read; counts are materialized on the class row (see counters.py)
+    rows = db.session.query(Class, ClassMember.is_moderator)\
+        .join(ClassMember, ClassMember.class_id == Class.id)\
+        .filter(ClassMember.user_id == uid)\
+        .order_by(ClassMember.id).all()
+    
+    classes = [{
+        "id": c.id,
+        "name": c.name,
+        "description": c.description,
+        "icon": c.icon_url,
+        "created_by": c.created_by,
+        "created_at": c.created_at.isoformat(),
+        "is_moderator": is_moderator,
+        "group_count": c.group_count,
+        "member_count": c.member_count
+    } for c, is_moderator in rows]
     
     return jsonify({"classes": classes}), 200
 
 @classes_bp.get("/<int:class_id>")
 @jwt_required()
+@query_budget(3)
 def get_class_details(class_id):
     """Get detailed information about a class"""
     uid = int(get_jwt_identity())
     
-    # Check membership
-    membership = ClassMember.query.filter_by(class_id=class_id, user_id=uid).first()
-    if not membership:
+    # Membership check and class row in one indexed lookup
+    row = db.session.query(Class, ClassMember.is_moderator)\
+        .join(ClassMember, ClassMember.class_id == Class.id)\
+        .filter(Class.id == class_id, ClassMember.user_id == uid).first()
+    if not row:
         return jsonify({"error": "Access denied"}), 403
-    
-    c = Class.query.get(class_id)
-    if not c:
-        return jsonify({"error": "Class not found"}), 404
-    
-    # Get groups in this class
-    groups = Group.query.filter_by(class_id=class_id).all()
-    group_list = []
-    for g in groups:
-        member_count = GroupMember.query.filter_by(group_id=g.id).count()
-        # Check if user is member of this group
-        user_membership = GroupMember.query.filter_by(group_id=g.id, user_id=uid).first()
-        
-        group_list.append({
-            "id": g.id,
-            "name": g.name,
-            "description": g.description,
-            "image": g.image_url,
-            "member_count": member_count,
-            "is_member": user_membership is not None,
-            "is_admin": user_membership.is_admin if user_membership else False
-        })
-    
-    # Get members
-    members = ClassMember.query.filter_by(class_id=class_id).all()
-    member_list = []
-    for m in members:
-        user = User.query.get(m.user_id)
-        if user:
-            member_list.append({
-                "id": user.id,
-                "name": user.display_name,
-                "email": user.email,
-                "role": user.role,
-                "is_moderator": m.is_moderator,
-                "joined_at": m.joined_at.isoformat()
-            })
-    
-    return jsonify({
+    c, is_moderator = row
+    
+    # The body depends on the class version and on who asks (is_member / is_admin flags)
+    etag = class_etag(c, uid)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+    
+    # Groups with their member counts and the caller's membership, in one query
+    member_counts = db.session.query(GroupMember.group_id, func.count(GroupMember.id).label("n"))\
+        .join(Group, Group.id == GroupMember.group_id)\
+        .filter(Group.class_id == class_id)\
+        .group_by(GroupMember.group_id).subquery()
+    mine = aliased(GroupMember)
+    groups = db.session.query(Group, member_counts.c.n, mine.id, mine.is_admin)\
+        .outerjoin(member_counts, member_counts.c.group_id == Group.id)\
+        .outerjoin(mine, and_(mine.group_id == Group.id, mine.user_id == uid))\
+        .filter(Group.class_id == class_id)\
+        .order_by(Group.id).all()
+    group_list = [{
+        "id": g.id,
+        "name": g.name,
+        "description": g.description,
+        "image": g.image_url,
+        "member_count": member_count or 0,
+        "is_member": my_membership is not None,
+        "is_admin": bool(is_admin)
+    } for g, member_count, my_membership, is_admin in groups]
+    
+    # Members joined to their users
+    members = db.session.query(
+        User.id, User.display_name, User.email, User.role, ClassMember.is_moderator, ClassMember.joined_at
+    ).join(User, User.id == ClassMember.user_id)\
+        .filter(ClassMember.class_id == class_id)\
+        .order_by(ClassMember.id).all()
+    member_list = [{
+        "id": m.id,
+        "name": m.display_name,
+        "email": m.email,
+        "role": m.role,
+        "is_moderator": m.is_moderator,
+        "joined_at": m.joined_at.isoformat()
+    } for m in members]
+    
+    response = jsonify({
         "class": {
             "id": c.id,
             "name": c.name,
@@ -168,11 +178,18 @@ def get_class_details(class_id):
             "icon": c.icon_url,
             "created_by": c.created_by,
             "created_at": c.created_at.isoformat(),
-            "is_moderator": membership.is_moderator
+            "is_moderator": is_moderator
         },
         "groups": group_list,
         "members": member_list
-    }), 200
+    })
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"  # Always revalidate; a 304 costs one lookup
+    return response, 200
+
+def class_etag(c, uid):
+    """Strong validator for one user's view of a class (see counters.py for the version)"""
+    return hashlib.sha1(f"class-detail:1:{c.id}:{c.version}:{uid}".encode()).hexdigest()
 
 @classes_bp.put("/<int:class_id>")
 @jwt_required()
@@ -187,6 +204,8 @@ def update_class(class_id):
     c = Class.query.get(class_id)
     if not c:
         return jsonify({"error": "Class not found"}), 404
+    if deleting(("class", class_id)):
+        return jsonify({"error": "Class is being deleted"}), 409
     
     data = request.json
     
@@ -218,37 +237,63 @@ def add_class_members():
     # Check moderator permission
     if not is_class_moderator(class_id, uid):
         return jsonify({"error": "Moderator access required"}), 403
+    if deleting(("class", class_id)):
+        return jsonify({"error": "Class is being deleted"}), 409
+    
+    report = roster.enroll(class_id, (str(email).strip() for email in emails), is_moderator=make_moderator)
+    db.session.commit()
     
-    added_count = 0
-    errors = []
+    problems = {"not_found": "User not found", "invalid": "User not found", "already_member": "Already member", "duplicate": "Already member"}
+    errors = [f"{problems[row['status']]}: {row['identifier']}" for row in report["rows"] if row["status"] in problems]
     
-    for email in emails:
-        user = User.query.filter_by(email=email.strip()).first()
-        if not user:
-            errors.append(f"User not found: {email}")
-            continue
-        
-        # Check if already member
-        existing = ClassMember.query.filter_by(class_id=class_id, user_id=user.id).first()
-        if existing:
-            errors.append(f"Already member: {email}")
-            continue
-        
-        # Add member
-        new_member = ClassMember(
-            class_id=class_id,
-            user_id=user.id,
-            is_moderator=make_moderator
+    return jsonify({
+        "message": f"Added {report['enrolled']} member(s)",
+        "added": report["enrolled"],
+        "errors": errors
+    }), 200
+
+@classes_bp.post("/<int:class_id>/roster")
+@jwt_required()
+def import_roster(class_id):
+    """Bulk-enroll a streamed roster: CSV or a JSON array of emails / registration numbers
+    
+    Body is the raw CSV / JSON, or a multipart upload in ``file``. Query
+    parameters: ``is_moderator=1``, ``dry_run=1`` (report without enrolling).
+    """
+    uid = int(get_jwt_identity())
+    
+    if not is_class_moderator(class_id, uid):
+        return jsonify({"error": "Moderator access required"}), 403
+    if deleting(("class", class_id)):
+        return jsonify({"error": "Class is being deleted"}), 409
+    
+    upload = request.files.get("file")
+    if upload is not None:
+        stream, is_json = upload.stream, upload.mimetype == "application/json" or (upload.filename or "").lower().endswith(".json")
+    else:
+        stream, is_json = request.stream, request.mimetype == "application/json"  # Never request.json: read as it arrives
+    identifiers = roster.json_identifiers(stream) if is_json else roster.csv_identifiers(stream)
+    dry_run = request.args.get("dry_run") == "1"
+    
+    try:
+        report = roster.enroll(
+            class_id, identifiers,
+            is_moderator=request.args.get("is_moderator") == "1",
+            chunk_size=current_app.config["ROSTER_CHUNK_SIZE"],
+            max_rows=current_app.config["ROSTER_MAX_ROWS"],
+            dry_run=dry_run,
         )
-        db.session.add(new_member)
-        added_count += 1
+    except (roster.RosterError, UnicodeDecodeError) as e:
+        db.session.rollback()
+        return jsonify({"error": f"Invalid roster: {e}"}), 400
     
-    db.session.commit()
+    if not dry_run:
+        db.session.commit()
     
     return jsonify({
-        "message": f"Added {added_count} member(s)",
-        "added": added_count,
-        "errors": errors
+        "message": f"{'Would enroll' if dry_run else 'Enrolled'} {report['enrolled']} of {report['total']} row(s)",
+        "dry_run": dry_run,
+        **report
     }), 200
 
 @classes_bp.delete("/<int:class_id>/members/<int:user_id>")
@@ -284,20 +329,10 @@ def delete_class(class_id):
     if c.created_by != uid:
         return jsonify({"error": "Only creator can delete class"}), 403
     
-    # Delete all members
-    ClassMember.query.filter_by(class_id=class_id).delete()
-    
-    # Delete all groups in class (and their members)
-    groups = Group.query.filter_by(class_id=class_id).all()
-    for g in groups:
-        GroupMember.query.filter_by(group_id=g.id).delete()
-        db.session.delete(g)
-    
-    # Delete class
-    db.session.delete(c)
-    db.session.commit()
+    # Rows, messages, assignments and blobs go in the background, in batches
+    job = cascade_deleter.enqueue("class", class_id, uid)
     
-    return jsonify({"message": "Class deleted successfully"}), 200
+    return jsonify({"message": "Class deletion started", "job": job_status(job)}), 202
 
 # ====== TEACHER DASHBOARD ======
 
@@ -325,8 +360,8 @@ def get_teacher_dashboard_stats():
     # Pending Requests (Friend requests for now, or could be class join requests if implemented)
     pending_requests = FriendRequest.query.filter_by(receiver_id=uid, status='pending').count()
 
-    # System Health (Fake/Mock or real uptime if tracked)
-    system_health = "99.9%" 
+    # System Health: share of requests this worker answered without a server error
+    system_health = http_metrics.health()
 
     # 3. Class Performance (DSA Graphs)
     # Generate graphs specific to this teacher
@@ -401,6 +436,8 @@ def quick_enroll_student():
     # Check if teacher owns or mods this class
     if not is_class_moderator(target_class.id, uid):
         return jsonify({"error": "You do not manage this class"}), 403
+    if deleting(("class", target_class.id)):
+        return jsonify({"error": "Class is being deleted"}), 409
 
     # 2. Find Student
     student = User.query.filter((User.id == student_identifier) | (User.email == student_identifier)).first()
@@ -2,6 +2,9 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from database import db
 from models import User, FriendRequest
+from presence import presence
+from query_audit import query_budget
+from sqlalchemy import case
 
 friends_bp = Blueprint("friends", __name__)
 
@@ -10,6 +13,14 @@ def get_current_user_id():
     # Return as int for DB operations
     return int(get_jwt_identity())
 
+def are_friends(user_id, other_id):
+    """Whether the two users have an accepted friend request in either direction"""
+    return db.session.query(FriendRequest.query.filter(
+        (FriendRequest.status == 'accepted') &
+        (((FriendRequest.sender_id == user_id) & (FriendRequest.receiver_id == other_id)) |
+         ((FriendRequest.sender_id == other_id) & (FriendRequest.receiver_id == user_id)))
+    ).exists()).scalar()
+
 # -----------------------------------------------------------------
 # 1. SEND REQUEST (Supports ID, email, username, or registration_number)
 # -----------------------------------------------------------------
@@ -84,15 +95,19 @@ def send_friend_request():
 # -----------------------------------------------------------------
 @friends_bp.get("/pending")
 @jwt_required()
+@query_budget(1)
 def get_pending_requests():
     user_id = get_current_user_id()
     
     # Filter for requests where user is the receiver AND status is 'pending'
-    pending_requests = FriendRequest.query.filter_by(receiver_id=user_id, status='pending').all()
+    # joined with its sender in the same query (outer join: the user may be gone)
+    pending_requests = db.session.query(FriendRequest, User)\
+        .outerjoin(User, User.id == FriendRequest.sender_id)\
+        .filter(FriendRequest.receiver_id == user_id, FriendRequest.status == 'pending')\
+        .order_by(FriendRequest.id).all()
     
     requests_list = []
-    for req in pending_requests:
-        sender = User.query.get(req.sender_id)
+    for req, sender in pending_requests:
         requests_list.append({
             "request_id": req.id,
             "sender_id": req.sender_id,
@@ -108,15 +123,19 @@ def get_pending_requests():
 # -----------------------------------------------------------------
 @friends_bp.get("/outgoing")
 @jwt_required()
+@query_budget(1)
 def get_outgoing_requests():
     user_id = get_current_user_id()
     
     # Filter for requests where user is the sender AND status is 'pending'
-    outgoing_requests = FriendRequest.query.filter_by(sender_id=user_id, status='pending').all()
+    # joined with its receiver in the same query (outer join: the user may be gone)
+    outgoing_requests = db.session.query(FriendRequest, User)\
+        .outerjoin(User, User.id == FriendRequest.receiver_id)\
+        .filter(FriendRequest.sender_id == user_id, FriendRequest.status == 'pending')\
+        .order_by(FriendRequest.id).all()
     
     requests_list = []
-    for req in outgoing_requests:
-        receiver = User.query.get(req.receiver_id)
+    for req, receiver in outgoing_requests:
         requests_list.append({
             "request_id": req.id,
             "receiver_id": req.receiver_id,
@@ -220,50 +239,78 @@ def accept_friend_request():
 # -----------------------------------------------------------------
 @friends_bp.get("/list")
 @jwt_required()
+@query_budget(1)
 def get_friends_list():
     user_id = get_current_user_id()
 
     # Query for all accepted friend requests where the user is either sender or receiver
-    friends_query = FriendRequest.query.filter(
+    # joined with the other person in the pair, so one query covers every friend
+    friend_id = case((FriendRequest.sender_id == user_id, FriendRequest.receiver_id), else_=FriendRequest.sender_id)
+    friends_query = db.session.query(User)\
+        .join(FriendRequest, User.id == friend_id)\
+        .filter(
+            ((FriendRequest.sender_id == user_id) | (FriendRequest.receiver_id == user_id)) &
+            (FriendRequest.status == 'accepted')
+        ).order_by(FriendRequest.id).all()
+
+    friends_data = [{
+        "id": friend.id,
+        "display_name": friend.display_name,
+        "avatar_url": friend.avatar_url,
+        "email": friend.email
+    } for friend in friends_query]
+
+    return jsonify(friends_data), 200
+
+# -----------------------------------------------------------------
+# 7b. BULK PRESENCE (friends, optionally narrowed with ?ids=1,2,3)
+# -----------------------------------------------------------------
+MAX_PRESENCE_IDS = 500
+
+@friends_bp.get("/presence")
+@jwt_required()
+@query_budget(2)  # Friends, then last_seen of those offline
+def get_presence():
+    user_id = get_current_user_id()
+
+    ids = request.args.get("ids")
+    if ids:
+        try:
+            requested = {int(i) for i in ids.split(",") if i.strip()}
+        except ValueError:
+            return jsonify({"error": "ids must be comma-separated integers"}), 400
+        if len(requested) > MAX_PRESENCE_IDS:
+            return jsonify({"error": f"At most {MAX_PRESENCE_IDS} ids per request"}), 400
+
+    pairs = db.session.query(FriendRequest.sender_id, FriendRequest.receiver_id).filter(
         ((FriendRequest.sender_id == user_id) | (FriendRequest.receiver_id == user_id)) &
         (FriendRequest.status == 'accepted')
     ).all()
+    user_ids = {s if r == user_id else r for s, r in pairs}
+    if ids:
+        user_ids &= requested  # Only friends' presence is visible; other ids are dropped
 
-    friends_data = []
-    
-    for req in friends_query:
-        # Determine who the friend is (the other person in the pair)
-        if req.sender_id == user_id:
-            friend_id = req.receiver_id
-        else:
-            friend_id = req.sender_id
-            
-        friend = User.query.get(friend_id)
-        
-        if friend:
-            friends_data.append({
-                "id": friend.id,
-                "display_name": friend.display_name,
-                "avatar_url": friend.avatar_url,
-                "email": friend.email
-            })
-
-    return jsonify(friends_data), 200
+    # JSON object keys are strings
+    return jsonify({str(uid): p for uid, p in presence.lookup(user_ids).items()}), 200
 
 # -----------------------------------------------------------------
 # 8. LIST IGNORED/REJECTED REQUESTS
 # -----------------------------------------------------------------
 @friends_bp.get("/ignored")
 @jwt_required()
+@query_budget(1)
 def get_ignored_requests():
     user_id = get_current_user_id()
     
     # Filter for requests where user is the receiver AND status is 'rejected'
-    ignored_requests = FriendRequest.query.filter_by(receiver_id=user_id, status='rejected').all()
+    # joined with its sender in the same query (outer join: the user may be gone)
+    ignored_requests = db.session.query(FriendRequest, User)\
+        .outerjoin(User, User.id == FriendRequest.sender_id)\
+        .filter(FriendRequest.receiver_id == user_id, FriendRequest.status == 'rejected')\
+        .order_by(FriendRequest.id).all()
     
     requests_list = []
-    for req in ignored_requests:
-        sender = User.query.get(req.sender_id)
+    for req, sender in ignored_requests:
         requests_list.append({
             "request_id": req.id,
             "sender_id": req.sender_id,
@@ -1,7 +1,14 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import User, Group, GroupMember, GroupMessage, ClassMember
+from models import User, Group, GroupMember, GroupMessage, ClassMember, MessageTombstone
 from database import db
+from attachments import read_upload_fields, store_request_uploads, resolve_file, open_attachment, refresh_urls, UploadTooLarge
+from inbox import record_group_message, record_delete, mark_read, forget_group
+from write_behind import write_behind
+from tombstones import latest_tombstone_id, cursor_expired
+from cascade import deleting
+from query_audit import query_budget
+from room_cache import recent_messages, group_room
 from datetime import datetime
 import sys
 import os
@@ -11,6 +18,10 @@ import base64
 
 groups_bp = Blueprint("groups", __name__)
 
+# Group history page size (keyset pagination)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
 # --- Group Management ---
 
 @groups_bp.post("/create")
@@ -30,6 +41,8 @@ def create_group():
         membership = ClassMember.query.filter_by(class_id=class_id, user_id=uid).first()
         if not membership or not membership.is_moderator:
             return jsonify({"error": "Must be class moderator to create groups"}), 403
+        if deleting(("class", class_id)):
+            return jsonify({"error": "Class is being deleted"}), 409
 
     new_group = Group(
         name=name,
@@ -50,24 +63,24 @@ def create_group():
 
 @groups_bp.get("/list")
 @jwt_required()
+@query_budget(1)
 def list_my_groups():
     uid = int(get_jwt_identity())
     
     # Query groups where user is a member
-    memberships = GroupMember.query.filter_by(user_id=uid).all()
-    groups = []
+    memberships = db.session.query(Group, GroupMember.is_admin)\
+        .join(GroupMember, GroupMember.group_id == Group.id)\
+        .filter(GroupMember.user_id == uid)\
+        .order_by(GroupMember.id).all()
     
-    for m in memberships:
-        g = Group.query.get(m.group_id)
-        if g:
-            groups.append({
-                "id": g.id,
-                "name": g.name,
-                "description": g.description,
-                "image": g.image_url,
-                "is_admin": m.is_admin,
-                "class_id": g.class_id  # Include parent class info
-            })
+    groups = [{
+        "id": g.id,
+        "name": g.name,
+        "description": g.description,
+        "image": g.image_url,
+        "is_admin": is_admin,
+        "class_id": g.class_id  # Include parent class info
+    } for g, is_admin in memberships]
             
     return jsonify({"groups": groups}), 200
 
@@ -130,6 +143,8 @@ def join_group():
         class_membership = ClassMember.query.filter_by(class_id=group.class_id, user_id=uid).first()
         if not class_membership:
             return jsonify({"error": "You must be a member of this class to join this group"}), 403
+        if deleting(("class", group.class_id)):
+            return jsonify({"error": "Class is being deleted"}), 409
         
         # Auto-join: Add user to group
         new_member = GroupMember(group_id=group_id, user_id=uid, is_admin=False)
@@ -142,6 +157,7 @@ def join_group():
 
 @groups_bp.get("/members/<int:group_id>")
 @jwt_required()
+@query_budget(2)
 def get_group_members(group_id):
     uid = int(get_jwt_identity())
     
@@ -149,21 +165,21 @@ def get_group_members(group_id):
     if not GroupMember.query.filter_by(group_id=group_id, user_id=uid).first():
         return jsonify({"error": "Access denied"}), 403
         
-    members = GroupMember.query.filter_by(group_id=group_id).all()
-    results = []
+    # Members with their users in one join
+    members = db.session.query(GroupMember, User)\
+        .join(User, User.id == GroupMember.user_id)\
+        .filter(GroupMember.group_id == group_id)\
+        .order_by(GroupMember.id).all()
     
-    for m in members:
-        u = User.query.get(m.user_id)
-        if u:
-            results.append({
-                "id": u.id,
-                "name": u.display_name,
-                "email": u.email,
-                "avatar": u.avatar_url,
-                "role": u.role,
-                "is_admin": m.is_admin,
-                "joined_at": m.joined_at.isoformat()
-            })
+    results = [{
+        "id": u.id,
+        "name": u.display_name,
+        "email": u.email,
+        "avatar": u.avatar_url,
+        "role": u.role,
+        "is_admin": m.is_admin,
+        "joined_at": m.joined_at.isoformat()
+    } for m, u in members]
             
     return jsonify({"members": results}), 200
 
@@ -179,25 +195,138 @@ def get_messages(group_id):
     if not membership:
         return jsonify({"error": "Access denied"}), 403
 
-    msgs = GroupMessage.query.filter_by(group_id=group_id).order_by(GroupMessage.timestamp.asc()).all()
+    limit = min(max(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    before_id = request.args.get("before_id", type=int)
+
+    # Read the tombstone cursor first so deletions racing this request are re-sent
+    since_deleted = latest_tombstone_id()
+
+    # The newest page of a recently active group is served from memory
+    room = group_room(group_id)
+    cached = recent_messages.page(room, limit) if before_id is None else None
+    if cached:
+        messages, has_more = cached
+        return history_response(uid, group_id, refresh_urls(messages), has_more, since_deleted)
+    generation = recent_messages.generation(room)
+
+    query = GroupMessage.query.filter_by(group_id=group_id)
+
+    # Keyset cursor on (timestamp, id): everything strictly older than the anchor
+    if before_id is not None:
+        anchor = GroupMessage.query.get(before_id)
+        if anchor and anchor.timestamp:
+            query = query.filter(
+                (GroupMessage.timestamp < anchor.timestamp) |
+                ((GroupMessage.timestamp == anchor.timestamp) & (GroupMessage.id < before_id))
+            )
+        else:
+            # Anchor was deleted; ids grow with time so they still bound the page
+            query = query.filter(GroupMessage.id < before_id)
+
+    # Newest page first, one extra row tells us whether an older page exists
+    page = query.order_by(GroupMessage.timestamp.desc(), GroupMessage.id.desc()).limit(limit + 1).all()
+    has_more = len(page) > limit
+    msgs = page[:limit][::-1]
+    messages = serialize_group_messages(msgs)
+
+    if before_id is not None:
+        return jsonify({
+            "messages": messages,
+            "has_more": has_more,
+            "next_before_id": messages[0]["id"] if has_more else None
+        }), 200
+
+    recent_messages.fill(room, [((m.timestamp, m.id), p) for m, p in zip(msgs, messages)], has_more, generation)
+    return history_response(uid, group_id, messages, has_more, since_deleted)
+
+def history_response(uid, group_id, messages, has_more, since_deleted):
+    """First history page, with the sync cursor; opening the group reads it"""
+    if mark_read(uid, "group", group_id):
+        db.session.commit()
+
+    return jsonify({
+        "messages": messages,
+        "has_more": has_more,
+        "next_before_id": messages[0]["id"] if has_more else None,
+        "sync": {
+            "since_id": write_behind.hold_cursor(max((m["id"] for m in messages), default=0)),
+            "since_deleted": since_deleted
+        }
+    }), 200
+
+@groups_bp.get("/messages/<int:group_id>/sync")
+@jwt_required()
+def sync_messages(group_id):
+    """Return only what changed in a group since the client's last sync cursor"""
+    uid = int(get_jwt_identity())
     
+    # Check membership
+    membership = GroupMember.query.filter_by(group_id=group_id, user_id=uid).first()
+    if not membership:
+        return jsonify({"error": "Access denied"}), 403
+
+    since_id = request.args.get("since_id", 0, type=int)
+    since_deleted = request.args.get("since_deleted", 0, type=int)
+
+    # Deletions before the tombstone horizon are gone; the client must reload history
+    if cursor_expired(since_deleted):
+        return jsonify({"error": "Sync cursor expired", "resync": True}), 410
+
+    next_deleted = latest_tombstone_id()
+
+    msgs = GroupMessage.query.filter(
+        (GroupMessage.group_id == group_id) & (GroupMessage.id > since_id)
+    ).order_by(GroupMessage.id.asc()).all()
+
+    deleted = MessageTombstone.query.filter(
+        (MessageTombstone.chat_type == "group") &
+        (MessageTombstone.group_id == group_id) &
+        (MessageTombstone.id > since_deleted)
+    ).all()
+
+    if msgs:
+        # The open chat just received these, so they are read
+        if mark_read(uid, "group", group_id):
+            db.session.commit()
+
+    return jsonify({
+        "messages": serialize_group_messages(msgs),
+        "deleted": [t.message_id for t in deleted],
+        "sync": {
+            "since_id": write_behind.hold_cursor(max((m.id for m in msgs), default=since_id)),
+            "since_deleted": max(next_deleted, since_deleted)
+        }
+    }), 200
+
+def serialize_group_messages(msgs):
+    """Serialize a page of group messages with batched sender and reply lookups"""
+    # One IN query for reply targets not already on the page
+    by_id = {m.id: m for m in msgs}
+    missing_replies = {m.reply_to_id for m in msgs if m.reply_to_id and m.reply_to_id not in by_id}
+    if missing_replies:
+        for r in GroupMessage.query.filter(GroupMessage.id.in_(missing_replies)).all():
+            by_id[r.id] = r
+
+    # One IN query for every sender on the page and behind its replies
+    sender_ids = {m.sender_id for m in by_id.values()}
+    users = {u.id: u for u in User.query.filter(User.id.in_(sender_ids)).all()} if sender_ids else {}
+
     results = []
     for m in msgs:
-        sender = User.query.get(m.sender_id)
+        sender = users.get(m.sender_id)
         
         # Get reply-to message if exists
         reply_data = None
-        if m.reply_to_id:
-            reply_msg = GroupMessage.query.get(m.reply_to_id)
-            if reply_msg:
-                reply_sender = User.query.get(reply_msg.sender_id)
-                reply_data = {
-                    "id": reply_msg.id,
-                    "text": reply_msg.text,
-                    "sender_name": reply_sender.display_name if reply_sender else "Unknown",
-                    "has_voice": bool(reply_msg.voice_data),
-                    "has_file": bool(reply_msg.file_data)
-                }
+        reply_msg = by_id.get(m.reply_to_id) if m.reply_to_id else None
+        if reply_msg:
+            reply_sender = users.get(reply_msg.sender_id)
+            reply_data = {
+                "id": reply_msg.id,
+                "text": reply_msg.text,
+                "sender_name": reply_sender.display_name if reply_sender else "Unknown",
+                "has_voice": reply_msg.has_voice,
+                "has_file": reply_msg.has_file
+            }
         
         results.append({
             "id": m.id,
@@ -206,26 +335,43 @@ def get_messages(group_id):
             "sender_name": sender.display_name if sender else "Unknown",
             "sender_avatar": sender.avatar_url if sender else "",
             "time": m.timestamp.isoformat(),
-            "file_data": m.file_data,
+            # Blobs are deferred: legacy inline ones are fetched via /messages/<id>/attachment
+            "file_data": resolve_file(m.file_ref, mime_type=m.file_type),
+            "has_file": m.has_file,
             "file_name": m.file_name,
             "file_type": m.file_type,
-            "voice_data": m.voice_data,
+            "file_size": m.file_size,
+            "voice_data": resolve_file(m.voice_ref),
+            "has_voice": m.has_voice,
             "voice_duration": m.voice_duration,
             "reply_to": reply_data
         })
 
-    return jsonify({"messages": results}), 200
+    return results
 
 @groups_bp.post("/send")
 @jwt_required()
 def send_message():
+    """Send to a group; attachments may be multipart parts, a raw body, or legacy base64 JSON"""
     uid = int(get_jwt_identity())
-    data = request.json
     
-    group_id = data.get("group_id")
+    # Text fields only (size-checked up front); nothing is stored before the checks below
+    try:
+        data = read_upload_fields(("file", "voice"))
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        # Form and query fields arrive as strings
+        group_id = int(data["group_id"])
+        voice_duration = int(data["voice_duration"]) if data.get("voice_duration") else None
+        reply_to_id = int(data["reply_to_id"]) if data.get("reply_to_id") else None
+    except (TypeError, KeyError, ValueError):
+        return jsonify({"error": "Invalid request body"}), 400
+
     text = data.get("message")
-    file_data = data.get("file_data")
-    file_type = data.get("file_type")
     
     # --- ML CONTENT MODERATION - REMOVED ---
     # moderator.initialize() # Ensure models are loaded
@@ -257,20 +403,30 @@ def send_message():
     if not membership:
         return jsonify({"error": "Access denied"}), 403
 
+    # Stream attachment bytes into the content-addressed store once the request is allowed
+    try:
+        refs = store_request_uploads(data, ("file", "voice"))
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     msg = GroupMessage(
         group_id=group_id,
         sender_id=uid,
         text=text,
-        file_data=data.get("file_data"),
+        file_ref=refs["file"],
         file_name=data.get("file_name"),
         file_type=data.get("file_type"),
-        voice_data=data.get("voice_data"),
-        voice_duration=data.get("voice_duration"),
-        reply_to_id=data.get("reply_to_id")
+        voice_ref=refs["voice"],
+        voice_duration=voice_duration,
+        reply_to_id=reply_to_id
     )
     
     db.session.add(msg)
+    record_group_message(msg)
     db.session.commit()
+    recent_messages.append(group_room(group_id), (msg.timestamp, msg.id), serialize_group_messages([msg])[0])
     
 
     return jsonify({"message": "Sent", "id": msg.id}), 201
@@ -319,15 +475,37 @@ def remove_member(group_id, user_id):
         return jsonify({"error": "Member not found"}), 404
         
     db.session.delete(member_to_remove)
+    forget_group(group_id, user_id)
     db.session.commit()
     return jsonify({"message": "Member removed"}), 200
 
+@groups_bp.get("/messages/<int:message_id>/attachment")
+@jwt_required()
+def group_message_attachment(message_id):
+    """Resolve a group message's file or voice note when the user opens it"""
+    uid = int(get_jwt_identity())
+
+    kind = request.args.get("kind", "file")
+    if kind not in ("file", "voice"):
+        return jsonify({"error": "kind must be 'file' or 'voice'"}), 400
+
+    msg = GroupMessage.query.get(message_id)
+    if not msg:
+        return jsonify({"error": "Message not found"}), 404
+
+    if not GroupMember.query.filter_by(group_id=msg.group_id, user_id=uid).first():
+        return jsonify({"error": "Access denied"}), 403
+
+    return jsonify({"url": open_attachment(msg, kind)}), 200
+
 @groups_bp.delete("/messages/<int:message_id>")
 @jwt_required()
 def delete_group_message(message_id):
     """Delete a group message (only sender can delete)"""
     uid = int(get_jwt_identity())
     
+    if write_behind.enabled:
+        write_behind.flush()  # The message may still be queued or in flight
     msg = GroupMessage.query.get(message_id)
     if not msg:
         return jsonify({"error": "Message not found"}), 404
@@ -336,6 +514,13 @@ def delete_group_message(message_id):
     if msg.sender_id != uid:
         return jsonify({"error": "Unauthorized"}), 403
     
+    db.session.add(MessageTombstone(
+        chat_type="group",
+        message_id=msg.id,
+        sender_id=msg.sender_id,
+        group_id=msg.group_id
+    ))
+    record_delete(msg, "group")
     db.session.delete(msg)
     db.session.commit()
     
@@ -0,0 +1,19 @@
+from flask import Blueprint, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from models import CascadeJob
+from database import db
+from cascade import job_status
+
+jobs_bp = Blueprint("jobs", __name__)
+
+@jobs_bp.get("/<int:job_id>")
+@jwt_required()
+def get_job(job_id):
+    """Progress of a background delete job (requester only)"""
+    uid = int(get_jwt_identity())
+
+    job = db.session.get(CascadeJob, job_id)
+    if not job or job.requested_by != uid:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify(job_status(job)), 200
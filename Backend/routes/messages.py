@@ -1,7 +1,15 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import Message, User
+from models import Message, MessageTombstone, User, Conversation, Group, GroupMember, GroupMessage
 from database import db
+from attachments import read_upload_fields, store_request_uploads, resolve_file, open_attachment, refresh_urls, UploadTooLarge
+from inbox import record_dm, record_delete, mark_read
+from search import search_messages
+from write_behind import write_behind
+from tombstones import latest_tombstone_id, cursor_expired
+from routes.friends import are_friends
+from query_audit import query_budget
+from room_cache import recent_messages, dm_room
 import sys
 import os
 import base64
@@ -12,22 +20,34 @@ import base64
 
 messages_bp = Blueprint("messages", __name__)
 
+# Chat history page size (keyset pagination)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Search result paging (ranked, so offset-based)
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_OFFSET = 1000
+
 @messages_bp.post("/send")
 @jwt_required()
 def send_msg():
+    """Send a DM; attachments may be multipart parts, a raw body, or legacy base64 JSON"""
     uid = int(get_jwt_identity())
     
+    # Text fields only (size-checked up front); nothing is stored before the checks below
     try:
-        data = request.json
+        data = read_upload_fields(("file", "voice"))
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        # Form and query fields arrive as strings
         receiver_id = int(data["receiver_id"])
-        message_content = data.get("message", "")
-        
-        # File upload fields (optional)
-        file_data = data.get("file_data")
-        file_name = data.get("file_name")
-        file_type = data.get("file_type")
-        file_category = data.get("file_category")
-        
+        voice_duration = int(data["voice_duration"]) if data.get("voice_duration") else None
+        reply_to_id = int(data["reply_to_id"]) if data.get("reply_to_id") else None
     except (TypeError, KeyError, ValueError):
         return jsonify({"error": "Invalid request body"}), 400
 
@@ -36,12 +56,19 @@ def send_msg():
     if not receiver:
         return jsonify({"error": "Receiver not found"}), 404
 
-    # Validate file size (5MB limit for base64)
-    if file_data:
-        # Base64 encoded size is ~4/3 of original
-        # 5MB * 1.33 = ~6.65MB base64
-        if len(file_data) > 6_650_000:
-            return jsonify({"error": "File too large. Maximum size is 5MB"}), 400
+    # Stream attachment bytes into the content-addressed store once the request is allowed
+    try:
+        refs = store_request_uploads(data, ("file", "voice"))
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    message_content = data.get("message", "")
+    file_ref, voice_ref = refs["file"], refs["voice"]
+    file_name = data.get("file_name")
+    file_type = data.get("file_type")
+    file_category = data.get("file_category")
 
     # --- ML CONTENT MODERATION - REMOVED ---
     # moderator.initialize() # Ensure models are loaded
@@ -73,16 +100,18 @@ def send_msg():
         sender_id=uid,
         receiver_id=receiver_id,
         content=message_content,
-        file_data=file_data,
+        file_ref=file_ref,
         file_name=file_name,
         file_type=file_type,
         file_category=file_category,
-        voice_data=data.get("voice_data"),
-        voice_duration=data.get("voice_duration"),
-        reply_to_id=data.get("reply_to_id")
+        voice_ref=voice_ref,
+        voice_duration=voice_duration,
+        reply_to_id=reply_to_id
     )
     db.session.add(msg)
+    record_dm(msg)
     db.session.commit()
+    recent_messages.append(dm_room(uid, receiver_id), (msg.timestamp, msg.id), serialize_dm(msg))
 
     return jsonify({
         "message": "sent",
@@ -92,6 +121,7 @@ def send_msg():
 
 @messages_bp.get("/chat/<int:friend_id>")
 @jwt_required()
+@query_budget(7)  # Friend, tombstone cursor, page, replies, their senders, read state
 def chat_history(friend_id):
     uid = int(get_jwt_identity())
 
@@ -100,49 +130,189 @@ def chat_history(friend_id):
     if not friend:
         return jsonify({"error": "User not found"}), 404
 
-    history = Message.query.filter(
+    limit = min(max(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    before_id = request.args.get("before_id", type=int)
+
+    # Read the tombstone cursor first so deletions racing this request are re-sent
+    since_deleted = latest_tombstone_id()
+
+    # The newest page of a recently active chat is served from memory
+    room = dm_room(uid, friend_id)
+    cached = recent_messages.page(room, limit) if before_id is None else None
+    if cached:
+        messages, has_more = cached
+        return history_response(uid, friend_id, refresh_urls(messages), has_more, since_deleted)
+    generation = recent_messages.generation(room)
+
+    query = Message.query.filter(
         ((Message.sender_id == uid) & (Message.receiver_id == friend_id)) |
         ((Message.sender_id == friend_id) & (Message.receiver_id == uid))
-    ).order_by(Message.timestamp.asc()).all()
+    )
+
+    # Keyset cursor on (timestamp, id): everything strictly older than the anchor
+    if before_id is not None:
+        anchor = Message.query.get(before_id)
+        if anchor and anchor.timestamp:
+            query = query.filter(
+                (Message.timestamp < anchor.timestamp) |
+                ((Message.timestamp == anchor.timestamp) & (Message.id < before_id))
+            )
+        else:
+            # Anchor was deleted; ids grow with time so they still bound the page
+            query = query.filter(Message.id < before_id)
+
+    # Newest page first, one extra row tells us whether an older page exists
+    page = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    has_more = len(page) > limit
+    history = page[:limit][::-1]
+    messages = serialize_dms(history)
+
+    if before_id is not None:
+        return jsonify({
+            "messages": messages,
+            "has_more": has_more,
+            "next_before_id": messages[0]["id"] if has_more else None
+        }), 200
+
+    recent_messages.fill(room, [((m.timestamp, m.id), p) for m, p in zip(history, messages)], has_more, generation)
+    return history_response(uid, friend_id, messages, has_more, since_deleted)
+
+def history_response(uid, friend_id, messages, has_more, since_deleted):
+    """First history page, with the sync cursor; opening the conversation reads it"""
+    if mark_read(uid, "dm", friend_id):
+        db.session.commit()
 
     return jsonify({
-        "messages": [
-            {
-                "id": m.id,  # Include message ID
-                "from": m.sender_id, 
-                "text": m.content, 
-                "time": m.timestamp.isoformat() if m.timestamp else None,
-                "file_data": m.file_data,
-                "file_name": m.file_name,
-                "file_type": m.file_type,
-                "file_category": m.file_category,
-                "voice_data": m.voice_data,
-                "voice_duration": m.voice_duration,
-                "reply_to": get_reply_data_dm(m.reply_to_id) if m.reply_to_id else None
-            }
-            for m in history
-        ]
+        "messages": messages,
+        "has_more": has_more,
+        "next_before_id": messages[0]["id"] if has_more else None,
+        "sync": {
+            "since_id": write_behind.hold_cursor(max((m["id"] for m in messages), default=0)),
+            "since_deleted": since_deleted
+        }
     }), 200
 
-def get_reply_data_dm(reply_to_id):
-    """Helper to get reply message data for DMs"""
-    reply_msg = Message.query.get(reply_to_id)
-    if not reply_msg:
-        return None
-    sender = User.query.filter_by(id=reply_msg.sender_id).first()
-    return {
-        "id": reply_msg.id,
-        "text": reply_msg.content,
-        "sender_name": sender.display_name if sender else "Unknown",
-        "has_voice": bool(reply_msg.voice_data),
-        "has_file": bool(reply_msg.file_data)
-    }
+@messages_bp.get("/chat/<int:friend_id>/sync")
+@jwt_required()
+def chat_sync(friend_id):
+    """Return only what changed in a DM since the client's last sync cursor"""
+    uid = int(get_jwt_identity())
+
+    if not are_friends(uid, friend_id):
+        return jsonify({"error": "Friend not found"}), 404
+
+    since_id = request.args.get("since_id", 0, type=int)
+    since_deleted = request.args.get("since_deleted", 0, type=int)
+
+    # Deletions before the tombstone horizon are gone; the client must reload history
+    if cursor_expired(since_deleted):
+        return jsonify({"error": "Sync cursor expired", "resync": True}), 410
+
+    next_deleted = latest_tombstone_id()
+
+    new_msgs = Message.query.filter(
+        (((Message.sender_id == uid) & (Message.receiver_id == friend_id)) |
+         ((Message.sender_id == friend_id) & (Message.receiver_id == uid))) &
+        (Message.id > since_id)
+    ).order_by(Message.id.asc()).all()
+
+    deleted = MessageTombstone.query.filter(
+        (MessageTombstone.chat_type == "dm") &
+        (MessageTombstone.id > since_deleted) &
+        (((MessageTombstone.sender_id == uid) & (MessageTombstone.receiver_id == friend_id)) |
+         ((MessageTombstone.sender_id == friend_id) & (MessageTombstone.receiver_id == uid)))
+    ).all()
+
+    if new_msgs:
+        # The open chat just received these, so they are read
+        if mark_read(uid, "dm", friend_id):
+            db.session.commit()
+
+    return jsonify({
+        "messages": serialize_dms(new_msgs),
+        "deleted": [t.message_id for t in deleted],
+        "sync": {
+            "since_id": write_behind.hold_cursor(max((m.id for m in new_msgs), default=since_id)),
+            "since_deleted": max(next_deleted, since_deleted)
+        }
+    }), 200
+
+def serialize_dm(m):
+    return serialize_dms([m])[0]
+
+def serialize_dms(msgs):
+    """Serialize a page of DMs with batched reply lookups"""
+    # One IN query for reply targets not already on the page
+    by_id = {m.id: m for m in msgs}
+    missing_replies = {m.reply_to_id for m in msgs if m.reply_to_id and m.reply_to_id not in by_id}
+    if missing_replies:
+        for r in Message.query.filter(Message.id.in_(missing_replies)).all():
+            by_id[r.id] = r
+
+    # One IN query for the senders behind those replies
+    reply_sender_ids = {by_id[m.reply_to_id].sender_id for m in msgs if m.reply_to_id in by_id}
+    users = {u.id: u for u in User.query.filter(User.id.in_(reply_sender_ids)).all()} if reply_sender_ids else {}
+
+    results = []
+    for m in msgs:
+        reply_data = None
+        reply_msg = by_id.get(m.reply_to_id) if m.reply_to_id else None
+        if reply_msg:
+            reply_sender = users.get(reply_msg.sender_id)
+            reply_data = {
+                "id": reply_msg.id,
+                "text": reply_msg.content,
+                "sender_name": reply_sender.display_name if reply_sender else "Unknown",
+                "has_voice": reply_msg.has_voice,
+                "has_file": reply_msg.has_file
+            }
+
+        results.append({
+            "id": m.id,  # Include message ID
+            "from": m.sender_id, 
+            "text": m.content, 
+            "time": m.timestamp.isoformat() if m.timestamp else None,
+            # Blobs are deferred: legacy inline ones are fetched via /<id>/attachment
+            "file_data": resolve_file(m.file_ref, mime_type=m.file_type),
+            "has_file": m.has_file,
+            "file_name": m.file_name,
+            "file_type": m.file_type,
+            "file_size": m.file_size,
+            "file_category": m.file_category,
+            "voice_data": resolve_file(m.voice_ref),
+            "has_voice": m.has_voice,
+            "voice_duration": m.voice_duration,
+            "reply_to": reply_data
+        })
+
+    return results
+
+@messages_bp.get("/<int:message_id>/attachment")
+@jwt_required()
+def message_attachment(message_id):
+    """Resolve a message's file or voice note when the user opens it"""
+    uid = int(get_jwt_identity())
+
+    kind = request.args.get("kind", "file")
+    if kind not in ("file", "voice"):
+        return jsonify({"error": "kind must be 'file' or 'voice'"}), 400
+
+    msg = Message.query.get(message_id)
+    if not msg:
+        return jsonify({"error": "Message not found"}), 404
+
+    if uid not in (msg.sender_id, msg.receiver_id):
+        return jsonify({"error": "Unauthorized"}), 403
+
+    return jsonify({"url": open_attachment(msg, kind)}), 200
 
 @messages_bp.delete("/delete/<int:message_id>")
 @jwt_required()
 def delete_message(message_id):
     uid = int(get_jwt_identity())
     
+    if write_behind.enabled:
+        write_behind.flush()  # The message may still be queued or in flight
     msg = Message.query.get(message_id)
     
     if not msg:
@@ -151,7 +321,142 @@ def delete_message(message_id):
     if msg.sender_id != uid:
         return jsonify({"error": "Unauthorized"}), 403
         
+    db.session.add(MessageTombstone(
+        chat_type="dm",
+        message_id=msg.id,
+        sender_id=msg.sender_id,
+        receiver_id=msg.receiver_id
+    ))
+    record_delete(msg, "dm")
     db.session.delete(msg)
     db.session.commit()
     
     return jsonify({"message": "Message deleted"}), 200
+
+@messages_bp.get("/inbox")
+@jwt_required()
+def inbox():
+    """Sidebar summary: every conversation with its last message and unread count"""
+    uid = int(get_jwt_identity())
+
+    # One indexed read; peer/group names come from primary-key joins
+    rows = db.session.query(
+        Conversation,
+        User.display_name, User.avatar_url,
+        Group.name, Group.image_url
+    ).outerjoin(
+        User, (Conversation.chat_type == "dm") & (User.id == Conversation.chat_id)
+    ).outerjoin(
+        Group, (Conversation.chat_type == "group") & (Group.id == Conversation.chat_id)
+    ).filter(
+        Conversation.user_id == uid
+    ).order_by(Conversation.last_timestamp.desc()).all()
+
+    conversations = []
+    for conv, display_name, avatar_url, group_name, group_image in rows:
+        if conv.last_message_id is None or (display_name is None and group_name is None):
+            continue  # Emptied by deletes, or the peer/group no longer exists
+        conversations.append({
+            "chat_type": conv.chat_type,
+            "chat_id": conv.chat_id,
+            "name": display_name if conv.chat_type == "dm" else group_name,
+            "avatar_url": avatar_url if conv.chat_type == "dm" else group_image,
+            "last_message_id": conv.last_message_id,
+            "last_sender_id": conv.last_sender_id,
+            "preview": conv.preview,
+            "timestamp": conv.last_timestamp.isoformat() if conv.last_timestamp else None,
+            "unread_count": conv.unread_count
+        })
+
+    return jsonify({
+        "conversations": conversations,
+        "total_unread": sum(c["unread_count"] for c in conversations)
+    }), 200
+
+@messages_bp.post("/inbox/read")
+@jwt_required()
+def inbox_read():
+    """Clear the unread count of one conversation"""
+    uid = int(get_jwt_identity())
+    data = request.json
+
+    chat_type = data.get("chat_type")
+    if chat_type not in ("dm", "group"):
+        return jsonify({"error": "chat_type must be 'dm' or 'group'"}), 400
+    try:
+        chat_id = int(data["chat_id"])
+    except (TypeError, KeyError, ValueError):
+        return jsonify({"error": "chat_id is required"}), 400
+
+    if mark_read(uid, chat_type, chat_id):
+        db.session.commit()
+    return jsonify({"message": "Marked as read"}), 200
+
+@messages_bp.get("/search")
+@jwt_required()
+def search():
+    """Full-text search across the caller's DMs and groups (or one conversation)"""
+    uid = int(get_jwt_identity())
+
+    query = request.args.get("q", "").strip()
+    limit = min(max(request.args.get("limit", SEARCH_PAGE_SIZE, type=int), 1), MAX_SEARCH_PAGE_SIZE)
+    offset = min(max(request.args.get("offset", 0, type=int), 0), MAX_SEARCH_OFFSET)
+    chat_type = request.args.get("chat_type")
+    chat_id = request.args.get("chat_id", type=int)
+
+    # Scope: the caller's own DMs plus every group they are a member of
+    group_ids = [m.group_id for m in GroupMember.query.filter_by(user_id=uid).all()]
+    scope = [f"d{uid}"] + [f"g{gid}" for gid in group_ids]
+    required = None
+    if chat_type == "dm" and chat_id is not None:
+        scope, required = [f"d{uid}"], [f"d{chat_id}"]
+    elif chat_type == "group" and chat_id is not None:
+        if chat_id not in group_ids:
+            return jsonify({"error": "Access denied"}), 403
+        scope = [f"g{chat_id}"]
+
+    hits = search_messages(db.session.connection(), query, scope, limit + 1, offset, required)
+    if hits is None:
+        return jsonify({"error": "Query must contain at least one word"}), 400
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    # Hydrate hits with a few IN lookups (never one query per hit)
+    dm_ids = [message_id for kind, message_id, _ in hits if kind == "dm"]
+    group_msg_ids = [message_id for kind, message_id, _ in hits if kind == "group"]
+    dms = {m.id: m for m in Message.query.filter(Message.id.in_(dm_ids)).all()} if dm_ids else {}
+    group_msgs = {m.id: m for m in GroupMessage.query.filter(GroupMessage.id.in_(group_msg_ids)).all()} if group_msg_ids else {}
+    user_ids = ({m.sender_id for m in dms.values()} | {m.receiver_id for m in dms.values()} |
+                {m.sender_id for m in group_msgs.values()})
+    users = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+    group_names = {g.id: g.name for g in Group.query.filter(Group.id.in_({m.group_id for m in group_msgs.values()})).all()} if group_msgs else {}
+
+    results = []
+    for kind, message_id, snippet in hits:
+        msg = dms.get(message_id) if kind == "dm" else group_msgs.get(message_id)
+        if not msg:
+            continue  # Deleted outside the ORM
+        sender = users.get(msg.sender_id)
+        if kind == "dm":
+            conversation_id = msg.receiver_id if msg.sender_id == uid else msg.sender_id
+            peer = users.get(conversation_id)
+            conversation_name = peer.display_name if peer else None
+        else:
+            conversation_id = msg.group_id
+            conversation_name = group_names.get(msg.group_id)
+        results.append({
+            "chat_type": kind,
+            "chat_id": conversation_id,
+            "chat_name": conversation_name,
+            "message_id": message_id,
+            "sender_id": msg.sender_id,
+            "sender_name": sender.display_name if sender else "Unknown",
+            "snippet": snippet,
+            "timestamp": msg.timestamp.isoformat() if msg.timestamp else None
+        })
+
+    return jsonify({
+        "results": results,
+        "has_more": has_more,
+        "next_offset": offset + limit if has_more else None
+    }), 200
@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User
 from database import db
+from presence import presence
 
 profile_bp = Blueprint("profile", __name__)
 
@@ -47,5 +48,6 @@ def update_profile():
         user.avatar_url = data["avatar"]
 
     db.session.commit()
+    presence.update_profile(uid, user.display_name, user.avatar_url)
     
     return jsonify({"message": "updated"}), 200
@@ -0,0 +1,167 @@
+"""Full-text search over DM and group messages.
+
+SQLite uses an FTS5 virtual table; Postgres a plain table with a generated
+``tsvector`` column and GIN indexes. Each row is keyed by
+``message_id * 2 + kind`` (0 = DM, 1 = group) and carries scope tokens
+(``d<user>`` for both DM participants, ``g<group>`` for group messages), so
+a search only ever matches conversations the caller belongs to.
+
+Rows are written by mapper events inside the flush that inserts or deletes
+the message, so the index commits (or rolls back) with it.
+"""
+import html
+import re
+
+from sqlalchemy import bindparam, event, text
+
+from models import GroupMessage, Message
+
+KINDS = {"dm": 0, "group": 1}
+
+# Private-use characters mark hits in snippets; swapped for <mark> after escaping
+HIT_START, HIT_END = "\ue000", "\ue001"
+SNIPPET_WORDS = 16
+
+TERM_RE = re.compile(r"\w+")
+
+
+def search_key(chat_type, message_id):
+    return message_id * 2 + KINDS[chat_type]
+
+def split_key(key):
+    """Inverse of search_key: ``(chat_type, message_id)``"""
+    return ("group" if key % 2 else "dm"), key // 2
+
+def is_postgres(connection):
+    return connection.dialect.name == "postgresql"
+
+def create_search_index(connection):
+    """Create the search table if missing (idempotent)"""
+    if is_postgres(connection):
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS message_search (
+                id BIGINT PRIMARY KEY,
+                body TEXT NOT NULL,
+                scope TEXT[] NOT NULL,
+                document TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', body)) STORED
+            )
+        """))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_message_search_document ON message_search USING GIN (document)"))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_message_search_scope ON message_search USING GIN (scope)"))
+    else:
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS message_search "
+            "USING fts5(body, scope, tokenize='unicode61 remove_diacritics 2')"
+        ))
+
+def rebuild_search_index(connection):
+    """Re-index all existing message text in two set-based statements"""
+    connection.execute(text("DELETE FROM message_search"))
+    if is_postgres(connection):
+        dm_scope = "ARRAY['d' || sender_id, 'd' || receiver_id]"
+        group_scope = "ARRAY['g' || group_id]"
+        columns = "id, body, scope"
+    else:
+        dm_scope = "'d' || sender_id || ' d' || receiver_id"
+        group_scope = "'g' || group_id"
+        columns = "rowid, body, scope"
+    connection.execute(text(
+        f"INSERT INTO message_search ({columns}) "
+        f"SELECT id * 2, content, {dm_scope} FROM message WHERE content IS NOT NULL AND content != ''"
+    ))
+    connection.execute(text(
+        f"INSERT INTO message_search ({columns}) "
+        f"SELECT id * 2 + 1, text, {group_scope} FROM group_message WHERE text IS NOT NULL AND text != ''"
+    ))
+
+def index_message(connection, chat_type, message_id, body, tokens):
+    if not body:
+        return
+    params = {"id": search_key(chat_type, message_id), "body": body}
+    if is_postgres(connection):
+        connection.execute(text(
+            "INSERT INTO message_search (id, body, scope) VALUES (:id, :body, :scope) ON CONFLICT (id) DO NOTHING"
+        ), {**params, "scope": tokens})
+    else:
+        connection.execute(text(
+            "INSERT INTO message_search (rowid, body, scope) VALUES (:id, :body, :scope)"
+        ), {**params, "scope": " ".join(tokens)})
+
+def unindex_message(connection, chat_type, message_id):
+    column = "id" if is_postgres(connection) else "rowid"
+    connection.execute(text(f"DELETE FROM message_search WHERE {column} = :id"),
+                       {"id": search_key(chat_type, message_id)})
+
+def unindex_messages(connection, chat_type, message_ids):
+    """Set-based unindex_message, for bulk deletes that bypass the mapper events"""
+    column = "id" if is_postgres(connection) else "rowid"
+    connection.execute(
+        text(f"DELETE FROM message_search WHERE {column} IN :ids").bindparams(bindparam("ids", expanding=True)),
+        {"ids": [search_key(chat_type, i) for i in message_ids]}
+    )
+
+
+@event.listens_for(Message, "after_insert")
+def index_dm(mapper, connection, target):
+    index_message(connection, "dm", target.id, target.content,
+                  [f"d{target.sender_id}", f"d{target.receiver_id}"])
+
+@event.listens_for(GroupMessage, "after_insert")
+def index_group_message(mapper, connection, target):
+    index_message(connection, "group", target.id, target.text, [f"g{target.group_id}"])
+
+@event.listens_for(Message, "after_delete")
+def unindex_dm(mapper, connection, target):
+    unindex_message(connection, "dm", target.id)
+
+@event.listens_for(GroupMessage, "after_delete")
+def unindex_group_message(mapper, connection, target):
+    unindex_message(connection, "group", target.id)
+
+
+def search_messages(connection, query, scope_tokens, limit, offset=0, require_tokens=None):
+    """Ranked hits for ``query`` within any of ``scope_tokens``.
+
+    ``require_tokens`` narrows to a single conversation (all must match).
+    Returns ``[(chat_type, message_id, snippet_html)]`` best match first,
+    or None when the query has no searchable terms.
+    """
+    terms = TERM_RE.findall(query)
+    if not terms or not scope_tokens:
+        return None if not terms else []
+
+    if is_postgres(connection):
+        # Every term must match; the last one as a prefix for type-ahead
+        tsquery = " & ".join(terms[:-1] + [terms[-1] + ":*"])
+        scope_filter = "scope && CAST(:scope AS TEXT[])"
+        if require_tokens:
+            scope_filter += " AND scope @> CAST(:required AS TEXT[])"
+        rows = connection.execute(text(f"""
+            SELECT id, ts_headline('simple', body, q,
+                       'StartSel={HIT_START}, StopSel={HIT_END}, MaxWords={SNIPPET_WORDS}, MinWords=5')
+            FROM message_search, to_tsquery('simple', :tsquery) AS q
+            WHERE document @@ q AND {scope_filter}
+            ORDER BY ts_rank(document, q) DESC, id DESC
+            LIMIT :limit OFFSET :offset
+        """), {"tsquery": tsquery, "scope": list(scope_tokens), "required": list(require_tokens or []),
+               "limit": limit, "offset": offset}).fetchall()
+    else:
+        # Terms are \w+ only, so quoting them is enough to neutralise FTS5 syntax
+        quoted = [f'"{t}"' for t in terms]
+        quoted[-1] += "*"
+        match = f"{{body}}: ({' '.join(quoted)}) AND {{scope}}: ({' OR '.join(scope_tokens)})"
+        for token in require_tokens or []:
+            match += f" AND {{scope}}: {token}"
+        rows = connection.execute(text(f"""
+            SELECT rowid, snippet(message_search, 0, '{HIT_START}', '{HIT_END}', '…', {SNIPPET_WORDS})
+            FROM message_search
+            WHERE message_search MATCH :match
+            ORDER BY bm25(message_search), rowid DESC
+            LIMIT :limit OFFSET :offset
+        """), {"match": match, "limit": limit, "offset": offset}).fetchall()
+
+    return [(*split_key(key), render_snippet(snippet)) for key, snippet in rows]
+
+def render_snippet(snippet):
+    """HTML-escape message text, then turn hit markers into <mark> tags"""
+    return html.escape(snippet).replace(HIT_START, "<mark>").replace(HIT_END, "</mark>")
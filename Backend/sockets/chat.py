@@ -1,27 +1,91 @@
-from flask_socketio import emit, join_room, leave_room
-from models import Message, GroupMessage, GroupMember, User
+from flask import request
+from flask_jwt_extended import decode_token
+from flask_socketio import emit, join_room, leave_room, rooms, ConnectionRefusedError
+from models import Message, GroupMessage, GroupMember, ClassMember, User, MessageTombstone
 from database import db
+from attachments import store_upload, resolve_file
+from inbox import record_dm, record_group_message, record_delete
+from room_cache import recent_messages, dm_room, group_room
+from routes.messages import serialize_dm
+from routes.groups import serialize_group_messages
+from routes.friends import are_friends
+from write_behind import write_behind
+from presence import presence
+from subscriptions import room_subscriptions, group_socket_room
+from logs import get_logger
 from datetime import datetime
+import logging
 import sys
 import os
 import base64
 
 
+log = get_logger("sockets")
+
+
+def call_room(user_a, user_b):
+    """Room of a call between two users, derived from their ids (never taken from a client)"""
+    user_a, user_b = int(user_a), int(user_b)
+    return f"call_{min(user_a, user_b)}_{max(user_a, user_b)}"
+
+def can_join(user_id, room):
+    """Rooms a socket may join: ``call_<a>_<b>`` / ``chat_<a>_<b>`` naming it, and groups/classes it belongs to"""
+    if room.startswith(("call_", "chat_")):
+        parts = room.split("_")
+        return len(parts) == 3 and all(part.isdigit() for part in parts[1:]) and str(user_id) in parts[1:]
+    kind, _, room_id = room.partition("_")
+    if not room_id.isdigit():
+        return False
+    if kind == "group":
+        return GroupMember.query.filter_by(group_id=int(room_id), user_id=user_id).first() is not None
+    if kind == "class":
+        return ClassMember.query.filter_by(class_id=int(room_id), user_id=user_id).first() is not None
+    return False
+
 
 def register_socket_events(socketio):
 
+    @socketio.on("connect")
+    def connect(auth=None):
+        # Authenticate once; handlers read identity from the presence registry
+        token = (auth or {}).get("token") or request.args.get("token")
+        try:
+            user_id = int(decode_token(token)["sub"])
+        except Exception:
+            raise ConnectionRefusedError("Authentication required")
+        user = User.query.get(user_id)
+        if not user:
+            raise ConnectionRefusedError("Unknown user")
+        presence.connect(request.sid, user_id, user.display_name, user.avatar_url)
+        join_room(str(user_id))  # Personal room: calls and presence updates
+        room_subscriptions.subscribe_on_connect(request.sid, user_id)  # Every group and class room at once
+
+    @socketio.on("disconnect")
+    def disconnect(*args):
+        presence.disconnect(request.sid)
+
+    @socketio.on("heartbeat")
+    def heartbeat(data=None):
+        presence.user_of(request.sid)
 
     @socketio.on("join_room")
     def join(data):
-        room = data["room"]
+        room = str(data["room"])
+        if room == str(presence.user_of(request.sid)):
+            return  # Joined at connect
+        if room in rooms():
+            return  # Subscribed at connect or on joining the group/class
+        if not can_join(presence.user_of(request.sid), room):
+            emit("error", {"message": "Not allowed to join this room"})
+            return
         join_room(room)
-        print(f"User joined room: {room}")
+        log.event("room_joined", level=logging.DEBUG, room=room)
 
     @socketio.on("leave_room")
     def leave(data):
         room = data["room"]
         leave_room(room)
-        print(f"User left room: {room}")
+        log.event("room_left", level=logging.DEBUG, room=room)
 
     @socketio.on("send_message")
     def send_message(data):
@@ -55,46 +119,75 @@ def register_socket_events(socketio):
         #         print(f"Moderation Error for Image: {e}")
         #         pass # Fail open or closed? Let's proceed if check fails to avoid blocking valid images on error
 
+        sender_id = presence.user_of(request.sid)
+        try:
+            receiver_id = int(data["receiver"])
+        except (KeyError, TypeError, ValueError):
+            emit("error", {"message": "Invalid receiver"})
+            return
+        if not sender_id or not are_friends(sender_id, receiver_id):
+            emit("error", {"message": "Receiver not found"})
+            return
+
+        # Store attachment bytes once (binary frames or legacy base64);
+        # the room only receives the attachment URL
+        try:
+            file_ref = store_upload(data.get("file_data"), data.get("file_type"))
+            voice_ref = store_upload(data.get("voice_data"), data.get("voice_type"))
+        except ValueError as e:
+            emit("error", {"message": str(e)})
+            return
+
         # Save message to database
-        msg = Message(
-            sender_id=data["sender"],
-            receiver_id=data["receiver"],
+        fields = dict(
+            sender_id=sender_id,
+            receiver_id=receiver_id,
             content=data.get("text", ""),
-            file_data=data.get("file_data"),
+            file_ref=file_ref,
             file_name=data.get("file_name"),
             file_type=data.get("file_type"),
             file_category=data.get("file_category"),
-            voice_data=data.get("voice_data"),
+            voice_ref=voice_ref,
             voice_duration=data.get("voice_duration"),
             reply_to_id=data.get("reply_to_id")
         )
-        db.session.add(msg)
-        db.session.commit()
+        if write_behind.enabled:
+            # Journaled now, committed by the next group commit
+            msg_id, timestamp = write_behind.submit("dm", fields)
+        else:
+            msg = Message(**fields)
+            db.session.add(msg)
+            record_dm(msg)
+            db.session.commit()
+            recent_messages.append(dm_room(msg.sender_id, msg.receiver_id), (msg.timestamp, msg.id), serialize_dm(msg))
+            msg_id, timestamp = msg.id, msg.timestamp
 
-        # Broadcast to room (both sender and receiver will receive)
-        room = data["room"]
+        # Both participants' personal rooms; never a room named by the client
+        participants = [str(sender_id), str(receiver_id)]
         emit("new_message", {
-            "id": msg.id,
-            "from": data["sender"],
-            "to": data["receiver"],
+            "id": msg_id,
+            "from": sender_id,
+            "to": receiver_id,
             "text": data.get("text", ""),
-            "time": msg.timestamp.isoformat(),
-            "file_data": data.get("file_data"),
+            "time": timestamp.isoformat(),
+            "file_data": resolve_file(file_ref, mime_type=data.get("file_type")),
             "file_name": data.get("file_name"),
             "file_type": data.get("file_type"),
             "file_category": data.get("file_category"),
-            "voice_data": data.get("voice_data"),
+            "voice_data": resolve_file(voice_ref),
             "voice_duration": data.get("voice_duration"),
             "reply_to_id": data.get("reply_to_id")
-        }, room=room)
+        }, to=participants)
         
-        msg_preview = data.get('text', '')[:30] if data.get('text') else f"[File: {data.get('file_name', 'attachment')}]"
-        print(f"Message sent in room {room}: {msg_preview}...")
+        log.event("message_sent", msg_id=msg_id, receiver_id=receiver_id, attachment=bool(file_ref or voice_ref))
+
+        # Ack to the sender so it can render its own attachment without a refetch
+        return {"id": msg_id, "file_data": resolve_file(file_ref, mime_type=data.get("file_type")), "voice_data": resolve_file(voice_ref)}
 
     @socketio.on("send_group_message")
     def send_group_message(data):
         try:
-            sender_id = data.get("sender_id")
+            sender_id = presence.user_of(request.sid)
             group_id = data.get("group_id")
             text = data.get("message", "")
             file_data = data.get("file_data")
@@ -124,52 +217,72 @@ def register_socket_events(socketio):
             
             # Simple validation (production should be more robust)
             if not sender_id or not group_id:
-                print("Invalid group message data")
+                log.event("invalid_group_message", level=logging.WARNING)
+                return
+            if not GroupMember.query.filter_by(group_id=group_id, user_id=sender_id).first():
+                emit("error", {"message": "Not a member of this group"})
+                return
+
+            # Store attachment bytes once (binary frames or legacy base64);
+            # the room only receives the attachment URL
+            try:
+                file_ref = store_upload(file_data, file_type)
+                voice_ref = store_upload(data.get("voice_data"), data.get("voice_type"))
+            except ValueError as e:
+                emit("error", {"message": str(e)})
                 return
 
             # Save to DB
-            msg = GroupMessage(
+            fields = dict(
                 group_id=group_id,
                 sender_id=sender_id,
                 text=text,
-                file_data=data.get("file_data"),
+                file_ref=file_ref,
                 file_name=data.get("file_name"),
                 file_type=data.get("file_type"),
-                file_category=data.get("file_category"),
-                voice_data=data.get("voice_data"),
+                voice_ref=voice_ref,
                 voice_duration=data.get("voice_duration"),
                 reply_to_id=data.get("reply_to_id")
             )
-            db.session.add(msg)
-            db.session.commit()
+            if write_behind.enabled:
+                # Journaled now, committed by the next group commit
+                msg_id, timestamp = write_behind.submit("group", fields)
+            else:
+                msg = GroupMessage(**fields)
+                db.session.add(msg)
+                record_group_message(msg)
+                db.session.commit()
+                recent_messages.append(group_room(group_id), (msg.timestamp, msg.id), serialize_group_messages([msg])[0])
+                msg_id, timestamp = msg.id, msg.timestamp
             
-            # Get sender info for the client
-            sender = User.query.get(sender_id)
-            sender_name = sender.display_name if sender else "Unknown"
-            sender_avatar = sender.avatar_url if sender else ""
+            # Sender info for the client, cached at connect
+            sender_name, sender_avatar = presence.profile_of(sender_id)
             
             # Broadcast
             emit("new_group_message", {
-                "id": msg.id,
+                "id": msg_id,
                 "group_id": group_id,
                 "sender_id": sender_id,
                 "sender_name": sender_name,
                 "sender_avatar": sender_avatar,
                 "text": text,
-                "time": msg.timestamp.isoformat(),
-                "file_data": data.get("file_data"),
+                "time": timestamp.isoformat(),
+                "file_data": resolve_file(file_ref, mime_type=data.get("file_type")),
                 "file_name": data.get("file_name"),
                 "file_type": data.get("file_type"),
                 "file_category": data.get("file_category"),
-                "voice_data": data.get("voice_data"),
+                "voice_data": resolve_file(voice_ref),
                 "voice_duration": data.get("voice_duration"),
                 "reply_to_id": data.get("reply_to_id")
-            }, room=str(group_id))
+            }, room=group_socket_room(group_id))
             
-            print(f"Group message sent in room {group_id}")
+            log.event("group_message_sent", msg_id=msg_id, group_id=group_id)
+
+            # Ack to the sender so it can render its own attachment without a refetch
+            return {"id": msg_id, "file_data": resolve_file(file_ref, mime_type=data.get("file_type")), "voice_data": resolve_file(voice_ref)}
             
-        except Exception as e:
-            print(f"Error sending group message: {e}")
+        except Exception:
+            log.exception("Error sending group message")
             db.session.rollback()
 
     @socketio.on("delete_message")
@@ -177,26 +290,34 @@ def register_socket_events(socketio):
         """Real-time message deletion for DMs"""
         try:
             message_id = data.get("message_id")
-            user_id = data.get("user_id")
-            room = data.get("room")
+            user_id = presence.user_of(request.sid)
             
             if not message_id or not user_id:
                 return
             
+            if write_behind.enabled:
+                write_behind.flush()  # The message may still be queued or in flight
             msg = Message.query.get(message_id)
             if msg and msg.sender_id == user_id:
+                db.session.add(MessageTombstone(
+                    chat_type="dm",
+                    message_id=msg.id,
+                    sender_id=msg.sender_id,
+                    receiver_id=msg.receiver_id
+                ))
+                record_delete(msg, "dm")
                 db.session.delete(msg)
                 db.session.commit()
                 
-                # Broadcast deletion to room
+                # Broadcast deletion to both participants
                 emit("message_deleted", {
                     "message_id": message_id,
                     "chat_type": "dm"
-                }, room=room)
+                }, to=[str(msg.sender_id), str(msg.receiver_id)])
                 
-                print(f"Message {message_id} deleted in room {room}")
-        except Exception as e:
-            print(f"Error deleting message: {e}")
+                log.event("message_deleted", msg_id=message_id, receiver_id=msg.receiver_id)
+        except Exception:
+            log.exception("Error deleting message")
             db.session.rollback()
 
     @socketio.on("delete_group_message")
@@ -204,14 +325,23 @@ def register_socket_events(socketio):
         """Real-time message deletion for groups"""
         try:
             message_id = data.get("message_id")
-            user_id = data.get("user_id")
+            user_id = presence.user_of(request.sid)
             group_id = data.get("group_id")
             
             if not message_id or not user_id or not group_id:
                 return
             
+            if write_behind.enabled:
+                write_behind.flush()  # The message may still be queued or in flight
             msg = GroupMessage.query.get(message_id)
             if msg and msg.sender_id == user_id:
+                db.session.add(MessageTombstone(
+                    chat_type="group",
+                    message_id=msg.id,
+                    sender_id=msg.sender_id,
+                    group_id=msg.group_id
+                ))
+                record_delete(msg, "group")
                 db.session.delete(msg)
                 db.session.commit()
                 
@@ -219,11 +349,11 @@ def register_socket_events(socketio):
                 emit("message_deleted", {
                     "message_id": message_id,
                     "chat_type": "group"
-                }, room=str(group_id))
+                }, room=group_socket_room(group_id))
                 
-                print(f"Group message {message_id} deleted in group {group_id}")
-        except Exception as e:
-            print(f"Error deleting group message: {e}")
+                log.event("group_message_deleted", msg_id=message_id, group_id=group_id)
+        except Exception:
+            log.exception("Error deleting group message")
             db.session.rollback()
 
     # ===== WEBRTC AUDIO CALL SIGNALING =====
@@ -232,64 +362,59 @@ def register_socket_events(socketio):
     def call_initiate(data):
         """Initiate an audio call to another user"""
         try:
-            caller_id = data.get("caller_id")
+            caller_id = presence.user_of(request.sid)
             recipient_id = data.get("recipient_id")
-            caller_name = data.get("caller_name")
-            caller_avatar = data.get("caller_avatar")
+            caller_name, caller_avatar = presence.profile_of(caller_id)
             
             if not caller_id or not recipient_id:
                 return
             
-            # Create a unique room for this call
-            call_room = f"call_{min(caller_id, recipient_id)}_{max(caller_id, recipient_id)}"
-            
             # Notify recipient of incoming call
             emit("call_ringing", {
                 "caller_id": caller_id,
                 "caller_name": caller_name,
                 "caller_avatar": caller_avatar,
-                "call_room": call_room,
+                "call_room": call_room(caller_id, recipient_id),
                 "call_type": data.get("call_type", "audio")
             }, room=str(recipient_id))
             
-            print(f"Call initiated: {caller_id} -> {recipient_id}, room: {call_room}")
-        except Exception as e:
-            print(f"Error initiating call: {e}")
+            log.event("call_initiated", caller_id=caller_id, recipient_id=recipient_id)
+        except Exception:
+            log.exception("Error initiating call")
     
     @socketio.on("call_accept")
     def call_accept(data):
         """Accept an incoming call"""
         try:
             caller_id = data.get("caller_id")
-            recipient_id = data.get("recipient_id")
-            recipient_name = data.get("recipient_name")
-            recipient_avatar = data.get("recipient_avatar")
-            call_room = data.get("call_room")
+            recipient_id = presence.user_of(request.sid)
+            recipient_name, recipient_avatar = presence.profile_of(recipient_id)
             
-            if not caller_id or not recipient_id or not call_room:
+            if not caller_id or not recipient_id:
                 return
             
-            # Join both users to the call room
-            join_room(call_room)
+            # The room follows from the two ids; a client-supplied name is ignored
+            room = call_room(caller_id, recipient_id)
+            join_room(room)
             
             # Notify caller that call was accepted
             emit("call_accepted", {
                 "recipient_id": recipient_id,
                 "recipient_name": recipient_name,
                 "recipient_avatar": recipient_avatar,
-                "call_room": call_room
+                "call_room": room
             }, room=str(caller_id))
             
-            print(f"Call accepted: {caller_id} <-> {recipient_id}, room: {call_room}")
-        except Exception as e:
-            print(f"Error accepting call: {e}")
+            log.event("call_accepted", caller_id=caller_id, recipient_id=recipient_id, room=room)
+        except Exception:
+            log.exception("Error accepting call")
     
     @socketio.on("call_reject")
     def call_reject(data):
         """Reject an incoming call"""
         try:
             caller_id = data.get("caller_id")
-            recipient_id = data.get("recipient_id")
+            recipient_id = presence.user_of(request.sid)
             
             if not caller_id or not recipient_id:
                 return
@@ -299,25 +424,25 @@ def register_socket_events(socketio):
                 "recipient_id": recipient_id
             }, room=str(caller_id))
             
-            print(f"Call rejected: {caller_id} -> {recipient_id}")
-        except Exception as e:
-            print(f"Error rejecting call: {e}")
+            log.event("call_rejected", caller_id=caller_id, recipient_id=recipient_id)
+        except Exception:
+            log.exception("Error rejecting call")
     
     @socketio.on("call_end")
     def call_end(data):
         """End an active call"""
         try:
-            user_id = data.get("user_id")
+            user_id = presence.user_of(request.sid)
             peer_id = data.get("peer_id")
-            call_room = data.get("call_room")
             
-            if not user_id or not peer_id or not call_room:
+            if not user_id or not peer_id:
                 return
+            room = call_room(user_id, peer_id)
             
             # Notify peer that call ended (broadcast to room AND specific peer to be safe)
             emit("call_ended", {
                 "user_id": user_id
-            }, room=call_room)
+            }, room=room)
             
             if peer_id:
                 emit("call_ended", {
@@ -325,11 +450,11 @@ def register_socket_events(socketio):
                 }, room=str(peer_id))
             
             # Leave the call room
-            leave_room(call_room)
+            leave_room(room)
             
-            print(f"Call ended: {user_id} with {peer_id}, room: {call_room}")
-        except Exception as e:
-            print(f"Error ending call: {e}")
+            log.event("call_ended", user_id=user_id, peer_id=peer_id, room=room)
+        except Exception:
+            log.exception("Error ending call")
     
     @socketio.on("webrtc_offer")
     def webrtc_offer(data):
@@ -337,7 +462,7 @@ def register_socket_events(socketio):
         try:
             offer = data.get("offer")
             recipient_id = data.get("recipient_id")
-            caller_id = data.get("caller_id")
+            caller_id = presence.user_of(request.sid)
             
             if not offer or not recipient_id or not caller_id:
                 return
@@ -348,9 +473,9 @@ def register_socket_events(socketio):
                 "caller_id": caller_id
             }, room=str(recipient_id))
             
-            print(f"WebRTC offer forwarded: {caller_id} -> {recipient_id}")
-        except Exception as e:
-            print(f"Error forwarding WebRTC offer: {e}")
+            log.event("webrtc_offer", level=logging.DEBUG, caller_id=caller_id, recipient_id=recipient_id)
+        except Exception:
+            log.exception("Error forwarding WebRTC offer")
     
     @socketio.on("webrtc_answer")
     def webrtc_answer(data):
@@ -358,7 +483,7 @@ def register_socket_events(socketio):
         try:
             answer = data.get("answer")
             caller_id = data.get("caller_id")
-            recipient_id = data.get("recipient_id")
+            recipient_id = presence.user_of(request.sid)
             
             if not answer or not caller_id or not recipient_id:
                 return
@@ -369,9 +494,9 @@ def register_socket_events(socketio):
                 "recipient_id": recipient_id
             }, room=str(caller_id))
             
-            print(f"WebRTC answer forwarded: {recipient_id} -> {caller_id}")
-        except Exception as e:
-            print(f"Error forwarding WebRTC answer: {e}")
+            log.event("webrtc_answer", level=logging.DEBUG, caller_id=caller_id, recipient_id=recipient_id)
+        except Exception:
+            log.exception("Error forwarding WebRTC answer")
     
     @socketio.on("webrtc_ice_candidate")
     def webrtc_ice_candidate(data):
@@ -379,7 +504,7 @@ def register_socket_events(socketio):
         try:
             candidate = data.get("candidate")
             peer_id = data.get("peer_id")
-            sender_id = data.get("sender_id")
+            sender_id = presence.user_of(request.sid)
             
             if not candidate or not peer_id or not sender_id:
                 return
@@ -390,6 +515,6 @@ def register_socket_events(socketio):
                 "sender_id": sender_id
             }, room=str(peer_id))
             
-            print(f"ICE candidate forwarded: {sender_id} -> {peer_id}")
-        except Exception as e:
-            print(f"Error forwarding ICE candidate: {e}")
+            log.event("ice_candidate", level=logging.DEBUG, sender_id=sender_id, peer_id=peer_id)
+        except Exception:
+            log.exception("Error forwarding ICE candidate")
@@ -0,0 +1,101 @@
+"""Server-side Socket.IO room subscriptions for groups and classes.
+
+On connect a socket joins every group and class room of its user, looked up
+in one query, so clients never emit ``join_room`` per chat (or again after
+each reconnect). Memberships added or removed through the ORM anywhere
+(``GroupMember`` / ``ClassMember`` rows) are applied to the user's open
+sockets when the transaction commits, on every worker when a message queue
+is configured. Bulk statements bypass the session: callers of bulk deletes
+close those rooms explicitly with ``close()``, and bulk inserts register
+their memberships with ``defer_membership_changes()``.
+
+Group and class rooms are prefixed so they never collide with personal
+rooms, which are the bare user id.
+"""
+from sqlalchemy import event, literal, select, union_all
+from sqlalchemy.orm import Session
+
+from database import db
+from models import ClassMember, GroupMember
+from presence import presence
+
+
+def group_socket_room(group_id):
+    return f"group_{group_id}"
+
+def class_socket_room(class_id):
+    return f"class_{class_id}"
+
+def member_rooms(user_id):
+    """Every group and class room of a user, in one query"""
+    rows = db.session.execute(union_all(
+        select(literal("group"), GroupMember.group_id).where(GroupMember.user_id == user_id),
+        select(literal("class"), ClassMember.class_id).where(ClassMember.user_id == user_id),
+    )).all()
+    return [group_socket_room(i) if kind == "group" else class_socket_room(i) for kind, i in rows]
+
+
+class RoomSubscriptions:
+    def __init__(self):
+        self._socketio = None
+        self.publish = None  # Forwards membership changes to other workers (see pubsub.py)
+
+    def init_app(self, app, socketio):
+        self._socketio = socketio
+        app.extensions["room_subscriptions"] = self
+
+    def subscribe_on_connect(self, sid, user_id):
+        server = self._socketio.server
+        for room in member_rooms(user_id):
+            server.enter_room(sid, room, namespace="/")
+
+    def apply(self, changes, broadcast=True):
+        """Join or leave the open sockets of each ``(user_id, room, joined)``"""
+        if self._socketio is None:
+            return
+        server = self._socketio.server
+        for user_id, room, joined in changes:
+            for sid in presence.sids_of(user_id):
+                if joined:
+                    server.enter_room(sid, room, namespace="/")
+                else:
+                    server.leave_room(sid, room, namespace="/")
+        if broadcast and self.publish is not None:
+            self.publish([list(change) for change in changes])
+
+    def close(self, room):
+        """Remove every socket from a room (reaches all workers through the message queue)"""
+        if self._socketio is not None:
+            self._socketio.close_room(room)
+
+
+room_subscriptions = RoomSubscriptions()
+
+
+def membership_change(obj, joined):
+    if isinstance(obj, GroupMember):
+        return (obj.user_id, group_socket_room(obj.group_id), joined)
+    if isinstance(obj, ClassMember):
+        return (obj.user_id, class_socket_room(obj.class_id), joined)
+    return None
+
+def defer_membership_changes(session, changes):
+    """Apply ``(user_id, room, joined)`` changes when the session commits"""
+    session.info.setdefault("membership_changes", []).extend(changes)
+
+# Membership rows added or deleted by any route are applied once committed
+@event.listens_for(Session, "after_flush")
+def collect_membership_changes(session, flush_context):
+    for objects, joined in ((session.new, True), (session.deleted, False)):
+        changes = [membership_change(obj, joined) for obj in objects]
+        defer_membership_changes(session, [change for change in changes if change])
+
+@event.listens_for(Session, "after_commit")
+def apply_membership_changes(session):
+    changes = session.info.pop("membership_changes", None)
+    if changes:
+        room_subscriptions.apply(changes)
+
+@event.listens_for(Session, "after_rollback")
+def forget_membership_changes(session):
+    session.info.pop("membership_changes", None)
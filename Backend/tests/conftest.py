@@ -0,0 +1,58 @@
+"""Shared fixtures: one app on a throwaway SQLite database for the whole run.
+
+The config is patched before app.py is imported (it reads ``Config`` at
+import and in ``create_app()``). Query auditing runs in strict mode, so any
+request over its ``@query_budget`` fails the test that made it.
+"""
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from config import Config  # noqa: E402
+
+TMP_DIR = tempfile.mkdtemp(prefix="sapcca-tests-")
+Config.SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(TMP_DIR, "test.db")
+Config.ATTACHMENT_DIR = os.path.join(TMP_DIR, "attachments")
+Config.WRITE_BEHIND_JOURNAL_DIR = os.path.join(TMP_DIR, "journal")
+Config.WRITE_BEHIND = False
+Config.SOCKETIO_MESSAGE_QUEUE = None
+Config.QUERY_AUDIT = True
+Config.QUERY_AUDIT_RAISE = True
+Config.LOG_FORMAT = "text"
+Config.LOG_LEVEL = "WARNING"
+
+from app import create_app, socketio  # noqa: E402
+from database import db  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+from models import User  # noqa: E402
+
+_user_numbers = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def app():
+    app = create_app()
+    app.config["TESTING"] = True
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def make_user(app):
+    """``make_user(role="student")`` -> ``(user id, auth headers)``"""
+    def make(role="student"):
+        n = next(_user_numbers)
+        with app.app_context():
+            user = User(email=f"user{n}@test.local", display_name=f"User {n}", role=role, is_verified=True, password="x")
+            db.session.add(user)
+            db.session.commit()
+            return user.id, {"Authorization": f"Bearer {create_access_token(identity=str(user.id))}"}
+    return make
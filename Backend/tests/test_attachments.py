@@ -0,0 +1,109 @@
+"""Attachment store: per-row MIME types, replaced submission files and read-only opens (attachments.py)."""
+import base64
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from attachments import blob_path
+from cascade import cascade_deleter
+from database import db
+from models import Assignment, Attachment, Class, ClassMember, Message
+
+
+def data_url(data, mime_type):
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
+
+@pytest.fixture
+def assignment(app, make_user):
+    teacher_id, _ = make_user("teacher")
+    student_id, headers = make_user()
+    with app.app_context():
+        klass = Class(name="Attachments", created_by=teacher_id)
+        db.session.add(klass)
+        db.session.flush()
+        db.session.add(ClassMember(class_id=klass.id, user_id=student_id))
+        work = Assignment(class_id=klass.id, title="Essay", created_by=teacher_id,
+                          due_date=datetime.utcnow() + timedelta(days=7))
+        db.session.add(work)
+        db.session.commit()
+        return work.id, headers
+
+
+def test_same_bytes_are_served_as_each_row_declared(app, client, make_user):
+    uid, headers = make_user()
+    friend_id, friend_headers = make_user()
+    data = os.urandom(256)
+    for sender, receiver, mime_type in ((headers, friend_id, "image/png"), (friend_headers, uid, "application/pdf")):
+        response = client.post("/api/messages/send", headers=sender, json={
+            "receiver_id": receiver, "file_data": data_url(data, mime_type), "file_type": mime_type, "file_name": "f"
+        })
+        assert response.status_code == 200
+    with app.app_context():
+        assert db.session.get(Attachment, hashlib.sha256(data).hexdigest()).mime_type == "image/png"  # First store wins
+
+    messages = client.get(f"/api/messages/chat/{friend_id}", headers=headers).get_json()["messages"]
+    served = [client.get(m["file_data"]).headers["Content-Type"] for m in messages]
+    assert served == ["image/png", "application/pdf"]
+
+def test_url_type_cannot_be_swapped(client, make_user):
+    uid, headers = make_user()
+    friend_id, _ = make_user()
+    client.post("/api/messages/send", headers=headers, json={
+        "receiver_id": friend_id, "file_data": data_url(os.urandom(64), "image/png"), "file_type": "image/png"
+    })
+    url = client.get(f"/api/messages/chat/{friend_id}", headers=headers).get_json()["messages"][-1]["file_data"]
+    assert client.get(url.replace("type=image%2Fpng", "type=text%2Fhtml")).status_code == 403
+
+def test_replaced_submission_file_is_reclaimed(app, client, assignment, monkeypatch):
+    assignment_id, headers = assignment
+    monkeypatch.setattr(cascade_deleter, "blob_grace", timedelta(0))
+    first, second = os.urandom(128), os.urandom(128)
+    for data in (first, second):
+        response = client.post(f"/api/assignments/{assignment_id}/submit", headers=headers, json={
+            "file_data": data_url(data, "application/pdf"), "file_type": "application/pdf", "file_name": "essay.pdf"
+        })
+        assert response.status_code in (200, 201)
+
+    with app.app_context():
+        old, new = hashlib.sha256(first).hexdigest(), hashlib.sha256(second).hexdigest()
+        assert db.session.get(Attachment, old) is None
+        assert not os.path.exists(blob_path(old))
+        assert db.session.get(Attachment, new) is not None
+        assert os.path.exists(blob_path(new))
+
+def test_replaced_file_used_elsewhere_is_kept(app, client, assignment, make_user, monkeypatch):
+    assignment_id, headers = assignment
+    monkeypatch.setattr(cascade_deleter, "blob_grace", timedelta(0))
+    shared = os.urandom(128)
+    uid, dm_headers = make_user()
+    client.post("/api/messages/send", headers=dm_headers, json={
+        "receiver_id": uid, "file_data": data_url(shared, "application/pdf"), "file_type": "application/pdf"
+    })
+    for data in (shared, os.urandom(128)):
+        client.post(f"/api/assignments/{assignment_id}/submit", headers=headers, json={
+            "file_data": data_url(data, "application/pdf"), "file_type": "application/pdf"
+        })
+    with app.app_context():
+        digest = hashlib.sha256(shared).hexdigest()
+        assert db.session.get(Attachment, digest) is not None
+        assert os.path.exists(blob_path(digest))
+
+def test_opening_a_legacy_attachment_writes_nothing(app, client, make_user):
+    uid, headers = make_user()
+    friend_id, _ = make_user()
+    legacy = data_url(b"legacy bytes", "text/plain")
+    with app.app_context():
+        msg = Message(sender_id=uid, receiver_id=friend_id, content="", file_data=legacy, file_type="text/plain")
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        attachments = Attachment.query.count()
+
+    response = client.get(f"/api/messages/{msg_id}/attachment", headers=headers)
+    assert response.get_json()["url"] == legacy
+    with app.app_context():
+        msg = db.session.get(Message, msg_id)
+        assert msg.file_ref is None and msg.file_data == legacy
+        assert Attachment.query.count() == attachments
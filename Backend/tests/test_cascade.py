@@ -0,0 +1,104 @@
+"""Background delete jobs of classes and assignments (cascade.py, routes/jobs.py)."""
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import socketio
+from cascade import cascade_deleter
+from database import db
+from models import Assignment, AssignmentSubmission, CascadeJob, Class, ClassMember, Group, GroupMember, GroupMessage
+
+ROWS = 5
+
+
+@pytest.fixture
+def klass(app, make_user):
+    """A class with ROWS students, assignments (each submitted by every student) and group messages"""
+    teacher_id, headers = make_user("teacher")
+    students = [make_user() for _ in range(ROWS)]
+    with app.app_context():
+        klass = Class(name="Cascade", created_by=teacher_id)
+        db.session.add(klass)
+        db.session.flush()
+        db.session.add(ClassMember(class_id=klass.id, user_id=teacher_id, is_moderator=True))
+        db.session.add_all(ClassMember(class_id=klass.id, user_id=student_id) for student_id, _ in students)
+        work = [Assignment(class_id=klass.id, title=f"Assignment {i}", created_by=teacher_id,
+                           due_date=datetime.utcnow() + timedelta(days=7)) for i in range(ROWS)]
+        group = Group(name="Cascade", created_by=teacher_id, class_id=klass.id)
+        db.session.add_all(work + [group])
+        db.session.flush()
+        db.session.add_all(AssignmentSubmission(assignment_id=a.id, student_id=student_id, text_response="done")
+                           for a in work for student_id, _ in students)
+        db.session.add(GroupMember(group_id=group.id, user_id=teacher_id, is_admin=True))
+        db.session.add_all(GroupMessage(group_id=group.id, sender_id=teacher_id, text=f"hello {i}") for i in range(ROWS))
+        db.session.commit()
+        return klass.id, [a.id for a in work], headers, students[0][1]
+
+def wait_for(client, job_id, headers, timeout=10):
+    """Poll the job until it finishes, yielding so the background task can run; returns every status seen"""
+    seen, deadline = [], time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f"/api/jobs/{job_id}", headers=headers).get_json()
+        seen.append(status)
+        if status["status"] in ("done", "failed"):
+            return seen
+        socketio.sleep(0.05)
+    pytest.fail(f"Job {job_id} still {seen[-1]['status']} after {timeout}s")
+
+
+def test_class_delete_runs_in_background(app, client, klass, monkeypatch):
+    class_id, assignment_ids, headers, student = klass
+    monkeypatch.setattr(cascade_deleter, "batch_size", 4)  # Several batches per table
+    response = client.delete(f"/api/classes/{class_id}", headers=headers)
+    assert response.status_code == 202
+    job = response.get_json()["job"]
+    assert (job["target_type"], job["target_id"], job["status"]) == ("class", class_id, "queued")
+
+    # Nothing ran yet: the class refuses writes and a second delete reuses the job
+    assert client.post(f"/api/classes/{class_id}/roster", headers=headers, data="email\n",
+                       content_type="text/csv").status_code == 409
+    assert client.post(f"/api/assignments/{assignment_ids[0]}/uploads", headers=student,
+                       json={"size": 10}).status_code == 409
+    assert client.delete(f"/api/classes/{class_id}", headers=headers).get_json()["job"]["job_id"] == job["job_id"]
+
+    seen = wait_for(client, job["job_id"], headers)
+    final = seen[-1]
+    assert final["status"] == "done", final["error"]
+    assert final["deleted_rows"] == final["total_rows"] > ROWS * ROWS
+    assert final["progress"] == 1.0
+    assert [s["progress"] for s in seen] == sorted(s["progress"] for s in seen)
+    with app.app_context():
+        assert db.session.get(Class, class_id) is None
+        assert Assignment.query.filter(Assignment.id.in_(assignment_ids)).count() == 0
+        assert AssignmentSubmission.query.filter(AssignmentSubmission.assignment_id.in_(assignment_ids)).count() == 0
+        assert GroupMessage.query.join(Group).filter(Group.class_id == class_id).count() == 0
+
+def test_assignment_delete_runs_in_background(app, client, klass):
+    class_id, assignment_ids, headers, student = klass
+    assignment_id = assignment_ids[0]
+    response = client.delete(f"/api/assignments/{assignment_id}", headers=headers)
+    assert response.status_code == 202
+    job_id = response.get_json()["job"]["job_id"]
+    assert client.post(f"/api/assignments/{assignment_id}/uploads", headers=student, json={"size": 10}).status_code == 409
+
+    assert wait_for(client, job_id, headers)[-1]["status"] == "done"
+    with app.app_context():
+        assert db.session.get(Assignment, assignment_id) is None
+        assert AssignmentSubmission.query.filter_by(assignment_id=assignment_id).count() == 0
+        assert Assignment.query.filter_by(class_id=class_id).count() == ROWS - 1
+
+def test_delete_needs_permission(client, klass):
+    class_id, assignment_ids, _, student = klass
+    assert client.delete(f"/api/classes/{class_id}", headers=student).status_code == 403
+    assert client.delete(f"/api/assignments/{assignment_ids[0]}", headers=student).status_code == 403
+    assert client.delete("/api/classes/999999", headers=student).status_code == 404
+
+def test_jobs_are_private(app, client, klass):
+    class_id, _, headers, student = klass
+    job_id = client.delete(f"/api/classes/{class_id}", headers=headers).get_json()["job"]["job_id"]
+    assert client.get(f"/api/jobs/{job_id}", headers=student).status_code == 404
+    assert client.get("/api/jobs/999999", headers=headers).status_code == 404
+    wait_for(client, job_id, headers)
+    with app.app_context():
+        assert db.session.get(CascadeJob, job_id).status == "done"
@@ -0,0 +1,107 @@
+"""Query budgets of the list endpoints and the N+1 detector (query_audit.py)."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import db
+from models import Assignment, Class, ClassMember, FriendRequest, Group, GroupMember, Message, User
+from query_audit import QueryBudgetExceeded, max_queries, statement_shape
+
+ROWS = 5  # Enough rows that a per-row query blows every budget
+
+
+@pytest.fixture
+def populated(app, make_user):
+    """A user with ROWS of everything the budgeted endpoints list"""
+    uid, headers = make_user("teacher")
+    others = [make_user()[0] for _ in range(3 * ROWS)]
+    with app.app_context():
+        classes = [Class(name=f"Class {i}", created_by=uid) for i in range(ROWS)]
+        db.session.add_all(classes)
+        db.session.flush()
+        db.session.add_all(ClassMember(class_id=c.id, user_id=uid, is_moderator=True) for c in classes)
+        groups = [Group(name=f"Group {i}", created_by=uid, class_id=classes[0].id) for i in range(ROWS)]
+        db.session.add_all(groups)
+        db.session.flush()
+        db.session.add_all(GroupMember(group_id=g.id, user_id=uid, is_admin=True) for g in groups)
+        db.session.add_all(GroupMember(group_id=groups[0].id, user_id=other) for other in others[:ROWS])
+        db.session.add_all(Assignment(class_id=classes[0].id, title=f"Assignment {i}", created_by=uid,
+                                      due_date=datetime.utcnow() + timedelta(days=i + 1)) for i in range(ROWS))
+        friends, pending, outgoing = others[:ROWS], others[ROWS:2 * ROWS], others[2 * ROWS:]
+        db.session.add_all(FriendRequest(sender_id=uid, receiver_id=f, status="accepted") for f in friends)
+        db.session.add_all(FriendRequest(sender_id=p, receiver_id=uid, status="pending") for p in pending)
+        db.session.add_all(FriendRequest(sender_id=uid, receiver_id=o, status="pending") for o in outgoing)
+        db.session.commit()
+        return headers, classes[0].id, groups[0].id
+
+
+@pytest.mark.parametrize("path", [
+    "/api/classes/list",
+    "/api/classes/{class_id}",
+    "/api/assignments/class/{class_id}",
+    "/api/friends/list",
+    "/api/friends/pending",
+    "/api/friends/outgoing",
+    "/api/friends/ignored",
+    "/api/friends/presence",
+    "/api/groups/list",
+    "/api/groups/members/{group_id}",
+])
+def test_endpoint_within_budget(client, populated, path):
+    headers, class_id, group_id = populated
+    response = client.get(path.format(class_id=class_id, group_id=group_id), headers=headers)
+    assert response.status_code == 200
+    assert int(response.headers["X-Query-Count"]) >= 1
+
+def test_rows_are_returned(client, populated):
+    headers, _, group_id = populated
+    assert len(client.get("/api/friends/list", headers=headers).get_json()) == ROWS
+    assert len(client.get("/api/friends/pending", headers=headers).get_json()["requests"]) == ROWS
+    assert len(client.get("/api/groups/list", headers=headers).get_json()["groups"]) == ROWS
+    assert len(client.get(f"/api/groups/members/{group_id}", headers=headers).get_json()["members"]) == ROWS + 1
+
+def test_over_budget_request_fails(app, client, populated, monkeypatch):
+    headers, _, _ = populated
+    monkeypatch.setattr(app.view_functions["friends.get_friends_list"], "query_budget", 0)
+    with pytest.raises(QueryBudgetExceeded, match="budget 0"):
+        client.get("/api/friends/list", headers=headers)
+
+
+def test_max_queries_fails_over_limit(app, populated):
+    with app.app_context():
+        with pytest.raises(QueryBudgetExceeded, match="at most 1"):
+            with max_queries(1):
+                User.query.count()
+                User.query.count()
+
+def test_n_plus_one_detected(app, populated):
+    with app.app_context():
+        ids = [u.id for u in User.query.limit(ROWS).all()]
+        db.session.expire_all()
+        with max_queries(ROWS) as statements:
+            for user_id in ids:
+                db.session.get(User, user_id)
+    [(shape, executions, sites)] = statements.repeated(ROWS)
+    assert executions == ROWS
+    assert "FROM user" in shape
+    assert any("test_n_plus_one_detected" in site for site in sites)
+
+def test_in_lists_share_a_shape():
+    assert statement_shape("SELECT * FROM t WHERE id IN (?, ?, ?)") == statement_shape("SELECT * FROM t WHERE id IN (?,?)")
+
+def test_dm_history_batches_replies(app, client, make_user):
+    uid, headers = make_user()
+    friend_id, _ = make_user()
+    with app.app_context():
+        db.session.add(FriendRequest(sender_id=uid, receiver_id=friend_id, status="accepted"))
+        older = [Message(sender_id=friend_id, receiver_id=uid, content=f"old {i}") for i in range(ROWS)]
+        db.session.add_all(older)
+        db.session.flush()
+        db.session.add_all(Message(sender_id=uid, receiver_id=friend_id, content=f"re {i}", reply_to_id=m.id)
+                           for i, m in enumerate(older))
+        db.session.commit()
+    response = client.get(f"/api/messages/chat/{friend_id}?limit={ROWS}", headers=headers)
+    assert response.status_code == 200
+    replies = [m["reply_to"] for m in response.get_json()["messages"]]
+    assert [r["text"] for r in replies] == [f"old {i}" for i in range(ROWS)]
+    assert all(r["sender_name"] != "Unknown" for r in replies)
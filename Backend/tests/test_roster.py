@@ -0,0 +1,78 @@
+"""Streamed roster imports and their dry run (roster.py, routes/classes.py)."""
+import io
+import json
+
+import pytest
+
+from database import db
+from models import Class, ClassMember, User
+
+
+@pytest.fixture
+def klass(app, make_user):
+    """A class with a teacher, one existing member and two students not yet enrolled"""
+    teacher_id, headers = make_user("teacher")
+    students = [make_user()[0] for _ in range(3)]
+    with app.app_context():
+        klass = Class(name="Roster", created_by=teacher_id)
+        db.session.add(klass)
+        db.session.flush()
+        db.session.add(ClassMember(class_id=klass.id, user_id=teacher_id, is_moderator=True))
+        db.session.add(ClassMember(class_id=klass.id, user_id=students[0]))
+        db.session.commit()
+        emails = [db.session.get(User, student_id).email for student_id in students]
+        return klass.id, headers, emails
+
+def members(app, class_id):
+    with app.app_context():
+        return ClassMember.query.filter_by(class_id=class_id).count()
+
+def csv_roster(*rows):
+    return "email\n" + "".join(f"{row}\n" for row in rows)
+
+
+def test_dry_run_reports_without_enrolling(app, client, klass):
+    class_id, headers, (member, first, second) = klass
+    roster = csv_roster(member, first, second, first, "nobody@test.local", "")
+    response = client.post(f"/api/classes/{class_id}/roster", headers=headers, query_string={"dry_run": "1"},
+                           data=roster, content_type="text/csv")
+    assert response.status_code == 200
+    report = response.get_json()
+    assert report["dry_run"] is True
+    assert [row["status"] for row in report["rows"]] == ["already_member", "enrolled", "enrolled", "duplicate", "not_found"]
+    assert (report["total"], report["enrolled"], report["already_member"]) == (5, 2, 1)
+    assert members(app, class_id) == 2
+
+    response = client.post(f"/api/classes/{class_id}/roster", headers=headers, data=roster, content_type="text/csv")
+    assert response.get_json()["enrolled"] == 2
+    assert members(app, class_id) == 4
+
+def test_json_roster_upload(app, client, klass):
+    class_id, headers, (_, first, second) = klass
+    body = json.dumps([first, {"email": second}]).encode()
+    response = client.post(f"/api/classes/{class_id}/roster", headers=headers,
+                           data={"file": (io.BytesIO(body), "roster.json")},
+                           content_type="multipart/form-data")
+    assert response.status_code == 200
+    assert response.get_json()["enrolled"] == 2
+    assert members(app, class_id) == 4
+
+def test_bad_roster_is_rejected(app, client, klass, monkeypatch):
+    class_id, headers, (_, first, second) = klass
+    response = client.post(f"/api/classes/{class_id}/roster", headers=headers, data=f'["{first}", ',
+                           content_type="application/json")
+    assert response.status_code == 400
+
+    monkeypatch.setitem(app.config, "ROSTER_MAX_ROWS", 1)
+    monkeypatch.setitem(app.config, "ROSTER_CHUNK_SIZE", 1)
+    response = client.post(f"/api/classes/{class_id}/roster", headers=headers, data=csv_roster(first, second),
+                           content_type="text/csv")
+    assert response.status_code == 400
+    assert members(app, class_id) == 2  # The first chunk was rolled back
+
+def test_roster_needs_a_moderator(client, klass, make_user):
+    class_id, _, (_, first, _) = klass
+    _, student = make_user()
+    response = client.post(f"/api/classes/{class_id}/roster", headers=student, data=csv_roster(first),
+                           content_type="text/csv")
+    assert response.status_code == 403
@@ -0,0 +1,98 @@
+"""Delta sync cursors of DM and group chats, and the tombstone horizon (tombstones.py)."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import db
+from models import FriendRequest, Group, GroupMember, Message, MessageTombstone
+from tombstones import tombstone_pruner
+
+LONG_AGO = datetime.utcnow() - timedelta(days=365)
+
+
+@pytest.fixture
+def friends(app, make_user):
+    uid, headers = make_user()
+    friend_id, friend_headers = make_user()
+    with app.app_context():
+        db.session.add(FriendRequest(sender_id=uid, receiver_id=friend_id, status="accepted"))
+        db.session.commit()
+    return uid, headers, friend_id, friend_headers
+
+def old_tombstones(app, uid, friend_id, n=3):
+    """Add ``n`` tombstones, age every tombstone past the horizon and prune; returns the kept (newest) id"""
+    with app.app_context():
+        db.session.add_all(MessageTombstone(chat_type="dm", message_id=10 ** 9 + i, sender_id=uid,
+                                            receiver_id=friend_id) for i in range(n))
+        MessageTombstone.query.update({"deleted_at": LONG_AGO})
+        db.session.commit()
+        assert tombstone_pruner.prune() >= n - 1
+        oldest = db.session.query(db.func.min(MessageTombstone.id)).scalar()
+        assert oldest == db.session.query(db.func.max(MessageTombstone.id)).scalar() > 2
+        return oldest
+
+
+def test_sync_requires_friendship(client, make_user, friends):
+    _, headers, _, _ = friends
+    stranger_id, _ = make_user()
+    assert client.get(f"/api/messages/chat/{stranger_id}/sync", headers=headers).status_code == 404
+    assert client.get("/api/messages/chat/999999/sync", headers=headers).status_code == 404
+
+def test_sync_returns_new_and_deleted_messages(client, friends):
+    uid, headers, friend_id, friend_headers = friends
+    cursor = client.get(f"/api/messages/chat/{friend_id}", headers=headers).get_json()["sync"]
+
+    sent = client.post("/api/messages/send", headers=friend_headers, json={"receiver_id": uid, "message": "hello"}).get_json()
+    doomed = client.post("/api/messages/send", headers=friend_headers, json={"receiver_id": uid, "message": "oops"}).get_json()
+    assert client.delete(f"/api/messages/delete/{doomed['id']}", headers=friend_headers).status_code == 200
+
+    data = client.get(f"/api/messages/chat/{friend_id}/sync", headers=headers, query_string=cursor).get_json()
+    assert [m["id"] for m in data["messages"]] == [sent["id"]]
+    assert data["deleted"] == [doomed["id"]]
+    assert data["sync"]["since_deleted"] > cursor["since_deleted"]
+
+def test_cursor_before_horizon_needs_resync(app, client, friends):
+    uid, headers, friend_id, _ = friends
+    oldest = old_tombstones(app, uid, friend_id)
+    response = client.get(f"/api/messages/chat/{friend_id}/sync", headers=headers,
+                          query_string={"since_id": 0, "since_deleted": oldest - 2})
+    assert response.status_code == 410
+    assert response.get_json()["resync"] is True
+
+    current = client.get(f"/api/messages/chat/{friend_id}/sync", headers=headers,
+                         query_string={"since_id": 0, "since_deleted": oldest - 1})
+    assert current.status_code == 200
+
+def test_first_sync_is_never_expired(app, client, friends):
+    uid, headers, friend_id, _ = friends
+    old_tombstones(app, uid, friend_id)
+    response = client.get(f"/api/messages/chat/{friend_id}/sync", headers=headers)
+    assert response.status_code == 200
+
+def test_group_cursor_before_horizon_needs_resync(app, client, friends):
+    uid, headers, friend_id, _ = friends
+    with app.app_context():
+        group = Group(name="Sync", created_by=uid)
+        db.session.add(group)
+        db.session.flush()
+        db.session.add(GroupMember(group_id=group.id, user_id=uid, is_admin=True))
+        db.session.commit()
+        group_id = group.id
+    oldest = old_tombstones(app, uid, friend_id)
+    response = client.get(f"/api/groups/messages/{group_id}/sync", headers=headers,
+                          query_string={"since_id": 0, "since_deleted": oldest - 2})
+    assert response.status_code == 410
+
+def test_deleted_ids_are_not_reused(app, friends):
+    uid, _, friend_id, _ = friends
+    with app.app_context():
+        newest = Message(sender_id=uid, receiver_id=friend_id, content="newest")
+        db.session.add(newest)
+        db.session.commit()
+        deleted_id = newest.id
+        db.session.delete(newest)
+        db.session.commit()
+        again = Message(sender_id=uid, receiver_id=friend_id, content="again")
+        db.session.add(again)
+        db.session.commit()
+        assert again.id > deleted_id
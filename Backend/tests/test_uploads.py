@@ -0,0 +1,100 @@
+"""Resumable submission uploads and their per-user caps (routes/assignments.py)."""
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import routes.assignments as assignments_routes
+from attachments import MAX_UPLOAD_BYTES
+from database import db
+from models import Assignment, AssignmentSubmission, Class, ClassMember, UploadSession
+
+
+@pytest.fixture
+def assignment(app, make_user):
+    teacher_id, _ = make_user("teacher")
+    student_id, headers = make_user()
+    with app.app_context():
+        klass = Class(name="Uploads", created_by=teacher_id)
+        db.session.add(klass)
+        db.session.flush()
+        db.session.add(ClassMember(class_id=klass.id, user_id=student_id))
+        work = Assignment(class_id=klass.id, title="Report", created_by=teacher_id,
+                          due_date=datetime.utcnow() + timedelta(days=7))
+        db.session.add(work)
+        db.session.commit()
+        return work.id, student_id, headers
+
+def start(client, assignment_id, headers, size, **fields):
+    return client.post(f"/api/assignments/{assignment_id}/uploads", headers=headers, json=dict(fields, size=size))
+
+def put(client, upload_id, headers, offset, data):
+    return client.put(f"/api/assignments/uploads/{upload_id}", headers=headers, query_string={"offset": offset}, data=data)
+
+
+def test_upload_resumes_and_completes(app, client, assignment):
+    assignment_id, student_id, headers = assignment
+    data = os.urandom(3000)
+    response = start(client, assignment_id, headers, len(data), file_name="report.pdf", file_type="application/pdf")
+    assert response.status_code == 201
+    upload_id = response.get_json()["upload_id"]
+
+    assert put(client, upload_id, headers, 0, data[:1000]).get_json()["received"] == 1000
+    # A retried chunk that already landed is told where to resume
+    retried = put(client, upload_id, headers, 0, data[:1000])
+    assert retried.status_code == 409
+    assert retried.get_json()["received"] == 1000
+    assert client.get(f"/api/assignments/uploads/{upload_id}", headers=headers).get_json() == {
+        "upload_id": upload_id, "received": 1000, "size": len(data), "complete": False
+    }
+
+    incomplete = client.post(f"/api/assignments/uploads/{upload_id}/complete", headers=headers, json={})
+    assert incomplete.status_code == 409
+    assert put(client, upload_id, headers, 1000, data[1000:]).status_code == 200
+
+    response = client.post(f"/api/assignments/uploads/{upload_id}/complete", headers=headers, json={"text_response": "done"})
+    assert response.status_code in (200, 201)
+    with app.app_context():
+        assert db.session.get(UploadSession, upload_id) is None
+        submission = AssignmentSubmission.query.filter_by(assignment_id=assignment_id, student_id=student_id).one()
+        assert submission.file_name == "report.pdf"
+    assert client.get(f"/api/assignments/uploads/{upload_id}", headers=headers).status_code == 404
+
+def test_chunks_are_bounded(client, assignment, monkeypatch):
+    assignment_id, _, headers = assignment
+    monkeypatch.setattr(assignments_routes, "MAX_CHUNK_BYTES", 16)
+    upload_id = start(client, assignment_id, headers, 20).get_json()["upload_id"]
+
+    assert put(client, upload_id, headers, 0, os.urandom(17)).status_code == 413
+    assert put(client, upload_id, headers, 0, b"").status_code == 413
+    assert put(client, upload_id, headers, 0, os.urandom(16)).status_code == 200
+    past_end = put(client, upload_id, headers, 16, os.urandom(8))
+    assert past_end.status_code == 400
+    assert past_end.get_json()["received"] == 16
+
+def test_declared_size_is_bounded(client, assignment):
+    assignment_id, _, headers = assignment
+    assert start(client, assignment_id, headers, 0).status_code == 400
+    assert start(client, assignment_id, headers, MAX_UPLOAD_BYTES + 1).status_code == 400
+    assert client.post(f"/api/assignments/{assignment_id}/uploads", headers=headers, json={}).status_code == 400
+
+def test_open_uploads_are_capped(client, assignment):
+    assignment_id, _, headers = assignment
+    for _ in range(assignments_routes.MAX_ACTIVE_UPLOADS):
+        assert start(client, assignment_id, headers, 10).status_code == 201
+    assert start(client, assignment_id, headers, 10).status_code == 429
+
+def test_staged_bytes_are_capped(client, assignment):
+    assignment_id, _, headers = assignment
+    for _ in range(assignments_routes.MAX_STAGED_BYTES // MAX_UPLOAD_BYTES):
+        assert start(client, assignment_id, headers, MAX_UPLOAD_BYTES).status_code == 201
+    assert start(client, assignment_id, headers, 1).status_code == 429
+
+def test_uploads_are_private(client, assignment, make_user):
+    assignment_id, _, headers = assignment
+    _, outsider = make_user()
+    assert start(client, assignment_id, outsider, 10).status_code == 403
+    upload_id = start(client, assignment_id, headers, 10).get_json()["upload_id"]
+    assert client.get(f"/api/assignments/uploads/{upload_id}", headers=outsider).status_code == 404
+    assert put(client, upload_id, outsider, 0, b"x").status_code == 404
+    assert client.post(f"/api/assignments/uploads/{upload_id}/complete", headers=outsider, json={}).status_code == 404
@@ -0,0 +1,101 @@
+"""Write-behind journal replay and deletes of queued messages (write_behind.py)."""
+import json
+import os
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+import write_behind as write_behind_module
+from database import db
+from models import FriendRequest, Message
+from write_behind import SnowflakeIds, WriteBehindWriter, write_behind
+
+
+@pytest.fixture
+def journal(tmp_path):
+    """A writer over an empty journal directory; ``write(name, records)`` adds a leftover segment"""
+    writer = WriteBehindWriter()
+    writer.ids = SnowflakeIds(0)
+    writer.journal_dir = str(tmp_path)
+
+    def write(name, contents):
+        with open(os.path.join(writer.journal_dir, name), "w", encoding="utf-8") as f:
+            for kind, fields in contents:
+                fields = dict(fields, id=writer.ids.next_id(), timestamp=datetime.utcnow().isoformat())
+                f.write(json.dumps({"kind": kind, "fields": fields}) + "\n")
+        writer._leftover.append(name)
+    return writer, write
+
+@pytest.fixture
+def failing_persist(monkeypatch):
+    """Make persist() refuse messages by content: "bad" as a bad row, "locked" as a busy database"""
+    persist = write_behind_module.persist
+
+    def fake(records):
+        for _, fields in records:
+            if fields["content"] == "bad":
+                raise IntegrityError("INSERT", {}, Exception("constraint failed"))
+            if fields["content"] == "locked":
+                raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return persist(records)
+    monkeypatch.setattr(write_behind_module, "persist", fake)
+
+
+def stored(*contents):
+    return Message.query.filter(Message.content.in_(contents)).count()
+
+def test_replay_rejects_only_bad_rows(app, make_user, journal, failing_persist):
+    writer, write = journal
+    uid, _ = make_user()
+    write("0001.jsonl", [("dm", {"sender_id": uid, "receiver_id": uid, "content": c}) for c in ("ok 1", "bad", "ok 2")])
+    with app.app_context():
+        writer.replay()
+        assert stored("ok 1", "ok 2") == 2
+    assert os.listdir(writer.journal_dir) == ["rejected.jsonl"]
+    assert writer.rejected == 1
+
+def test_replay_keeps_segments_while_database_is_unavailable(app, make_user, journal, failing_persist):
+    writer, write = journal
+    uid, _ = make_user()
+    write("0001.jsonl", [("dm", {"sender_id": uid, "receiver_id": uid, "content": c}) for c in ("first", "locked")])
+    write("0002.jsonl", [("dm", {"sender_id": uid, "receiver_id": uid, "content": "second"})])
+    with app.app_context():
+        with pytest.raises(OperationalError):
+            writer.replay()
+        assert writer._leftover == ["0001.jsonl", "0002.jsonl"]
+        assert sorted(os.listdir(writer.journal_dir)) == ["0001.jsonl", "0002.jsonl"]
+        assert writer.rejected == 0
+
+        # The database is back: the stored row is skipped, not duplicated or rejected
+        with open(os.path.join(writer.journal_dir, "0001.jsonl"), encoding="utf-8") as f:
+            lines = f.read().replace('"locked"', '"recovered"')
+        with open(os.path.join(writer.journal_dir, "0001.jsonl"), "w", encoding="utf-8") as f:
+            f.write(lines)
+        writer.replay()
+        assert stored("first") == 1
+        assert stored("recovered", "second") == 2
+    assert os.listdir(writer.journal_dir) == []
+    assert writer._leftover == []
+
+def test_rest_delete_flushes_queued_message(app, client, make_user, monkeypatch, tmp_path):
+    uid, headers = make_user()
+    friend_id, _ = make_user()
+    with app.app_context():
+        db.session.add(FriendRequest(sender_id=uid, receiver_id=friend_id, status="accepted"))
+        db.session.commit()
+    monkeypatch.setattr(write_behind, "enabled", True)
+    monkeypatch.setattr(write_behind, "ids", SnowflakeIds(0))
+    monkeypatch.setattr(write_behind, "journal_dir", str(tmp_path), raising=False)
+    monkeypatch.setattr(write_behind, "batch_size", 100, raising=False)
+    monkeypatch.setattr(write_behind, "fsync", False, raising=False)
+
+    with app.test_request_context():
+        msg_id, _ = write_behind.submit("dm", {"sender_id": uid, "receiver_id": friend_id, "content": "queued"})
+    assert write_behind.pending() == 1
+
+    assert client.delete(f"/api/messages/delete/{msg_id}", headers=headers).status_code == 200
+    assert write_behind.pending() == 0
+    with app.app_context():
+        assert db.session.get(Message, msg_id) is None
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,87 @@
+"""Deleted-message tombstones for delta sync.
+
+Deleting a DM or group message records a ``MessageTombstone``; the sync
+endpoints return the tombstones after the client's ``since_deleted`` cursor
+so an open chat can drop messages deleted elsewhere.
+
+Tombstones are only needed by clients that synced before the deletion, so
+they are kept for ``SYNC_HORIZON_DAYS`` and a background task prunes older
+ones every ``SYNC_PRUNE_INTERVAL`` seconds. Ids are never reused (the table
+is AUTOINCREMENT on SQLite) and the newest tombstone is always kept, so the
+oldest kept id marks the horizon: a cursor from before it may have missed
+pruned deletions and gets ``cursor_expired()``, and the client reloads
+history instead.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+
+from database import db
+from logs import get_logger
+from models import MessageTombstone
+
+log = get_logger("tombstones")
+
+# Tombstones removed per delete transaction
+PRUNE_BATCH_SIZE = 1000
+
+
+def latest_tombstone_id():
+    """Highest tombstone id; any later deletion is guaranteed to sort after it"""
+    return db.session.query(func.max(MessageTombstone.id)).scalar() or 0
+
+def cursor_expired(since_deleted):
+    """Whether tombstones after ``since_deleted`` may already have been pruned
+
+    0 is the default cursor of a first sync: the client has nothing to
+    reconcile yet, so it is a fresh load and never expired.
+    """
+    if not since_deleted:
+        return False
+    oldest = db.session.query(func.min(MessageTombstone.id)).scalar()
+    return oldest is not None and since_deleted < oldest - 1
+
+
+class TombstonePruner:
+    def init_app(self, app, socketio):
+        self._app = app
+        self._socketio = socketio
+        self.horizon = timedelta(days=app.config.get("SYNC_HORIZON_DAYS", 7))
+        self.interval = app.config.get("SYNC_PRUNE_INTERVAL", 3600)
+        app.extensions["tombstones"] = self
+        socketio.start_background_task(self.run)
+
+    def run(self):
+        while True:
+            try:
+                with self._app.app_context():
+                    self.prune()
+            except Exception:
+                db.session.rollback()
+                log.exception("Tombstone pruning failed")
+            self._socketio.sleep(self.interval)
+
+    def prune(self):
+        """Delete tombstones older than the horizon, in short batches; returns the number removed"""
+        # Prune a prefix of ids, so the oldest kept id is the horizon cursor_expired() checks
+        cutoff = datetime.utcnow() - self.horizon
+        boundary = db.session.query(func.min(MessageTombstone.id)).filter(
+            MessageTombstone.deleted_at >= cutoff
+        ).scalar() or latest_tombstone_id()
+        removed = 0
+        while True:
+            ids = db.session.execute(select(MessageTombstone.id).where(
+                MessageTombstone.id < boundary
+            ).order_by(MessageTombstone.id).limit(PRUNE_BATCH_SIZE)).scalars().all()
+            if not ids:
+                break
+            db.session.execute(delete(MessageTombstone).where(MessageTombstone.id.in_(ids)))
+            db.session.commit()
+            removed += len(ids)
+            self._socketio.sleep(0)  # Let waiting writers take the lock
+        if removed:
+            log.event("tombstones_pruned", removed=removed, kept_from=boundary)
+        return removed
+
+
+tombstone_pruner = TombstonePruner()
@@ -1,28 +1,18 @@
 from app import create_app
 from database import db
-from sqlalchemy import text
+from flask_migrate import upgrade
 
 app = create_app()
 
 with app.app_context():
     print("Checking database schema...")
     
-    # 1. Add SystemLog table
-    print("Creating SystemLog table if not exists...")
-    db.create_all() # This creates any missing tables (like SystemLog)
+    # 1. Create any missing tables
+    print("Creating missing tables...")
+    db.create_all()
     
-    # 2. Add is_admin column to User if missing
-    print("Checking for is_admin column...")
-    inspector = db.inspect(db.engine)
-    columns = [c['name'] for c in inspector.get_columns('user')]
-    
-    if 'is_admin' not in columns:
-        print("Adding is_admin column to user table...")
-        with db.engine.connect() as conn:
-            conn.execute(text("ALTER TABLE user ADD COLUMN is_admin BOOLEAN DEFAULT 0"))
-            conn.commit()
-        print("Column added.")
-    else:
-        print("is_admin column already exists.")
+    # 2. Apply versioned migrations (columns, indexes) from migrations/versions
+    print("Applying migrations...")
+    upgrade()
 
     print("Database update complete.")
@@ -0,0 +1,344 @@
+"""Write-behind persistence for socket chat messages.
+
+With ``WRITE_BEHIND`` enabled, ``send_message`` / ``send_group_message`` no
+longer commit per chat line. A message gets a snowflake id and timestamp up
+front, is appended to a local journal and emitted at once; a background
+worker then persists pending messages in one transaction every
+``WRITE_BEHIND_INTERVAL_MS`` or as soon as ``WRITE_BEHIND_BATCH_SIZE`` are
+waiting (group commit).
+
+Durability: the journal is a directory of append-only JSON-lines segments.
+The worker seals the current segment when it takes a batch and deletes it
+only after that batch commits, so anything left on disk at startup is
+replayed (rows that already reached the database are skipped; while the
+database is unavailable the worker retries the replay before each batch).
+Journal writes reach the OS before the emit, which survives a process
+crash; ``WRITE_BEHIND_FSYNC`` also fsyncs each append to survive power loss.
+
+While enabled every new Message/GroupMessage row, including REST sends,
+takes its id from the generator so the two paths never collide. Each
+process claims a free worker id from ``WRITE_BEHIND_WORKER_IDS`` with a
+lock file, which also makes it the owner (and replayer) of that id's
+journal; a restarted worker picks up the slot a dead one released. Give
+each host a disjoint range. Snowflake
+ids are larger than any autoincrement id; on Postgres, advance the table
+sequences past them before switching write-behind off again. REST history
+and ``/sync`` see a socket message once its batch commits.
+
+Ids are taken at submit but rows commit later (and REST sends take theirs at
+commit), so ids are not in commit order. Sync cursors therefore go through
+``hold_cursor()``: they never pass this worker's oldest unflushed message,
+nor the id of ``WRITE_BEHIND_SYNC_LAG_MS`` ago, which covers batches still
+in flight on other workers. Clients re-receive the overlap and skip ids they
+already have.
+"""
+import json
+import logging
+import os
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows: single process only
+    fcntl = None
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.exc import DataError, IntegrityError
+
+from database import db
+from inbox import record_dm, record_group_message
+from logs import get_logger
+from models import GroupMessage, Message
+from room_cache import recent_messages, dm_room, group_room
+
+log = get_logger("write_behind")
+
+# 41 bits of milliseconds since EPOCH_MS | 5 bits worker | 7 bits sequence:
+# 53 bits, so ids stay exact as JavaScript numbers
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+MODELS = {"dm": Message, "group": GroupMessage}
+
+
+class SnowflakeIds:
+    """Time-ordered unique ids, unique across processes by worker id"""
+
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = max(int(time.time() * 1000), self._last_ms)  # Never step back with the clock
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & SEQUENCE_MASK
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond: borrow the next one
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+class WriteBehindWriter:
+    def __init__(self):
+        self.enabled = False
+        self.ids = None
+        self._app = None
+        self._wake = None
+        self._worker_lock = None
+        self._pending = []  # (kind, fields) in submit order
+        self._flushing = []  # Batch taken by the worker and not committed yet
+        self._segment = None  # Open journal file taking new appends
+        self._sealed = []  # Closed journal files whose messages are not committed yet
+        self._leftover = []  # Journal files of a previous run not replayed yet
+        self._lock = threading.Lock()  # Guards _pending and _segment
+        self._flush_lock = threading.Lock()  # One batch in flight
+        self.batches = self.persisted = self.rejected = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = None
+
+    def init_app(self, app, socketio):
+        """Replay the journal and start the worker (no-op unless WRITE_BEHIND is set)"""
+        if not app.config.get("WRITE_BEHIND"):
+            return
+        self._app = app
+        self.enabled = True
+        self.interval = app.config.get("WRITE_BEHIND_INTERVAL_MS", 50) / 1000
+        self.batch_size = app.config.get("WRITE_BEHIND_BATCH_SIZE", 200)
+        self.fsync = app.config.get("WRITE_BEHIND_FSYNC", False)
+        self.sync_lag_ms = app.config.get("WRITE_BEHIND_SYNC_LAG_MS", 2000)
+        journal_root = app.config["WRITE_BEHIND_JOURNAL_DIR"]
+        os.makedirs(journal_root, exist_ok=True)
+        worker_id = self.claim_worker_id(journal_root, app.config.get("WRITE_BEHIND_WORKER_IDS", "0-31"))
+        self.ids = SnowflakeIds(worker_id)
+        self.journal_dir = os.path.join(journal_root, f"worker-{worker_id}")
+        os.makedirs(self.journal_dir, exist_ok=True)
+        app.extensions["write_behind"] = self
+
+        for model in MODELS.values():
+            event.listen(model, "before_insert", self.assign_id)
+
+        self._leftover = sorted(name for name in os.listdir(self.journal_dir)
+                                if name.endswith(".jsonl") and name != "rejected.jsonl")
+        with app.app_context():
+            try:
+                self.replay()
+            except Exception:
+                db.session.rollback()
+                log.exception("Journal replay failed, the worker retries it before its next batch")
+
+        self._wake = socketio.server.eio.create_event()
+        socketio.start_background_task(self.run)
+
+    def claim_worker_id(self, journal_root, id_range):
+        """Lock the first free worker id in ``"first-last"`` for the life of the process"""
+        first, _, last = id_range.partition("-")
+        candidates = range(int(first), int(last or first) + 1)
+        if fcntl is None:
+            return candidates[0]
+        for worker_id in candidates:
+            lock = open(os.path.join(journal_root, f"worker-{worker_id}.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            self._worker_lock = lock  # Released by the OS when the process exits
+            return worker_id
+        raise RuntimeError(f"No free write-behind worker id in {id_range}")
+
+    def assign_id(self, mapper, connection, target):
+        if target.id is None:
+            target.id = self.ids.next_id()
+
+    def submit(self, kind, fields):
+        """Journal a message and queue it for the next batch; returns ``(id, timestamp)``"""
+        if fields.get("file_ref") or fields.get("voice_ref"):
+            # Attachment rows stored for this message: the batch commits in another session
+            db.session.commit()
+        fields = dict(fields, id=self.ids.next_id(), timestamp=datetime.utcnow())
+        line = json.dumps({"kind": kind, "fields": fields}, default=datetime.isoformat) + "\n"
+        with self._lock:
+            if self._segment is None:
+                self._segment = open(os.path.join(self.journal_dir, f"{fields['id']:016d}.jsonl"), "a", encoding="utf-8")
+            self._segment.write(line)
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+            self._pending.append((kind, fields))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+        return fields["id"], fields["timestamp"]
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def hold_cursor(self, since_id):
+        """Clamp a sync cursor so it cannot pass messages that have ids but are not committed yet"""
+        if not self.enabled:
+            return since_id
+        # Snowflake ids are time-ordered across workers: every id below this one is older than the lag
+        floor = (int(time.time() * 1000) - self.sync_lag_ms - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)
+        with self._lock:
+            for queue in (self._flushing, self._pending):
+                if queue:
+                    floor = min(floor, queue[0][1]["id"])  # Oldest first: ids grow in submit order
+                    break
+        return max(min(since_id, floor - 1), 0)
+
+    def run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                with self._app.app_context():
+                    if self._leftover:
+                        self.replay()
+                    self.flush()
+            except Exception:
+                log.exception("Write-behind flush failed, retrying next interval")
+
+    def flush(self):
+        """Persist everything pending in one transaction (call inside an app context)"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._flushing = batch
+                segment, self._segment = self._segment, None
+            if segment is not None:
+                segment.close()
+                self._sealed.append(segment.name)
+            if not batch:
+                return
+
+            started = time.perf_counter()
+            try:
+                messages = persist(batch)
+            except (IntegrityError, DataError):
+                db.session.rollback()
+                # Isolate the bad rows so one of them cannot hold back the rest
+                messages = []
+                for record in batch:
+                    try:
+                        messages += persist([record])
+                    except (IntegrityError, DataError) as e:
+                        db.session.rollback()
+                        self.reject(record, e)
+            except Exception:
+                # Database unavailable: keep the batch (and its journal) for the next try
+                db.session.rollback()
+                with self._lock:
+                    self._pending[:0] = batch
+                    self._flushing = []
+                raise
+
+            with self._lock:
+                self._flushing = []
+            for path in self._sealed:
+                os.remove(path)
+            self._sealed = []
+            cache_recent(messages)
+            self.batches += 1
+            self.persisted += len(messages)
+            self.last_batch_size = len(batch)
+            self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def replay(self):
+        """Persist journal segments left by a previous run, oldest first (call inside an app context)
+
+        Only rows the database refuses (integrity or data errors) are rejected.
+        Any other error (a locked or unavailable database) propagates and
+        keeps the segment and those after it for the next try; rows already
+        stored by then are skipped.
+        """
+        while self._leftover:
+            name = self._leftover[0]
+            path = os.path.join(self.journal_dir, name)
+            records = []
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Torn final line from a crash mid-append
+                    fields = entry["fields"]
+                    fields["timestamp"] = datetime.fromisoformat(fields["timestamp"])
+                    records.append((entry["kind"], fields))
+
+            # A crash between commit and segment removal leaves rows already stored
+            for kind, model in MODELS.items():
+                ids = [fields["id"] for k, fields in records if k == kind]
+                stored = {row.id for row in model.query.with_entities(model.id).filter(model.id.in_(ids))} if ids else set()
+                records = [(k, fields) for k, fields in records if k != kind or fields["id"] not in stored]
+
+            for record in records:
+                try:
+                    persist([record])
+                except (IntegrityError, DataError) as e:
+                    db.session.rollback()
+                    self.reject(record, e)
+            os.remove(path)
+            self._leftover.pop(0)
+            log.event("journal_replayed", segment=name, messages=len(records))
+
+    def reject(self, record, error):
+        """Keep a message the database refused next to the journal instead of retrying it forever"""
+        kind, fields = record
+        with open(os.path.join(self.journal_dir, "rejected.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"kind": kind, "fields": fields, "error": str(error)}, default=datetime.isoformat) + "\n")
+        self.rejected += 1
+        log.event("message_rejected", level=logging.ERROR, kind=kind, msg_id=fields["id"], error=str(error))
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pending": self.pending(),
+            "batches": self.batches,
+            "persisted": self.persisted,
+            "rejected": self.rejected,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+
+def persist(records):
+    """Insert ``[(kind, fields)]`` with their inbox updates and commit once"""
+    messages = []
+    for kind, fields in records:
+        msg = MODELS[kind](**fields)
+        db.session.add(msg)
+        if kind == "dm":
+            record_dm(msg)
+        else:
+            record_group_message(msg)
+        messages.append(msg)
+    db.session.commit()
+    return messages
+
+def cache_recent(messages):
+    """Append committed messages to warm rooms of the recent message cache"""
+    from routes.messages import serialize_dms
+    from routes.groups import serialize_group_messages
+
+    group_msgs = [m for m in messages if isinstance(m, GroupMessage)]
+    for m, payload in zip(group_msgs, serialize_group_messages(group_msgs) if group_msgs else []):
+        recent_messages.append(group_room(m.group_id), (m.timestamp, m.id), payload)
+    dms = [m for m in messages if isinstance(m, Message)]
+    for m, payload in zip(dms, serialize_dms(dms) if dms else []):
+        recent_messages.append(dm_room(m.sender_id, m.receiver_id), (m.timestamp, m.id), payload)
+
+
+write_behind = WriteBehindWriter()
@@ -276,7 +276,7 @@
                         return (bytes / (1024 * 1024)).toFixed(1) + ' MB';
                     };
 
-                    const fileSize = msg.file_data.length * 0.75;
+                    const fileSize = msg.file_size ?? msg.file_data.length * 0.75;
 
                     if (msg.file_category === 'photo') {
                         fileContent = `
@@ -12,8 +12,8 @@
         return;
     }
 
-    // Connect to WebSocket server
-    const socket = io();
+    // Connect to WebSocket server (authenticated once with the JWT)
+    const socket = io({ auth: { token: sessionStorage.getItem('token') } });
     let currentRoom = null;
     let currentUserId = null;
 
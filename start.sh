@@ -1,2 +1,57 @@
 #!/bin/bash
-gunicorn -k eventlet -w 1 --bind 0.0.0.0:$PORT wsgi:app
+# One eventlet worker by default. With WEB_WORKERS > 1, one single-worker
+# gunicorn process per worker listens on 127.0.0.1:WORKER_BASE_PORT+i and
+# nginx balances them with sticky sessions on $PORT (Backend/deploy/README.md).
+WEB_WORKERS=${WEB_WORKERS:-1}
+
+if [ "$WEB_WORKERS" -le 1 ]; then
+    exec gunicorn -k eventlet -w 1 --bind 0.0.0.0:$PORT wsgi:app
+fi
+
+if [ -z "$SOCKETIO_MESSAGE_QUEUE" ]; then
+    echo "WEB_WORKERS=$WEB_WORKERS needs SOCKETIO_MESSAGE_QUEUE (e.g. redis://... or sqlite:///...)" >&2
+    exit 1
+fi
+
+if ! command -v nginx >/dev/null 2>&1; then
+    echo "WEB_WORKERS=$WEB_WORKERS needs nginx on PATH to balance the workers" >&2
+    exit 1
+fi
+
+# Run one worker, restarting it whenever it exits; TERM stops it for good
+supervise() {
+    port=$1
+    child=""
+    trap 'kill -TERM $child 2>/dev/null; wait $child; exit 0' TERM INT
+    while :; do
+        gunicorn -k eventlet -w 1 --bind 127.0.0.1:$port wsgi:app &
+        child=$!
+        wait $child
+        echo "Worker on 127.0.0.1:$port exited with status $?, restarting" >&2
+        sleep 1
+    done
+}
+
+WORKER_BASE_PORT=${WORKER_BASE_PORT:-8001}
+UPSTREAMS=""
+SUPERVISORS=""
+for i in $(seq 0 $((WEB_WORKERS - 1))); do
+    supervise $((WORKER_BASE_PORT + i)) &
+    SUPERVISORS="$SUPERVISORS $!"
+    UPSTREAMS="$UPSTREAMS        server 127.0.0.1:$((WORKER_BASE_PORT + i));\n"
+done
+
+NGINX_CONF=$(mktemp)
+sed -e "s|{{PORT}}|$PORT|" -e "s|{{UPSTREAMS}}|$UPSTREAMS|" Backend/deploy/nginx.conf.template > "$NGINX_CONF"
+nginx -c "$NGINX_CONF" -g "daemon off;" &
+NGINX=$!
+
+# Shutdown reaches nginx and every worker; nginx exiting on its own ends the service too
+stop() {
+    kill -TERM $NGINX $SUPERVISORS 2>/dev/null
+    wait
+    exit "${1:-0}"
+}
+trap 'stop 0' TERM INT
+wait $NGINX
+stop $?